@@ -5,38 +5,151 @@ from opencensus.trace.samplers import ProbabilitySampler
 from opencensus.ext.azure.trace_exporter import AzureExporter
 from opencensus.trace.tracer import Tracer
 import logging
-import azure.core.exceptions
 from flask import Flask, request
-from azure.storage.queue import QueueClient
-from azure.data.tables import TableServiceClient
+import collections
 import datetime
 import time
 import json
+import random
+import math
 import uuid
+import os
 from Common import connect_str, queue_name, table_name, instrumentation_key
+import Admission
+import Availability
+import CircuitBreaker
+import Planning
+import Startup
+import Serving
+import Telemetry
+import Storage
+import Metrics
+
+history_max_age = 5  # minutes an availability observation may be used to answer run once requests
+stale_history_max_age = 60  # minutes, while the circuit breaker around the IND site is open
+max_bulk_requests = int(os.environ.get('MAX_BULK_REQUESTS', 1000))  # requests or run ids per bulk call
+job_timing_rate = float(os.environ.get('JOB_TIMING_RATE', 1.0))  # share of run once requests timed per stage
 
 guid = str(uuid.uuid4())
 FORMAT = '[%(asctime)s] [API-SERVER] [{}] %(message)s'.format(guid)
 config_integration.trace_integrations(['logging', 'requests'])
-tracer = Tracer(exporter=AzureExporter(connection_string=instrumentation_key), sampler=ProbabilitySampler(1.0))
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-logger.addHandler(AzureLogHandler(connection_string=instrumentation_key))
+startup = Startup.Startup(service='api-server', logger=logger)
+sampling_rules = Telemetry.SamplingRules.from_environment()
+trace_exporter = Telemetry.TraceExporter(
+    target=Startup.Lazy(factory=lambda: AzureExporter(connection_string=instrumentation_key)), rules=sampling_rules)
+tracer = Tracer(exporter=trace_exporter, sampler=ProbabilitySampler(1.0))
 
 app = Flask(__name__)
-middleware = FlaskMiddleware(app,exporter=AzureExporter(connection_string=instrumentation_key),
-                             sampler=ProbabilitySampler(rate=1.0),)
+middleware = FlaskMiddleware(app, exporter=trace_exporter, sampler=ProbabilitySampler(rate=1.0),
+                             excludelist_paths=Telemetry.UNTRACED_PATHS)
+Startup.add_probes(app=app, startup=startup)
+
+metrics = Metrics.Registry()
+storage_seconds = metrics.histogram('storage_call_seconds', "Time taken by calls to table and queue storage",
+                                    labels=('operation',))
+telemetry = {'traces': trace_exporter}
+
+
+def create_storage():
+
+    created = Storage.create_storage(
+        name=os.environ.get('STORAGE_BACKEND', 'azure'), path=os.environ.get('STORAGE_PATH'), connect_str=connect_str,
+        table_name=table_name, queue_name=queue_name)
+    created.call_listener = lambda operation, seconds: storage_seconds.observe(seconds, operation=operation)
+    return created
 
-run_once_queue_client = QueueClient.from_connection_string(connect_str, queue_name)
-table_service = TableServiceClient.from_connection_string(conn_str=connect_str)
-table_client = table_service.get_table_client(table_name=table_name)
+
+storage = Startup.Lazy(factory=create_storage)
+breaker = Startup.Lazy(factory=lambda: CircuitBreaker.CircuitBreaker(storage=storage, logger=logger))
+admission = Startup.Lazy(factory=lambda: Admission.AdmissionControl(
+    storage=storage, max_queue_seconds=float(os.environ.get('MAX_QUEUE_SECONDS', 300)),
+    min_queue_depth=int(os.environ.get('MIN_QUEUE_DEPTH', 100)), logger=logger))
+client_limiter = Admission.ClientLimiter(rate=float(os.environ.get('CLIENT_RATE', 1)),
+                                         burst=float(os.environ.get('CLIENT_BURST', 20)))
+# Endpoints that submit work, limited per client
+LIMITED_ENDPOINTS = {'run_once', 'run_once_bulk', 'run_continuous', 'run_continuous_bulk'}
+metrics.gauge('storage_queue_depth', "Run once requests waiting in the queue",
+              function=lambda: storage.queue_depth() if storage.loaded else 0)
+metrics.gauge('api_queue_drain_seconds', "Estimated time to drain the run once queue at the recent controller rate",
+              function=lambda: (admission.status()['drain_seconds'] or 0) if admission.loaded else 0)
+rejected_requests = metrics.counter('api_rejected_requests', "Requests turned away by admission control",
+                                    labels=('reason',))
+Metrics.add_endpoint(app=app, registry=metrics, telemetry=telemetry)
+
+
+def start_telemetry():
+    """
+    Create the trace exporter and start exporting sampled logs to Application Insights. Runs in the background so
+    exporters do not delay readiness, logs from before are only written to the console.
+    """
+    trace_exporter.target.load()
+    telemetry['logs'] = Telemetry.LogHandler(target=AzureLogHandler(connection_string=instrumentation_key),
+                                             rules=sampling_rules)
+    logger.addHandler(telemetry['logs'])
 
 
 def send_message_to_queue(message):
 
     logger.info("Sending run once job to queue: {}".format(message))
-    run_once_queue_client.send_message(message)
+    storage.send_message(message)
+
+
+def _trace_context():
+    """
+    Context carried along with run once requests in their queue message, and by the controller in their job record
+    and the parameters sent to the worker, so the spans of every service join the trace of the request. Timed requests
+    also get a JobTiming record of the stages they pass, see job_timing.
+    :return: traceparent, time the request was queued and whether it is timed (dict)
+    """
+    return {'traceparent': Telemetry.traceparent(), 'enqueued_at': time.time(),
+            'timed': random.random() < job_timing_rate}
+
+
+def _start_timings(traces):
+    """
+    Start the timing records of the queued run once requests that are timed. Failing to do so only logs an error.
+    :param traces: run id to the context the request was queued with (dict of dict, see _trace_context)
+    """
+    timings = {run_id: {'EnqueuedAt': trace['enqueued_at'], 'TraceParent': trace['traceparent']}
+               for run_id, trace in traces.items() if trace['timed']}
+    if not timings:
+        return
+    try:
+        storage.create_job_timings(timings=timings)
+    except Exception as e:
+        logger.error("Could not store job timings: {}".format(e))
+
+
+def _client():
+    """
+    :return: address of the client, as forwarded by the web frontend (str)
+    """
+    forwarded = request.headers.get('X-Forwarded-For')
+    return forwarded.split(',')[0].strip() if forwarded else request.remote_addr
+
+
+@app.before_request
+def limit_clients():
+
+    if request.endpoint not in LIMITED_ENDPOINTS:
+        return None
+    wait = client_limiter.acquire(client=_client())
+    if wait:
+        rejected_requests.inc(reason='client_rate')
+        return "Too many requests, try again later", 429, {'Retry-After': str(math.ceil(wait))}
+    return None
+
+
+def _over_capacity(retry_after):
+    """
+    :param retry_after: time in seconds, as returned by Admission.AdmissionControl.admit (int)
+    :return: 429 response (tuple)
+    """
+    rejected_requests.inc(reason='over_capacity')
+    return "Too many requests waiting, try again later", 429, {'Retry-After': str(retry_after)}
 
 
 @app.route("/run_once", methods=['POST'])
@@ -44,43 +157,231 @@ def run_once():
 
     parameters = json.loads(request.json)
     run_id = uuid.uuid4()
-    message = u"{},{},{},{},0".format(run_id, parameters['start_date'], parameters['end_date'],
-                                    '+'.join(parameters['desks']))
+    try:
+        plan = Planning.plan_request(start_date=parameters['start_date'], end_date=parameters['end_date'],
+                                     desks=parameters['desks'], max_results=parameters.get('max_results', 1))
+    except (KeyError, ValueError) as e:
+        return "Invalid request: {}".format(e), 400
+    site_down = breaker.is_open()
+    results = _answer_from_history(parameters=parameters, max_age=stale_history_max_age if site_down else
+                                   history_max_age) if plan['max_results'] == 1 else None
+    retry_after = admission.admit(jobs=1) if results is None and not site_down else 0
+    if retry_after and plan['max_results'] == 1:
+        # Older availability is better than a check whose result would be stale by the time the queue drained
+        results = _answer_from_history(parameters=parameters, max_age=stale_history_max_age)
+    if results is not None:
+        storage.store_result(run_id=str(run_id), result=results)
+        logger.info("Answered run once job {} from availability history".format(run_id))
+        return str(run_id)
+    if site_down:
+        return "The IND site is unavailable, try again later", 503, {'Retry-After': str(breaker.retry_after())}
+    if retry_after:
+        return _over_capacity(retry_after=retry_after)
+    trace = _trace_context()
+    message = json.dumps({'run_id': str(run_id), 'plan': plan, 'error_count': 0, 'trace': trace})
+    _start_timings(traces={str(run_id): trace})
     send_message_to_queue(message=message)
     return str(run_id)
 
 
+def _answer_from_history(parameters, max_age=history_max_age, observations=None):
+    """
+    Answer a run once request for the earliest day per desk from fresh availability observations if every requested
+    desk has one that covers the request, so no worker has to open a browser for it.
+    :param parameters: run once request parameters (dict)
+    :param max_age: minutes an observation may be used (float)
+    :param observations: desk to its observations made within max_age, as returned by _recent_observations (dict,
+                         optional, None to query them)
+    :return: results (str) or None if the request could not be answered or nothing is available
+    """
+    try:
+        start_date = Planning.parse_date(parameters['start_date'])
+        end_date = Planning.parse_date(parameters['end_date'])
+        since = datetime.datetime.now() - datetime.timedelta(minutes=max_age)
+        results = []
+        for desk in parameters['desks']:
+            desk_observations = Availability.query_recent(storage=storage, desk=desk, since=since) \
+                if observations is None else observations.get(desk, [])
+            answered, slot = Availability.answer_from_history(observations=desk_observations, start_date=start_date,
+                                                              end_date=end_date)
+            if not answered:
+                return None
+            if slot:
+                results.append(Planning.format_result(desk=desk, date=slot))
+        return ','.join(results) or None
+    except Exception as e:
+        logger.error("Could not check availability history: {}".format(e))
+        return None
+
+
+def _recent_observations(desks, max_age=history_max_age):
+    """
+    Query the availability observations of desks once, to answer many run once requests from.
+    :param desks: set of str
+    :param max_age: minutes an observation may be used (float)
+    :return: desk to its observations (dict of list, None if they could not be queried)
+    """
+    since = datetime.datetime.now() - datetime.timedelta(minutes=max_age)
+    try:
+        return {desk: Availability.query_recent(storage=storage, desk=desk, since=since) for desk in desks}
+    except Exception as e:
+        logger.error("Could not check availability history: {}".format(e))
+        return None
+
+
+@app.route("/run_once/bulk", methods=['POST'])
+def run_once_bulk():
+    """
+    Submit many run once requests in one call: all requests are validated before any is accepted, the availability
+    history of every desk they ask for is queried once, answers from it are stored in one batch and the others sent
+    to the queue in one batch.
+    :return: run ids in the order of the requests (JSON list)
+    """
+    requests, error = _bulk_requests()
+    if error:
+        return error
+    plans, errors = _plan_requests(requests=requests)
+    if errors:
+        return json.dumps({'errors': errors}), 400, {'Content-Type': 'application/json'}
+    site_down = breaker.is_open()
+    max_age = stale_history_max_age if site_down else history_max_age
+    observations = _recent_observations(desks=set(desk for parameters, plan in zip(requests, plans)
+                                                  if plan['max_results'] == 1 for desk in parameters['desks']),
+                                        max_age=max_age)
+    run_ids, answered, queued = [], {}, []
+    for parameters, plan in zip(requests, plans):
+        run_id = str(uuid.uuid4())
+        run_ids.append(run_id)
+        results = _answer_from_history(parameters=parameters, max_age=max_age, observations=observations) \
+            if plan['max_results'] == 1 and observations is not None else None
+        if results is not None:
+            answered[run_id] = results
+        else:
+            queued.append((run_id, plan))
+    if site_down and queued:
+        return "The IND site is unavailable, try again later", 503, {'Retry-After': str(breaker.retry_after())}
+    retry_after = admission.admit(jobs=len(queued)) if queued else 0
+    if retry_after:
+        return _over_capacity(retry_after=retry_after)
+    if answered:
+        storage.create_results(results=answered)
+    if queued:
+        # Every request is timed (or not) on its own, as the single requests are
+        traces = {run_id: _trace_context() for run_id, _ in queued}
+        _start_timings(traces=traces)
+        storage.send_messages(contents=[json.dumps({'run_id': run_id, 'plan': plan, 'error_count': 0,
+                                                    'trace': traces[run_id]}) for run_id, plan in queued])
+    logger.info("Accepted {} run once job(s), {} answered from availability history".format(
+        len(run_ids), len(answered)))
+    return json.dumps(run_ids), {'Content-Type': 'application/json'}
+
+
 @app.route("/run_continuous", methods=['POST'])
 def run_continuous():
 
     parameters = json.loads(request.json)
     job_id = str(uuid.uuid4())
-    entity = {
-        'PartitionKey': 'ContinuousRun',
-        'RowKey': job_id,
-        'StartDate': parameters['start_date'],
-        'EndDate': parameters['end_date'],
-        'Desks': '+'.join(parameters['desks']),
-        'Email': parameters['email'] or 'none',
-        'LastRun': '',
-        'ErrorCount': 0}
-    table_client.create_entity(entity)
+    try:
+        plan = Planning.plan_request(start_date=parameters['start_date'], end_date=parameters['end_date'],
+                                     desks=parameters['desks'], max_results=parameters.get('max_results', 1))
+    except (KeyError, ValueError) as e:
+        return "Invalid request: {}".format(e), 400
+    entity = storage.create_continuous_run(run_id=job_id, properties=_continuous_run_properties(
+        parameters=parameters, plan=plan))
     logger.info("Sending continuous run job to database: {}".format(entity))
     return job_id
 
 
+@app.route("/run_continuous/bulk", methods=['POST'])
+def run_continuous_bulk():
+    """
+    Submit many continuous runs in one call: all runs are validated before any is stored, and stored in one batch.
+    :return: run ids in the order of the requests (JSON list)
+    """
+    requests, error = _bulk_requests()
+    if error:
+        return error
+    plans, errors = _plan_requests(requests=requests)
+    if errors:
+        return json.dumps({'errors': errors}), 400, {'Content-Type': 'application/json'}
+    try:
+        runs = collections.OrderedDict(
+            (str(uuid.uuid4()), _continuous_run_properties(parameters=parameters, plan=plan))
+            for parameters, plan in zip(requests, plans))
+    except KeyError as e:
+        return "Invalid request: {}".format(e), 400
+    storage.create_continuous_runs(runs=runs)
+    logger.info("Sending {} continuous run job(s) to database".format(len(runs)))
+    return json.dumps(list(runs)), {'Content-Type': 'application/json'}
+
+
+def _continuous_run_properties(parameters, plan):
+    """
+    :param parameters: continuous run request parameters (dict)
+    :param plan: as returned by Planning.plan_request (dict)
+    :return: properties of the continuous run entity (dict)
+    """
+    return {'StartDate': parameters['start_date'],
+            'EndDate': parameters['end_date'],
+            'Desks': '+'.join(parameters['desks']),
+            'Email': parameters['email'] or 'none',
+            'Plan': json.dumps(plan),
+            'LastRun': '',
+            'ErrorCount': 0}
+
+
+def _bulk_requests():
+    """
+    Read the requests of a bulk call: a JSON list of request parameters, or a JSON string holding one as the single
+    request endpoints take.
+    :return: list of parameters (list of dict) and an error response (tuple, None if the requests were read)
+    """
+    requests = request.get_json(silent=True)
+    try:
+        if isinstance(requests, str):
+            requests = json.loads(requests)
+    except ValueError:
+        requests = None
+    if not isinstance(requests, list) or not all(isinstance(parameters, dict) for parameters in requests):
+        return None, ("Invalid request: expected a list of requests", 400)
+    if len(requests) > max_bulk_requests:
+        return None, ("Too many requests, at most {} per call".format(max_bulk_requests), 413)
+    return requests, None
+
+
+def _plan_requests(requests):
+    """
+    :param requests: request parameters (list of dict)
+    :return: plans of the requests (list of dict) and the error of every invalid request by its index (dict of str)
+    """
+    plans, errors = [], {}
+    for index, parameters in enumerate(requests):
+        try:
+            plans.append(Planning.plan_request(start_date=parameters['start_date'], end_date=parameters['end_date'],
+                                               desks=parameters['desks'],
+                                               max_results=parameters.get('max_results', 1)))
+        except (KeyError, ValueError) as e:
+            errors[index] = "Invalid request: {}".format(e)
+    return plans, errors
+
+
 @app.route("/desks", methods=['GET'])
 def desks():
 
     try:
-        entity = table_client.get_entity('Desks', '0')
+        entity = storage.get_desks()
+        if breaker.is_open():
+            # Expired desks are better than waiting for a check that will not be dispatched
+            return entity['Desks']
         if not datetime.datetime.now() - datetime.datetime.strptime(entity['CheckedAt'], '%d/%m/%Y %H:%M:%S') < \
            datetime.timedelta(minutes=60):
             logger.info("Desk data expired: {}".format(entity))
-            table_client.delete_entity(partition_key='Desks', row_key='0')
+            storage.delete_desks()
             raise ValueError("Desks checked too long ago")
         desks = entity['Desks']
-    except (azure.core.exceptions.ResourceNotFoundError, ValueError):
+    except (Storage.NotFoundError, ValueError):
+        if breaker.is_open():
+            return "The IND site is unavailable, try again later", 503, {'Retry-After': str(breaker.retry_after())}
         send_message_to_queue(message="check_desks, 0")
         logger.info("Sending check desks job to queue")
         desks = _wait_for_desk_result()
@@ -89,29 +390,175 @@ def desks():
 
 def _wait_for_desk_result():
 
+    timer = 1
     while True:
-        timer = 1
         try:
-            if timer > 120:
-                return
-            return table_client.get_entity('Desks', '0')['Desks']
-        except azure.core.exceptions.ResourceNotFoundError:
+            if timer > 120 or breaker.is_open():
+                return ''
+            return storage.get_desks()['Desks']
+        except Storage.NotFoundError:
             timer += 1
             time.sleep(1)
             continue
 
 
+@app.route('/availability')
+def availability():
+    """
+    Summarize availability observed per desk over the last 'minutes' (default 60). Desks can be passed as '+' separated
+    'desks' argument, all known desks are summarized otherwise.
+    """
+    minutes = int(request.args.get('minutes', 60))
+    if 'desks' in request.args:
+        desk_names = request.args['desks'].split('+')
+    else:
+        try:
+            # Desks that expired are good enough to summarize history by
+            desk_names = storage.get_desks()['Desks'].split(',')
+        except Storage.NotFoundError:
+            response = desks()
+            if isinstance(response, tuple):
+                return response
+            desk_names = response.split(',')
+    since = datetime.datetime.now() - datetime.timedelta(minutes=minutes)
+    summary = {}
+    for desk in filter(None, desk_names):
+        observations = Availability.query_recent(storage=storage, desk=desk, since=since)
+        summary[desk] = Availability.earliest_slot(observations=observations)
+    return json.dumps(summary)
+
+
 @app.route('/get_result')
 def get_result():
 
     run_id = request.args['run_id']
     try:
-        entity = table_client.get_entity('Result', run_id)
-        return entity['Result']
-    except azure.core.exceptions.ResourceNotFoundError:
+        result = storage.get_result(run_id=run_id)
+    except Storage.NotFoundError:
         return ''
+    _record_fetches(run_ids=[run_id])
+    return result
+
+
+@app.route('/get_results', methods=['GET', 'POST'])
+def get_results():
+    """
+    Look up the results of many runs at once, by comma separated 'run_ids' or a JSON list of run ids in the body.
+    :return: run id to result, '' for runs without a result yet (JSON object)
+    """
+    if request.method == 'POST':
+        run_ids = request.get_json(silent=True)
+    else:
+        run_ids = [run_id for run_id in request.args.get('run_ids', '').split(',') if run_id]
+    if not isinstance(run_ids, list) or not all(isinstance(run_id, str) for run_id in run_ids):
+        return "Invalid request: expected a list of run ids", 400
+    if len(run_ids) > max_bulk_requests:
+        return "Too many run ids, at most {} per call".format(max_bulk_requests), 413
+    results = storage.get_results(run_ids=run_ids)
+    _record_fetches(run_ids=list(results))
+    return json.dumps({run_id: results.get(run_id, '') for run_id in run_ids}), {'Content-Type': 'application/json'}
+
+
+def _record_fetches(run_ids):
+    """
+    Store when the results of timed runs were fetched first. Failing to do so only logs an error.
+    :param run_ids: runs whose results were fetched (list of uuid4 str)
+    """
+    if not run_ids:
+        return
+    try:
+        for run_id, timing in storage.get_job_timings(run_ids=run_ids).items():
+            if not timing.get('ResultFetchedAt'):
+                storage.store_job_timing(run_id=run_id, properties={'ResultFetchedAt': time.time()})
+    except Exception as e:
+        logger.error("Could not store result fetch times: {}".format(e))
+
+
+@app.route('/job_timing')
+def job_timing():
+    """
+    Where a timed run once request spent its time: waiting in the queue (until a controller took it), being
+    dispatched (until a worker accepted it), on the worker (with the time per engine step, like starting the browser
+    and loading pages, and per scraped desk), being returned and stored (until its result was stored) and waiting to
+    be fetched (until its result was first fetched). Stages the request did not pass yet are null, the trace id finds
+    the spans of the request in Application Insights.
+    :return: JSON object, 404 if the run is unknown or was not timed
+    """
+    try:
+        timing = storage.get_job_timing(run_id=request.args['run_id'])
+    except Storage.NotFoundError:
+        return "Unknown run, or the run was not timed", 404
+    return json.dumps(_timing_stages(timing=timing)), {'Content-Type': 'application/json'}
+
+
+def _timing_stages(timing):
+    """
+    :param timing: JobTiming entity (dict)
+    :return: when the run passed each stage, and how long each stage took in seconds (dict)
+    """
+    names = {'enqueued': 'EnqueuedAt', 'dequeued': 'DequeuedAt', 'dispatched': 'DispatchedAt',
+             'result_stored': 'ResultStoredAt', 'result_fetched': 'ResultFetchedAt'}
+    times = {name: float(timing[key]) if timing.get(key) else None for name, key in names.items()}
+
+    def between(first, last):
+        return round(times[last] - times[first], 3) if times[first] and times[last] else None
+
+    worker_seconds = float(timing['WorkerSeconds']) if timing.get('WorkerSeconds') else None
+    stored = between('dispatched', 'result_stored')
+    seconds = {'queued': between('enqueued', 'dequeued'), 'dispatch': between('dequeued', 'dispatched'),
+               'worker': worker_seconds,
+               'delivery': round(stored - worker_seconds, 3) if stored is not None and worker_seconds else None,
+               'fetch': between('result_stored', 'result_fetched'),
+               'total': between('enqueued', 'result_fetched') or between('enqueued', 'result_stored')}
+    traceparent = timing.get('TraceParent') or ''
+    return {'run_id': timing['RowKey'], 'trace_id': traceparent.split('-')[1] if traceparent else None,
+            'worker_id': timing.get('WorkerId'), 'attempt': timing.get('Attempt'),
+            'batch_size': timing.get('BatchSize'), 'times': times, 'seconds': seconds,
+            'steps': json.loads(timing.get('Steps') or '{}'), 'desks': json.loads(timing.get('Desks') or '{}')}
+
+
+@app.route('/dead_letters', methods=['GET'])
+def dead_letters():
+    """
+    Jobs the controllers stopped retrying, with the number of attempts and the last error.
+    """
+    return json.dumps([{'job_id': entity['RowKey'], 'type': entity['Type'], 'attempts': entity['Attempts'],
+                        'error': entity['Error'], 'failed_at': entity['FailedAt'], 'content': entity['Content']}
+                       for entity in storage.dead_letters()])
+
+
+@app.route('/dead_letters/<job_id>/replay', methods=['POST'])
+def replay_dead_letter(job_id):
+    """
+    Run a dead lettered job again: run once requests and desk checks are queued, continuous runs recreated.
+    """
+    try:
+        entity = storage.get_dead_letter(job_id=job_id)
+    except Storage.NotFoundError:
+        return "Unknown job", 404
+    if entity['Type'] == 'continuous':
+        storage.create_continuous_run(run_id=job_id, properties=dict(json.loads(entity['Content']), LastRun='',
+                                                                      ErrorCount=0))
+    else:
+        send_message_to_queue(message=entity['Content'])
+    storage.delete_dead_letter(job_id=job_id)
+    logger.info("Replayed dead lettered {} job {}".format(entity['Type'], job_id))
+    return "OK"
+
+
+@app.route('/dead_letters/<job_id>', methods=['DELETE'])
+def delete_dead_letter(job_id):
+
+    storage.delete_dead_letter(job_id=job_id)
+    return "OK"
+
+
+def start_api_server():
+
+    startup.in_background(name='telemetry', target=start_telemetry)
+    startup.in_background(name='storage', target=storage.load, required=True)
 
 
 if __name__ == '__main__':
 
-    app.run(host='0.0.0.0', port=5001)
+    Serving.run(app=app, port=5001, on_start=start_api_server, logger=logger)
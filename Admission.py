@@ -0,0 +1,175 @@
+import collections
+import threading
+import logging
+import math
+import time
+
+
+class ThroughputMeter(object):
+
+    def __init__(self, storage, name, window=60, logger=None):
+        """
+        Measures the rate at which a controller finishes queued requests, and shares it through storage so API servers
+        can tell how fast the queue drains. The rate is averaged over the last window seconds.
+        :param storage: Storage
+        :param name: unique name of the controller (str)
+        :param window: time in seconds to average the rate over (float)
+        :param logger: logger to report failures to (logging.Logger, optional)
+        """
+        self.storage = storage
+        self.name = name
+        self.window = window
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.finished = collections.deque()
+        self.started = time.monotonic()
+
+    def record(self):
+        """
+        Record that a queued request was finished.
+        """
+        with self.lock:
+            self.finished.append(time.monotonic())
+
+    def rate(self):
+        """
+        :return: queued requests finished per second over the window, or since the meter started (float)
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.finished and self.finished[0] < now - self.window:
+                self.finished.popleft()
+            return len(self.finished) / max(1.0, min(self.window, now - self.started))
+
+    def publish(self):
+        """
+        Store the current rate for the API servers. Errors are only logged.
+        """
+        try:
+            self.storage.store_throughput(name=self.name, properties={'JobsPerSecond': self.rate(),
+                                                                      'UpdatedAt': time.time()})
+        except Exception as e:
+            self.logger.error("Could not store throughput: {}".format(e))
+
+
+class ClientLimiter(object):
+
+    def __init__(self, rate, burst, max_clients=10000):
+        """
+        Token bucket per client. Only the max_clients clients seen most recently are kept: a client seen longer ago
+        starts with a full bucket, as its bucket would have refilled by then in all but the busiest cases.
+        :param rate: calls per second a client may make (float)
+        :param burst: number of calls a client may make at once after a quiet period (float)
+        :param max_clients: int
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict()
+
+    def acquire(self, client):
+        """
+        Take a token from the bucket of a client if it has one.
+        :param client: e.g. the address of the client (str)
+        :return: time in seconds until the client may call again (float, 0 if it may call now)
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            self.buckets[client] = (tokens - 1 if not wait else tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            return wait
+
+
+class AdmissionControl(object):
+
+    def __init__(self, storage, max_queue_seconds=300, min_queue_depth=100, stale_seconds=60, sync_interval=5,
+                 retry_seconds=30, logger=None):
+        """
+        Admits requests to the run once queue while it drains within max_queue_seconds at the rate the controllers
+        finished queued requests recently (see ThroughputMeter), so requests are not queued for longer than their
+        results stay useful. Up to min_queue_depth requests are always admitted, which covers a quiet cluster that
+        has no recent rate to go by. The queue depth and rates are read every sync_interval seconds, requests
+        admitted in between are counted on top.
+        :param storage: Storage
+        :param max_queue_seconds: longest time in seconds a request may wait in the queue (float)
+        :param min_queue_depth: number of queued requests that is always admitted (int)
+        :param stale_seconds: age in seconds after which the rate of a controller is ignored, as it stopped (float)
+        :param sync_interval: time in seconds between reading the queue depth and rates from storage (float)
+        :param retry_seconds: time in seconds to retry after when no controller reported a rate (int)
+        :param logger: logger to report failures to (logging.Logger, optional)
+        """
+        self.storage = storage
+        self.max_queue_seconds = max_queue_seconds
+        self.min_queue_depth = min_queue_depth
+        self.stale_seconds = stale_seconds
+        self.sync_interval = sync_interval
+        self.retry_seconds = retry_seconds
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.jobs_per_second = 0.0
+        self.admitted = 0
+        self.synced_at = 0.0
+
+    def admit(self, jobs=1):
+        """
+        Admit requests to the queue if it drains in time with them.
+        :param jobs: number of requests to queue (int)
+        :return: time in seconds to retry after (int, 0 if the requests are admitted)
+        """
+        self.sync()
+        with self.lock:
+            excess = self.queue_depth + self.admitted + jobs - self._allowed_depth()
+            if excess <= 0:
+                self.admitted += jobs
+                return 0
+            if not self.jobs_per_second:
+                return self.retry_seconds
+            return int(min(self.max_queue_seconds, max(1, math.ceil(excess / self.jobs_per_second))))
+
+    def status(self):
+        """
+        :return: queue depth, rate at which it drains, estimated time to drain it and the depth admitted up to (dict)
+        """
+        self.sync()
+        with self.lock:
+            depth = self.queue_depth + self.admitted
+            return {'queue_depth': depth, 'jobs_per_second': round(self.jobs_per_second, 3),
+                    'drain_seconds': round(depth / self.jobs_per_second, 1) if self.jobs_per_second else None,
+                    'allowed_depth': self._allowed_depth()}
+
+    def _allowed_depth(self):
+
+        return max(self.min_queue_depth, int(self.jobs_per_second * self.max_queue_seconds))
+
+    def sync(self, force=False):
+        """
+        Read the queue depth and the rates of the controllers that are running. Rates of controllers that stopped long
+        ago are deleted.
+        :param force: read even if the last read was less than sync_interval ago (Bool)
+        """
+        now = time.time()
+        if not force and now - self.synced_at < self.sync_interval:
+            return
+        self.synced_at = now
+        try:
+            queue_depth = self.storage.queue_depth()
+            jobs_per_second = 0.0
+            for entity in self.storage.throughputs():
+                age = now - float(entity['UpdatedAt'])
+                if age < self.stale_seconds:
+                    jobs_per_second += float(entity['JobsPerSecond'])
+                elif age > 10 * self.stale_seconds:
+                    self.storage.delete_throughput(name=entity['RowKey'])
+        except Exception as e:
+            self.logger.error("Could not read queue depth and throughput: {}".format(e))
+            return
+        with self.lock:
+            self.queue_depth = queue_depth
+            self.jobs_per_second = jobs_per_second
+            self.admitted = 0
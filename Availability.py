@@ -0,0 +1,173 @@
+import datetime
+import uuid
+import Planning
+
+PARTITION_PREFIX = 'Availability'
+SLOT_FORMAT = '%Y-%m-%d'
+OBSERVED_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def partition_key(desk, day):
+    """
+    Availability observations are partitioned by desk and day, so recent history of a single desk can be read from one
+    or two partitions.
+    :param desk: desk name (str)
+    :param day: day the observation was made (datetime)
+    :return: str
+    """
+    return '{}_{}_{}'.format(PARTITION_PREFIX, desk.lower(), day.strftime('%Y%m%d'))
+
+
+def row_key(observed_at):
+    """
+    Row keys start with the observation time so they sort chronologically within a partition.
+    :param observed_at: datetime
+    :return: str
+    """
+    return '{}_{}'.format(observed_at.strftime(OBSERVED_FORMAT), uuid.uuid4().hex[:8])
+
+
+def observation_entities(desks, window_start, window_end, results, job_id, observed_at=None):
+    """
+    Create one availability entity per scraped desk. A desk without a result is recorded too, as 'nothing available
+    in this window' is an observation as well.
+    :param desks: desks that were scraped (list of str)
+    :param window_start: first day that was scraped (datetime.date)
+    :param window_end: last day that was scraped (datetime.date)
+    :param results: comma separated result string as returned by a worker (str)
+    :param job_id: uuid4 (str)
+    :param observed_at: time of observation (optional, None for current time)
+    :return: list of dict
+    """
+    observed_at = observed_at or datetime.datetime.now()
+    slots = {}
+    for result in filter(None, results.split(',')):
+        parsed = Planning.parse_result(result, now=observed_at)
+        if parsed:
+            desk, date = parsed
+            slots.setdefault(desk.lower(), (desk, []))[1].append(date)
+    entities = []
+    for desk in desks:
+        desk_name, dates = slots.get(desk.lower(), (desk, []))
+        dates = sorted(dates)
+        entities.append({
+            'PartitionKey': partition_key(desk=desk, day=observed_at),
+            'RowKey': row_key(observed_at=observed_at),
+            'Desk': desk_name,
+            'ObservedAt': observed_at.strftime(OBSERVED_FORMAT),
+            'WindowStart': window_start.strftime(SLOT_FORMAT),
+            'WindowEnd': window_end.strftime(SLOT_FORMAT),
+            'Slots': ','.join(date.strftime(SLOT_FORMAT) for date in dates),
+            'EarliestSlot': dates[0].strftime(SLOT_FORMAT) if dates else '',
+            'JobId': job_id
+        })
+    return entities
+
+
+def slots_by_window(results):
+    """
+    :param results: comma separated result string as returned by a worker (str)
+    :return: (desk, year, month) to available days (dict of set of datetime.date)
+    """
+    windows = {}
+    for result in filter(None, results.split(',')):
+        parsed = Planning.parse_result(result)
+        if parsed:
+            desk, date = parsed
+            windows.setdefault((desk.lower(), date.year, date.month), set()).add(date)
+    return windows
+
+
+def changed_windows(previous, current):
+    """
+    Compare two observations of the same desks and months per (desk, month) window.
+    :param previous: comma separated results observed before (str)
+    :param current: comma separated results observed now (str)
+    :return: windows whose available days changed, and windows that have days available that were not before
+             (tuple of sorted lists of (desk, year, month))
+    """
+    before, now = slots_by_window(previous), slots_by_window(current)
+    changed = sorted(window for window in set(before) | set(now) if before.get(window) != now.get(window))
+    appeared = sorted(window for window in now if now[window] - before.get(window, set()))
+    return changed, appeared
+
+
+def replace_desks(previous, current, desks=None):
+    """
+    Combine the results of a check of some desks with the results observed before for the other desks.
+    :param previous: comma separated results observed before (str)
+    :param current: comma separated results of the check (str)
+    :param desks: desks that were checked (list of str, optional, None for all desks)
+    :return: comma separated results (str)
+    """
+    if desks is None:
+        return current
+    desks = set(desk.lower() for desk in desks)
+    kept = []
+    for result in filter(None, previous.split(',')):
+        parsed = Planning.parse_result(result)
+        if parsed and parsed[0].lower() not in desks:
+            kept.append(result)
+    return ','.join(kept + list(filter(None, current.split(','))))
+
+
+def query_recent(storage, desk, since, now=None):
+    """
+    Return observations for a desk made since a point in time, oldest first.
+    :param storage: Storage.Storage
+    :param desk: str
+    :param since: datetime
+    :param now: datetime (optional, None for current time)
+    :return: list of dict
+    """
+    now = now or datetime.datetime.now()
+    observations = []
+    day = since.date()
+    while day <= now.date():
+        observations.extend(storage.query_partition(partition_key=partition_key(desk=desk, day=day),
+                                                    row_key_from=since.strftime(OBSERVED_FORMAT)))
+        day += datetime.timedelta(days=1)
+    return observations
+
+
+def earliest_slot(observations):
+    """
+    Summarize observations of a single desk.
+    :param observations: list of dict
+    :return: dict
+    """
+    slots = [observation['EarliestSlot'] for observation in observations if observation['EarliestSlot']]
+    last = max(observations, key=lambda observation: observation['ObservedAt']) if observations else None
+    return {
+        'earliest_slot': min(slots) if slots else None,
+        'last_observed_at': datetime.datetime.strptime(last['ObservedAt'], OBSERVED_FORMAT).strftime(
+            '%d/%m/%Y %H:%M:%S') if last else None,
+        'observations': len(observations)
+    }
+
+
+def answer_from_history(observations, start_date, end_date):
+    """
+    Try to answer a request for a single desk from its observations. An observation answers a request when it
+    scraped from (at least) the first day of the request, because its earliest slot is then also the earliest slot
+    of the request. Newest observations are tried first.
+    :param observations: list of dict
+    :param start_date: datetime.date
+    :param end_date: datetime.date
+    :return: (True, date or None) if answered, (False, None) otherwise
+    """
+    for observation in sorted(observations, key=lambda observation: observation['ObservedAt'], reverse=True):
+        window_start = datetime.datetime.strptime(observation['WindowStart'], SLOT_FORMAT).date()
+        window_end = datetime.datetime.strptime(observation['WindowEnd'], SLOT_FORMAT).date()
+        if window_start > start_date:
+            continue
+        if observation['EarliestSlot']:
+            slot = datetime.datetime.strptime(observation['EarliestSlot'], SLOT_FORMAT).date()
+            if start_date <= slot <= end_date:
+                return True, slot
+            if slot > end_date:
+                return True, None
+        elif window_end >= end_date:
+            return True, None
+    return False, None
+
@@ -0,0 +1,348 @@
+from concurrent.futures import ThreadPoolExecutor
+import Engines
+import ReplayServer
+import Serving
+import argparse
+import collections
+import threading
+import datetime
+import logging
+import time
+import math
+import uuid
+import sys
+import os
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def percentile(values, percent):
+    """
+    Nearest rank percentile.
+    :param values: list of float
+    :param percent: 0-100 (int)
+    :return: float or None if there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100.0 * len(ordered)) - 1)]
+
+
+def format_latencies(values):
+    """
+    :param values: latencies in seconds (list of float)
+    :return: p50/p95/p99 in milliseconds (str)
+    """
+    if not values:
+        return 'n/a'
+    return '/'.join('{:.1f}'.format(percentile(values, percent) * 1000) for percent in (50, 95, 99))
+
+
+class StepRecorder(object):
+
+    def __init__(self):
+        """
+        Collects step timings reported by an engine, used as its step_listener.
+        """
+        self.lock = threading.Lock()
+        self.steps = collections.defaultdict(list)
+
+    def __call__(self, name, seconds, desk=None):
+
+        with self.lock:
+            self.steps[name].append(seconds)
+
+
+class RssSampler(object):
+
+    def __init__(self, pool, interval=0.2):
+        """
+        Samples the resident memory of every browser of a pool (chromedriver, chrome and its renderers) and keeps the
+        highest seen for a single browser.
+        :param pool: Engines.DriverPool (None for engines without browsers)
+        :param interval: time in seconds between samples (float)
+        """
+        self.pool = pool
+        self.interval = interval
+        self.peak_rss = 0
+        self.running = False
+        self.thread = threading.Thread(target=self.sample_loop, daemon=True)
+
+    def sample_loop(self):
+
+        while self.running:
+            for pid in self.pool.browser_pids():
+                try:
+                    process = psutil.Process(pid)
+                    rss = sum(child.memory_info().rss for child in process.children(recursive=True))
+                    self.peak_rss = max(self.peak_rss, rss + process.memory_info().rss)
+                except psutil.Error:
+                    continue
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if psutil and self.pool:
+            self.running = True
+            self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+
+    @property
+    def peak_rss_mb(self):
+        """
+        :return: str
+        """
+        return '{:.0f}'.format(self.peak_rss / 1024 ** 2) if psutil and self.peak_rss else 'n/a'
+
+
+def run_worker_jobs(engine, jobs, concurrency, max_results):
+    """
+    Run the fixture request as many jobs through an engine, concurrently.
+    :return: jobs per second (float), job latencies in seconds (list of float), number of failed jobs (int)
+    """
+    desired_months, desks, window = ReplayServer.fixture_request()
+    latencies = []
+    failures = []
+
+    def job():
+        started = time.perf_counter()
+        try:
+            engine.check_available_dates(desired_months=desired_months, desks=desks, window=window,
+                                         max_results=max_results)
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            failures.append(e)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(jobs):
+            executor.submit(job)
+    return jobs / (time.perf_counter() - started), latencies, len(failures)
+
+
+def benchmark_worker(args):
+    """
+    Benchmark a Worker engine against the replay server, for every combination of pool size and concurrency.
+    """
+    with ReplayServer.ReplayServer(latency=args.latency) as replay_server:
+        pool_sizes = [int(size) for size in args.pool_sizes.split(',')] if args.engine == 'selenium' else [0]
+        for pool_size in pool_sizes:
+            for concurrency in [int(concurrency) for concurrency in args.concurrency.split(',')]:
+                if args.engine == 'selenium':
+                    engine = Engines.SeleniumEngine(url=replay_server.url, step_delay=args.step_delay,
+                                                    pool_size=pool_size or None)
+                else:
+                    engine = Engines.HttpEngine(base_url=replay_server.base_url)
+                engine.step_listener = StepRecorder()
+                with RssSampler(pool=getattr(engine, 'pool', None)) as rss_sampler:
+                    jobs_per_second, latencies, failures = run_worker_jobs(
+                        engine=engine, jobs=args.jobs, concurrency=concurrency, max_results=args.max_results or None)
+                if args.engine == 'selenium':
+                    engine.pool.close()
+                print("engine={} pool={} concurrency={} jobs={} failed={} jobs/s={:.2f} peak_rss/browser_mb={}".format(
+                    args.engine, pool_size or '-', concurrency, args.jobs, failures, jobs_per_second,
+                    rss_sampler.peak_rss_mb))
+                print("    {:<14} p50/p95/p99 ms {}".format('job', format_latencies(latencies)))
+                for step, timings in sorted(engine.step_listener.steps.items()):
+                    print("    {:<14} p50/p95/p99 ms {}".format(step, format_latencies(timings)))
+
+
+def timed(function, repeat=1):
+    """
+    :return: time in seconds a call of function took, the best of repeat calls (float)
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def benchmark_controller(args):
+    """
+    Benchmark the memory of a controller's worker and job records and the time its sweeps over them take, with
+    storage in SQLite in memory. Half of the workers are registered to the controller and run the jobs, the other half
+    are registered to another controller and synced.
+    """
+    import tracemalloc
+    os.environ.setdefault('STORAGE_BACKEND', 'sqlite')
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Controller'))
+    import Controller
+    import Storage
+    Controller.logger.setLevel(logging.WARNING)
+    Controller.storage = Storage.SQLiteStorage(path=':memory:')
+    own_workers = args.workers // 2
+    jobs_per_worker = max(1, args.jobs // max(1, own_workers))
+    controller = Controller.Controller(max_number_of_jobs=jobs_per_worker + 1, start_loops=False)
+    Controller.controller = controller
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    workers = []
+    for _ in range(own_workers):
+        worker = Controller.RegisteredWorker(new_worker=True, worker_id=str(uuid.uuid4()), remote_addr='127.0.0.1:9')
+        controller.register_worker(worker_obj=worker)
+        workers.append(worker)
+    for worker in workers:
+        controller.call(worker.track_jobs, [Controller.RegisteredJob(job_id=str(uuid.uuid4()), job_type='run-once',
+                                                                     args='{}', assigned_worker=worker)
+                                            for _ in range(jobs_per_worker)])
+    register_seconds = time.perf_counter() - started
+    records_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    jobs = own_workers * jobs_per_worker
+    print("controller workers={} own={} jobs={} register+start_s={:.2f}".format(args.workers, own_workers, jobs,
+                                                                              register_seconds))
+    print("    records_mb={:.1f} bytes/worker+jobs={:.0f} bytes/job={:.0f}".format(
+        records_bytes / 1024 ** 2, records_bytes / max(1, own_workers), records_bytes / max(1, jobs)))
+
+    heartbeat = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+    for _ in range(args.workers - own_workers):
+        Controller.storage.create_worker(worker_id=str(uuid.uuid4()), properties={
+            'remote_addr': '127.0.0.1:9', 'last_heartbeat': heartbeat})
+    print("    {:<28} {:.3f}s".format('sync workers (new)', timed(controller.sync_workers)))
+    print("    {:<28} {:.3f}s".format('sync workers (unchanged)', timed(controller.sync_workers, repeat=args.repeat)))
+    sweeps = [('available worker', lambda: controller._available_worker),
+              ('worker counts', Controller.worker_counts),
+              ('job counts', Controller.job_counts),
+              ('look up every worker by id', lambda: [controller.registered_worker(worker.worker_id)
+                                                      for worker in workers])]
+    for name, function in sweeps:
+        print("    {:<28} {:.3f}s".format(name, timed(function, repeat=args.repeat)))
+
+
+def start_service(service_dir, script, port, server, environment):
+    """
+    Start a service in a subprocess, as its container would, and wait until it answers /healthz.
+    :param service_dir: directory of the service (str)
+    :param script: file name of the service (str)
+    :param port: port the service listens on, see Serving.run (int)
+    :param server: dev or gunicorn (str)
+    :param environment: additional environment variables (dict)
+    :return: subprocess.Popen
+    """
+    import subprocess
+    import requests
+    root_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, WEB_SERVER=server, **environment)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root_dir, env.get('PYTHONPATH')]))
+    process = subprocess.Popen([sys.executable, os.path.join(root_dir, service_dir, script)], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(300):
+        try:
+            if requests.get('http://127.0.0.1:{}/healthz'.format(port), timeout=1).ok:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("{} did not start with the {} server".format(script, server))
+
+
+def load_endpoint(send, clients, duration):
+    """
+    Call an endpoint from clients threads in a closed loop, each over its own keep-alive session.
+    :param send: function(session) returning a requests.Response
+    :param clients: int
+    :param duration: time in seconds (float)
+    :return: latencies of successful calls in seconds and the number of failed calls (tuple of list and int)
+    """
+    import requests
+    latencies, errors, lock = [], [0], threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                ok = send(session).ok
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors[0] += 1
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        for _ in range(clients):
+            executor.submit(client)
+    return latencies, errors[0]
+
+
+def benchmark_serving(args):
+    """
+    Compare the Werkzeug development server to gunicorn on the API server's /get_result and /run_once and the
+    worker's /heartbeat, with storage in a SQLite file shared by the API server's processes. The worker cannot reach a
+    controller, which does not matter for its heartbeats.
+    """
+    import tempfile
+    import json
+    servers = ['dev'] + (['gunicorn'] if Serving.gunicorn else [])
+    if not Serving.gunicorn:
+        print("gunicorn is not installed, only the development server is measured")
+    parameters = json.dumps({'start_date': datetime.date.today().strftime('%d/%m/%Y'), 'desks': ['AM'],
+                             'end_date': (datetime.date.today() + datetime.timedelta(days=30)).strftime('%d/%m/%Y')})
+    endpoints = [('/get_result', lambda session: session.get('http://127.0.0.1:5001/get_result?run_id={}'.format(
+                     uuid.uuid4()))),
+                 ('/run_once', lambda session: session.post('http://127.0.0.1:5001/run_once', json=parameters)),
+                 ('/heartbeat', lambda session: session.get('http://127.0.0.1:5003/heartbeat'))]
+    environment = {'STORAGE_BACKEND': 'sqlite', 'WEB_PROCESSES': str(args.processes), 'WEB_THREADS': str(args.threads)}
+    for server in servers:
+        with tempfile.TemporaryDirectory() as directory:
+            environment['STORAGE_PATH'] = os.path.join(directory, 'storage.db')
+            processes = [start_service('APIServer', 'APIServer.py', 5001, server, environment),
+                         start_service('Worker', 'Worker.py', 5003, server, environment)]
+            try:
+                print("{} clients={}".format('dev (a thread per request)' if server == 'dev' else
+                                             'gunicorn processes={} threads={}'.format(args.processes, args.threads),
+                                             args.clients))
+                for endpoint, send in endpoints:
+                    latencies, errors = load_endpoint(send=send, clients=args.clients, duration=args.duration)
+                    print("    {:<12} req/s {:>7.1f} errors {:>4} p50/p95/p99 ms {}".format(
+                        endpoint, len(latencies) / args.duration, errors, format_latencies(latencies)))
+            finally:
+                for process in processes:
+                    process.kill()
+                    process.wait()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmarks against local stand-ins of the IND site")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help="Worker engine throughput, step latency and browser memory")
+    worker_parser.add_argument('--engine', choices=['selenium', 'http'], default='selenium')
+    worker_parser.add_argument('--pool-sizes', default='0,1,2,4', help="comma separated, 0 for a browser per job")
+    worker_parser.add_argument('--concurrency', default='1,2,4', help="comma separated number of parallel jobs")
+    worker_parser.add_argument('--jobs', type=int, default=20, help="jobs per combination")
+    worker_parser.add_argument('--latency', type=float, default=0.05, help="seconds of delay per replayed response")
+    worker_parser.add_argument('--step-delay', type=float, default=0.2, help="seconds to let the page settle")
+    worker_parser.add_argument('--max-results', type=int, default=1, help="earliest days per desk, 0 for all")
+    worker_parser.set_defaults(benchmark=benchmark_worker)
+    controller_parser = subparsers.add_parser('controller', help="Controller memory and sweep times at many workers "
+                                                                 "and jobs")
+    controller_parser.add_argument('--workers', type=int, default=10000, help="workers of all controllers")
+    controller_parser.add_argument('--jobs', type=int, default=100000,
+                                   help="jobs running on this controller's workers")
+    controller_parser.add_argument('--repeat', type=int, default=3, help="runs per sweep, the best is reported")
+    controller_parser.set_defaults(benchmark=benchmark_controller)
+    serving_parser = subparsers.add_parser('serving', help="Requests/sec and latency of the development server and "
+                                                           "gunicorn on the API server and worker")
+    serving_parser.add_argument('--clients', type=int, default=16, help="parallel keep-alive connections")
+    serving_parser.add_argument('--duration', type=float, default=10, help="seconds per endpoint")
+    serving_parser.add_argument('--processes', type=int, default=1,
+                                help="gunicorn processes of the API server (1 as deployed, see Serving.settings)")
+    serving_parser.add_argument('--threads', type=int, default=8, help="gunicorn threads per process")
+    serving_parser.set_defaults(benchmark=benchmark_serving)
+    args = parser.parse_args()
+    args.benchmark(args)
@@ -0,0 +1,231 @@
+import collections
+import threading
+import logging
+import time
+import Storage
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, storage, name='ind', window=20, min_calls=5, failure_ratio=0.5, slow_seconds=30,
+                 open_seconds=60, max_open_seconds=600, probes=1, sync_interval=5, logger=None):
+        """
+        Circuit breaker around the upstream site, shared by all controllers through storage. Outcomes of jobs are kept
+        in a window, the breaker opens when too many of them failed or loaded the page too slowly. While open no jobs
+        should be dispatched, once open_seconds have passed a limited number of probe jobs is allowed (half open). The
+        breaker closes when the probes succeed, and opens again for twice as long when one of them fails.
+        Every state change is stored, and every breaker adopts changes stored by others, so all controllers (and the
+        API server) act on the same state.
+        :param storage: Storage
+        :param name: name of the upstream site, breakers with the same name share their state (str)
+        :param window: number of recent job outcomes to judge the site by (int)
+        :param min_calls: number of outcomes needed before the breaker can open (int)
+        :param failure_ratio: share of failed or slow outcomes in the window that opens the breaker (float)
+        :param slow_seconds: page load time in seconds above which a successful job counts as failed (float)
+        :param open_seconds: time in seconds the breaker stays open before probing (float)
+        :param max_open_seconds: highest time in seconds the breaker stays open after failed probes (float)
+        :param probes: number of probe jobs allowed at once while half open, and needed to close (int)
+        :param sync_interval: time in seconds between reading the shared state from storage (float)
+        :param logger: logger to report state changes to (logging.Logger, optional)
+        """
+        self.storage = storage
+        self.name = name
+        self.outcomes = collections.deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_seconds = slow_seconds
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probes = probes
+        self.sync_interval = sync_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.reason = ''
+        self.open_seconds = open_seconds
+        self.open_until = 0.0
+        self.changed_at = 0.0
+        self.synced_at = 0.0
+        self.probes_in_flight = 0
+        self.probes_succeeded = 0
+        self.half_open_at = 0.0
+
+    def allow(self):
+        """
+        Whether a job may be dispatched to the upstream site now. While half open this reserves one of the probes,
+        call release if no job was dispatched after all.
+        :return: Bool
+        """
+        self.sync()
+        with self.lock:
+            self._half_open_when_due()
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self.probes_in_flight < self.probes:
+                self.probes_in_flight += 1
+                return True
+            return False
+
+    def release(self):
+        """
+        Give back a probe reserved by allow, for a job that was not dispatched or did not tell anything about the site.
+        """
+        with self.lock:
+            self.probes_in_flight = max(0, self.probes_in_flight - 1)
+
+    def record(self, succeeded, page_load_seconds=None, started_at=None):
+        """
+        Record the outcome of a job.
+        :param succeeded: whether the job could read the site (Bool)
+        :param page_load_seconds: slowest page load of the job in seconds (float, optional)
+        :param started_at: time.monotonic() when the job was started, outcomes of jobs started before probing are no
+                           probe outcomes (float, optional)
+        """
+        failed = not succeeded or (page_load_seconds is not None and page_load_seconds > self.slow_seconds)
+        reason = 'job failed' if not succeeded else 'page load took {:.1f}s'.format(page_load_seconds or 0)
+        with self.lock:
+            change = self._record(failed=failed, reason=reason, started_at=started_at)
+        if change:
+            self._store(change=change)
+
+    def _record(self, failed, reason, started_at=None):
+        """
+        Record the outcome of a job in memory. Called with the lock held.
+        :param failed: whether the job failed or was slow (Bool)
+        :param reason: what the outcome was (str)
+        :param started_at: time.monotonic() when the job was started (float, optional)
+        :return: state change to store (dict, None if the state did not change)
+        """
+        if self.state == HALF_OPEN and started_at is not None and started_at < self.half_open_at:
+            return None
+        if self.state == HALF_OPEN:
+            self.probes_in_flight = max(0, self.probes_in_flight - 1)
+            if failed:
+                return self._open(reason='probe failed: {}'.format(reason),
+                                  open_seconds=min(self.open_seconds * 2, self.max_open_seconds))
+            self.probes_succeeded += 1
+            return self._close() if self.probes_succeeded >= self.probes else None
+        if self.state == OPEN:
+            return None
+        self.outcomes.append(failed)
+        failures = sum(self.outcomes)
+        if failed and len(self.outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self.outcomes):
+            return self._open(reason='{} of the last {} jobs failed or were slow, last: {}'.format(
+                failures, len(self.outcomes), reason), open_seconds=self.base_open_seconds)
+        return None
+
+    def is_open(self):
+        """
+        Whether requests to the upstream site should fail fast, without reserving a probe.
+        :return: Bool
+        """
+        self.sync()
+        with self.lock:
+            self._half_open_when_due()
+            return self.state == OPEN
+
+    def is_half_open(self):
+        """
+        Whether only probe jobs may be dispatched, one per probe reserved by allow.
+        :return: Bool
+        """
+        with self.lock:
+            self._half_open_when_due()
+            return self.state == HALF_OPEN
+
+    def retry_after(self):
+        """
+        :return: time in seconds until the breaker probes the site again (int, 0 if it is not open)
+        """
+        with self.lock:
+            return max(0, int(self.open_until - time.time()) + 1) if self.state == OPEN else 0
+
+    def status(self):
+        """
+        :return: state, reason and time until probing (dict)
+        """
+        with self.lock:
+            status = {'state': self.state, 'reason': self.reason, 'probes_in_flight': self.probes_in_flight}
+        status['retry_after'] = self.retry_after()
+        return status
+
+    def sync(self, force=False):
+        """
+        Adopt a state change stored by another breaker since the last change of this one.
+        :param force: read the shared state even if it was read less than sync_interval ago (Bool)
+        """
+        now = time.time()
+        if not force and now - self.synced_at < self.sync_interval:
+            return
+        self.synced_at = now
+        try:
+            entity = self.storage.get_circuit(name=self.name)
+        except Storage.NotFoundError:
+            return
+        except Exception as e:
+            self.logger.error("Could not read circuit breaker state: {}".format(e))
+            return
+        with self.lock:
+            if float(entity.get('ChangedAt', 0)) <= self.changed_at:
+                return
+            self.state = entity['State']
+            self.reason = entity.get('Reason', '')
+            self.open_seconds = float(entity.get('OpenSeconds', self.base_open_seconds))
+            self.open_until = float(entity.get('OpenUntil', 0))
+            self.changed_at = float(entity['ChangedAt'])
+            self.outcomes.clear()
+            self.probes_in_flight = self.probes_succeeded = 0
+
+    def _half_open_when_due(self):
+        """
+        Start probing once the open time has passed. Not stored: every breaker moves to half open by itself.
+        """
+        if self.state == OPEN and time.time() >= self.open_until:
+            self.state = HALF_OPEN
+            self.half_open_at = time.monotonic()
+            self.probes_in_flight = self.probes_succeeded = 0
+            self.logger.info("Circuit breaker '{}' half open, probing the site".format(self.name))
+
+    def _open(self, reason, open_seconds):
+
+        self.open_seconds = open_seconds
+        self.open_until = time.time() + open_seconds
+        return self._change(state=OPEN, reason=reason)
+
+    def _close(self):
+
+        self.open_seconds = self.base_open_seconds
+        return self._change(state=CLOSED, reason='')
+
+    def _change(self, state, reason):
+        """
+        Change state in memory. Called with the lock held, the change is stored by _store once it is released.
+        :return: state change to store (dict)
+        """
+        self.state = state
+        self.reason = reason
+        self.changed_at = time.time()
+        self.outcomes.clear()
+        self.probes_in_flight = self.probes_succeeded = 0
+        return {'State': state, 'Reason': reason, 'OpenSeconds': self.open_seconds, 'OpenUntil': self.open_until,
+                'ChangedAt': self.changed_at}
+
+    def _store(self, change):
+        """
+        Log a state change and store it for the other breakers, without holding the lock so callers of allow and
+        record do not wait for storage.
+        :param change: state change made by _change (dict)
+        """
+        if change['State'] == OPEN:
+            self.logger.warning("Circuit breaker '{}' opened for {:.0f}s: {}".format(
+                self.name, change['OpenSeconds'], change['Reason']))
+        else:
+            self.logger.info("Circuit breaker '{}' closed, the site recovered".format(self.name))
+        try:
+            self.storage.store_circuit(name=self.name, properties=change)
+        except Exception as e:
+            self.logger.error("Could not store circuit breaker state: {}".format(e))
@@ -1,14 +1,26 @@
-import azure.core.exceptions
 from flask import Flask, request
-from azure.storage.queue import QueueClient
-from azure.data.tables import TableServiceClient
 from Common import instrumentation_key, connect_str, table_name, queue_name, sender_address, sender_pass
+import Admission
+import Availability
+import CircuitBreaker
+import Mailer
+import Planning
+import Startup
+import Serving
+import Telemetry
+import Storage
+import Metrics
+import Watchers
+import concurrent.futures
 import collections
+import functools
 import threading
 import datetime
 import requests
 import uuid
 import logging
+import queue
+import os
 from opencensus.trace import config_integration
 from opencensus.ext.flask.flask_middleware import FlaskMiddleware
 from opencensus.trace.samplers import ProbabilitySampler
@@ -21,21 +33,23 @@ from opencensus.stats import stats as stats_module
 from opencensus.stats import view as view_module
 from opencensus.tags import tag_map as tag_map_module
 from opencensus.ext.azure.log_exporter import AzureLogHandler
-import smtplib
 import json
+import math
+import random
 import time
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 
 az_logger = logging.getLogger("azure.core.pipeline.policies.http_logging_policy")
 az_logger.setLevel(logging.WARNING)
 config_integration.trace_integrations(['logging', 'requests'])
-tracer = Tracer(exporter=AzureExporter(connection_string=instrumentation_key), sampler=ProbabilitySampler(1.0))
 FORMAT = '[%(asctime)s] [CONTROLLER] [traceId=%(traceId)s spanId=%(spanId)s] %(message)s'
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-logger.addHandler(AzureLogHandler(connection_string=instrumentation_key))
+startup = Startup.Startup(service='controller', logger=logger)
+sampling_rules = Telemetry.SamplingRules.from_environment()
+trace_exporter = Telemetry.TraceExporter(
+    target=Startup.Lazy(factory=lambda: AzureExporter(connection_string=instrumentation_key)), rules=sampling_rules)
+tracer = Tracer(exporter=trace_exporter, sampler=ProbabilitySampler(1.0))
 
 stats = stats_module.stats
 view_manager = stats.view_manager
@@ -44,43 +58,304 @@ workers_measure = measure_module.MeasureInt("workers", "number of workers", "wor
 workers_view = view_module.View("workers view", "number of workers", [], workers_measure,
                                 aggregation_module.LastValueAggregation())
 view_manager.register_view(workers_view)
+desired_workers_measure = measure_module.MeasureInt("desired_workers",
+                                                    "number of workers needed for the current demand", "workers")
+desired_workers_view = view_module.View("desired workers view", "number of workers needed for the current demand", [],
+                                        desired_workers_measure, aggregation_module.LastValueAggregation())
+view_manager.register_view(desired_workers_view)
 mmap = stats_recorder.new_measurement_map()
 tmap = tag_map_module.TagMap()
-exporter = metrics_exporter.new_metrics_exporter(connection_string=instrumentation_key)
-view_manager.register_exporter(exporter)
 
 app = Flask(__name__)
-middleware = FlaskMiddleware(app, exporter=AzureExporter(connection_string=instrumentation_key),
-                             sampler=ProbabilitySampler(rate=1.0),)
+middleware = FlaskMiddleware(app, exporter=trace_exporter, sampler=ProbabilitySampler(rate=1.0),
+                             excludelist_paths=Telemetry.UNTRACED_PATHS)
+Startup.add_probes(app=app, startup=startup)
+
+metrics = Metrics.Registry()
+dispatch_seconds = metrics.histogram('controller_dispatch_seconds', "Time taken to start a job on a worker",
+                                     labels=('job_type',))
+heartbeat_sweep_seconds = metrics.histogram('controller_heartbeat_sweep_seconds',
+                                            "Time taken to check the heartbeats of all workers")
+job_retries = metrics.counter('controller_job_retries',
+                              "Failed jobs by type and whether they were retried or moved to the dead letters",
+                              labels=('job_type', 'outcome'))
+upstream_token_delay = metrics.histogram('controller_upstream_token_delay_seconds',
+                                         "Time workers are told to wait for a token to make a request to the IND site")
+result_seconds = metrics.histogram('controller_result_seconds', "Time taken to handle results returned by a worker")
+storage_seconds = metrics.histogram('storage_call_seconds', "Time taken by calls to table and queue storage",
+                                    labels=('operation',))
+telemetry = {'traces': trace_exporter}
+
+
+def create_storage():
+
+    created = Storage.create_storage(
+        name=os.environ.get('STORAGE_BACKEND', 'azure'), path=os.environ.get('STORAGE_PATH'), connect_str=connect_str,
+        table_name=table_name, queue_name=queue_name)
+    created.call_listener = lambda operation, seconds: storage_seconds.observe(seconds, operation=operation)
+    return created
+
+
+storage = Startup.Lazy(factory=create_storage)
+controller = None
+
+
+def create_mailer():
+    """
+    SMTP_HOST and SMTP_PORT point the mailer at another server than Gmail, SMTP_TLS=0 sends without TLS and login,
+    e.g. to a local SMTP sink.
+    """
+    tls = os.environ.get('SMTP_TLS', '1') == '1'
+    return Mailer.Mailer(host=os.environ.get('SMTP_HOST', 'smtp.gmail.com'),
+                         port=int(os.environ.get('SMTP_PORT', 587)), sender=sender_address,
+                         password=sender_pass if tls else None, starttls=tls, logger=logger)
+
+
+mailer = Startup.Lazy(factory=create_mailer)
+
+# Outcomes of jobs reported by workers
+JOB_SUCCEEDED = 'ok'
+JOB_RETRIABLE = 'retry'
+JOB_FAILED = 'failed'
+
+
+def worker_counts():
+    """
+    :return: number of workers registered to this controller, and how many of them are ready for a job (dict)
+    """
+    if controller is None:
+        return {}
+    workers = list(controller.registered_workers)
+    lowest_amount_of_jobs = controller.lowest_amount_of_jobs if workers else 0
+    return {('registered',): len(workers),
+            ('ready',): sum(1 for worker in workers if worker.is_ready(lowest_amount_of_jobs=lowest_amount_of_jobs))}
+
+
+def job_counts():
+    """
+    :return: number of jobs running on workers of this controller, waiting to be restarted, and desks watched by
+             continuous runs that are due to be scanned (dict)
+    """
+    if controller is None:
+        return {}
+    return {('in_flight',): sum(len(worker.job_ids) for worker in controller.registered_workers),
+            ('to_restart',): len(controller.jobs_to_restart),
+            ('continuous_due',): controller.scaling.get('due_continuous_jobs', 0)}
+
+
+class RetryPolicy(object):
+
+    def __init__(self, max_attempts=3, base_delay=5, max_delay=300):
+        """
+        Exponential backoff with jitter for failed jobs. The delay doubles with every failed attempt, and a random part
+        of it spreads retries of jobs that failed at the same time (e.g. during an outage of the site) over time.
+        :param max_attempts: number of attempts after which a job is moved to the dead letters (int)
+        :param base_delay: maximum delay in seconds after the first failed attempt (float)
+        :param max_delay: maximum delay in seconds (float)
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def exhausted(self, attempts):
+        """
+        :param attempts: number of failed attempts (int)
+        :return: Bool
+        """
+        return attempts >= self.max_attempts
+
+    def delay(self, attempts):
+        """
+        :param attempts: number of failed attempts (int)
+        :return: time in seconds to wait before the next attempt, between half and all of the backoff (float)
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        """
+        Token bucket limiting requests to the IND site. Tokens are reserved instead of polled for: a reservation is
+        granted right away, with the time to wait until its token is there, so a worker asks once and the waits of all
+        workers are spread at the rate.
+        :param rate: tokens added per second (float)
+        :param burst: maximum number of tokens in the bucket (float)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        :return: time in seconds to wait before using the reserved token (float)
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            return max(0.0, -self.tokens / self.rate)
+
+    def set_rate(self, rate, burst):
+        """
+        :param rate: tokens added per second (float)
+        :param burst: maximum number of tokens in the bucket (float)
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+            self.burst = burst
+
+
+def desired_workers(backlog, in_flight, average_job_seconds, jobs_per_worker, target_seconds, min_workers,
+                    max_workers):
+    """
+    Number of workers needed to finish the jobs waiting and running now within the target time. A worker runs
+    jobs_per_worker jobs at once, so within the target time it finishes that many jobs for every average job duration
+    that fits in it.
+    :param backlog: jobs waiting to be started (int)
+    :param in_flight: jobs running on workers (int)
+    :param average_job_seconds: average time in seconds from starting a job to its results (float)
+    :param jobs_per_worker: maximum number of jobs run by a worker at once (int)
+    :param target_seconds: time in seconds in which the jobs should be done (float)
+    :param min_workers: int
+    :param max_workers: int
+    :return: int
+    """
+    jobs_per_worker_in_target = jobs_per_worker * max(1.0, target_seconds / max(average_job_seconds, 0.001))
+    needed = math.ceil((backlog + in_flight) / jobs_per_worker_in_target)
+    return min(max_workers, max(min_workers, needed))
+
+
+metrics.gauge('storage_queue_depth', "Run once requests waiting in the queue",
+              function=lambda: storage.queue_depth() if storage.loaded else 0)
+metrics.gauge('controller_workers', "Workers by state", labels=('state',), function=worker_counts)
+metrics.gauge('controller_jobs', "Jobs by state", labels=('state',), function=job_counts)
+metrics.gauge('controller_desired_workers', "Workers needed for the current demand, for an external autoscaler",
+              function=lambda: controller.scaling.get('desired_workers', 0) if controller else 0)
+metrics.gauge('controller_circuit_state', "State of the circuit breaker around the IND site (1 for the current state)",
+              labels=('state',), function=lambda: {
+                  (state,): int(controller.breaker.state == state) for state in (
+                      CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)} if controller else {})
+metrics.gauge('controller_mails', "Result mails by state (queued, sent, failed, dropped)", labels=('state',),
+              function=lambda: {(state,): count for state, count in mailer.stats().items()} if mailer.loaded else {})
+metrics.gauge('controller_watchers', "Continuous runs in the watcher index, and the desks they watch",
+              labels=('kind',), function=lambda: {('runs',): len(controller.watchers),
+                                                  ('desks',): len(controller.watchers.desks())} if controller else {})
+metrics.gauge('controller_upstream_rate', "Requests per second to the IND site this controller grants tokens for",
+              function=lambda: controller.upstream_tokens.rate if controller else 0)
+Metrics.add_endpoint(app=app, registry=metrics, telemetry=telemetry)
+
+
+def start_telemetry():
+    """
+    Create the trace exporter and start exporting sampled logs and metrics to Application Insights. Runs in the
+    background so exporters do not delay readiness, logs from before are only written to the console.
+    """
+    trace_exporter.target.load()
+    telemetry['logs'] = Telemetry.LogHandler(target=AzureLogHandler(connection_string=instrumentation_key),
+                                             rules=sampling_rules)
+    logger.addHandler(telemetry['logs'])
+    view_manager.register_exporter(metrics_exporter.new_metrics_exporter(connection_string=instrumentation_key))
+
+
+def start_controller():
+    """
+    Connect to storage and start the controller loops. Workers cannot register until this has finished.
+    """
+    global controller
+    storage.load()
+    controller = Controller(min_workers=int(os.environ.get('MIN_WORKERS', 2)),
+                            max_workers=int(os.environ.get('MAX_WORKERS', 10)),
+                            scaling_target_time=float(os.environ.get('SCALING_TARGET_TIME', 120)),
+                            upstream_rate=float(os.environ.get('UPSTREAM_RATE', 2)),
+                            upstream_burst=float(os.environ.get('UPSTREAM_BURST', 5)),
+                            max_batch_size=int(os.environ.get('MAX_BATCH_SIZE', 10)))
+
+
+class WorkerRegistry(object):
+
+    __slots__ = ('workers', 'snapshot')
+
+    def __init__(self):
+        """
+        Workers by id, so looking a worker up, checking membership and removing it take O(1). Only the controller's
+        state loop adds and removes workers, every change publishes a new immutable snapshot that other threads iterate
+        without locking.
+        """
+        self.workers = {}
+        self.snapshot = ()
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def __iter__(self):
+        return iter(self.snapshot)
+
+    def __contains__(self, worker_id):
+        return worker_id in self.workers
+
+    def add(self, worker):
+        """
+        :param worker: RegisteredWorker object
+        """
+        self.workers[worker.worker_id] = worker
+        self.snapshot = tuple(self.workers.values())
 
-queue_run_once_client = QueueClient.from_connection_string(connect_str, queue_name)
-table_service = TableServiceClient.from_connection_string(conn_str=connect_str)
-table_client = table_service.get_table_client(table_name=table_name)
+    def discard(self, worker):
+        """
+        :param worker: RegisteredWorker object
+        """
+        if self.workers.get(worker.worker_id) is worker:
+            del self.workers[worker.worker_id]
+            self.snapshot = tuple(self.workers.values())
+
+    def get(self, worker_id):
+        """
+        :param worker_id: uuid4 (str)
+        :return: RegisteredWorker object (None if unknown)
+        """
+        return self.workers.get(worker_id)
 
 
 class RegisteredWorker(object):
 
+    __slots__ = ('worker_id', 'jobs', 'job_ids', 'last_job_started_at', 'draining', 'errors', '_remote_addr',
+                 '_entity')
+
     def __init__(self, worker_id=None, remote_addr=None, new_worker=False, sync_from=None):
         """
         Object representing a worker that retrieves available dates. Workers registered to a controller are
         assigned jobs by it. Controllers also create RegisteredWorker objects to represent workers registered to
         different controllers. These are used to check job across workers of all controllers, to ensure an even
         distribution. Use new_worker=True when a new worker registers to a controller, and new_worker=False with
-        a Table entity in sync_from representing the worker to represent workers of different controllers.
+        a storage entity in sync_from representing the worker to represent workers of different controllers.
         Workers contain a list of active jobs, so the controller can check if they return in a timely manner, and
-        restart them if not.
+        restart them if not. Only the controller's state loop changes the jobs, other threads read the immutable
+        snapshot of their ids in job_ids.
         :param worker_id: uuid4 (str)
         :param remote_addr: ip_addr:port (str)
         :param new_worker: True if adding a new active worker to pool, False if just syncing (Bool)
-        :param sync_from: Sync a worker from a database entity (TableClient.entity)
+        :param sync_from: Sync a worker from a storage entity (dict)
         """
-        self.jobs = collections.OrderedDict()
+        self.jobs = {}
+        self.job_ids = frozenset()
         self.last_job_started_at = None
+        self.draining = False
+        self.errors = 0
         if new_worker:
             self.worker_id = worker_id
+            self._remote_addr = remote_addr
+            self._entity = None
             self.register_in_database(worker_id=worker_id, remote_addr=remote_addr)
         else:
             self.worker_id = sync_from['RowKey']
+            self._remote_addr = None
             self._entity = sync_from
 
     @property
@@ -90,9 +365,19 @@ class RegisteredWorker(object):
         all workers, job assignment cool down and max number of jobs.
         :return: Bool
         """
-        if len(self.jobs) != controller.lowest_amount_of_jobs:
+        return self.is_ready(lowest_amount_of_jobs=controller.lowest_amount_of_jobs)
+
+    def is_ready(self, lowest_amount_of_jobs):
+        """
+        Same as ready, for callers checking many workers against the same lowest amount of jobs.
+        :param lowest_amount_of_jobs: int
+        :return: Bool
+        """
+        if self.draining:
             return False
-        elif len(self.jobs) > controller.max_number_of_jobs:
+        elif len(self.job_ids) != lowest_amount_of_jobs:
+            return False
+        elif len(self.job_ids) > controller.max_number_of_jobs:
             return False
         elif not self.last_job_started_at:
             return True
@@ -102,17 +387,19 @@ class RegisteredWorker(object):
     @property
     def entity(self):
         """
-        Return table entity associated with this worker.
-        :return: Azure.Data.Table.entity
+        Return storage entity associated with this worker.
+        :return: dict
         """
-        return table_client.get_entity(partition_key='RegisteredWorkers', row_key=self.worker_id)
+        return storage.get_worker(worker_id=self.worker_id)
 
     @property
     def remote_addr(self):
         """
         :return: ip_addr:port (str)
         """
-        return self.entity['remote_addr']
+        remote_addr = self._remote_addr or self.entity['remote_addr']
+        # Workers registered before they reported their port listen on the default port
+        return remote_addr if ':' in remote_addr else '{}:5003'.format(remote_addr)
 
     @property
     def last_heartbeat(self):
@@ -121,44 +408,108 @@ class RegisteredWorker(object):
 
     def register_in_database(self, worker_id, remote_addr):
         """
-        Create a table entity representing this worker.
+        Create a storage entity representing this worker.
         :param worker_id: uuid4 (str)
         :param remote_addr: ip_addr:port (str)
         """
-        entity = {
-            'PartitionKey': 'RegisteredWorkers',
-            'RowKey': worker_id,
+        storage.create_worker(worker_id=worker_id, properties={
             'remote_addr': remote_addr,
             'last_heartbeat': datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-        }
-        table_client.create_entity(entity)
+        })
 
     def unregister_from_database(self):
         """
-        Delete the table entity representing this worker.
+        Delete the storage entity representing this worker.
         """
-        try:
-            table_client.delete_entity(partition_key='RegisteredWorkers', row_key=self.worker_id)
-        except azure.core.exceptions.ResourceNotFoundError:
-            pass
+        storage.delete_worker(worker_id=self.worker_id)
 
-    def start_job(self, job_type, email=None, **kwargs):
+    def start_job(self, job_type, email=None, attempt=0, dequeued_at=None, **kwargs):
         """
         Start a job on this worker and create a RegisteredJob object to allow the controller to keep track of it.
         :param job_type: run-once / continuous / get-desks (str)
         :param email: email address to mail results to if any (str)
+        :param attempt: number of earlier attempts of the job that failed (int)
+        :param dequeued_at: time since the epoch the job was taken from the queue (float, optional)
         :param kwargs: parameters to send to worker for the job (dict)
         """
+        started = time.time()
         post_json = json.dumps(kwargs)
-        self.last_job_started_at = datetime.datetime.now()
         with tracer.span(name=kwargs['job_id']):
             logger.info("Starting job of type {} on worker {}: {}".format(job_type, self.worker_id, kwargs))
+        job = RegisteredJob(job_id=kwargs['job_id'], job_type=job_type, assigned_worker=self, email=email,
+                            args=post_json, attempt=attempt, trace=kwargs.get('trace'))
+        with dispatch_seconds.time(job_type=job_type):
+            self._post_jobs(post_json=post_json, jobs=[job])
+        controller.trace_dispatch(worker_id=self.worker_id, job=job, started=started, dequeued_at=dequeued_at)
+
+    def start_batch(self, jobs):
+        """
+        Start a batch of date check jobs on this worker, which checks them in one session, and create a RegisteredJob
+        object for each of them: the jobs of a batch complete, time out and are retried on their own.
+        :param jobs: jobs with 'job_type', 'email', 'attempt', 'kwargs' to send to the worker and optionally
+                     'dequeued_at' (list of dict)
+        """
+        started = time.time()
+        batch_id = str(uuid.uuid4())
+        post_json = json.dumps({'job_id': batch_id, 'batch': [job['kwargs'] for job in jobs]})
+        with tracer.span(name=batch_id):
+            logger.info("Starting batch {} on worker {}: {}".format(batch_id, self.worker_id,
+                                                                   [job['kwargs']['job_id'] for job in jobs]))
+        registered_jobs = [RegisteredJob(job_id=job['kwargs']['job_id'], job_type=job['job_type'],
+                                         assigned_worker=self, email=job['email'], args=json.dumps(job['kwargs']),
+                                         attempt=job['attempt'], trace=job['kwargs'].get('trace'),
+                                         batch_id=batch_id)
+                           for job in jobs]
+        with dispatch_seconds.time(job_type='batch'):
+            self._post_jobs(post_json=post_json, jobs=registered_jobs)
+        for job, registered_job in zip(jobs, registered_jobs):
+            controller.trace_dispatch(worker_id=self.worker_id, job=registered_job, started=started,
+                                      dequeued_at=job.get('dequeued_at'), batch_size=len(jobs))
+
+    def _post_jobs(self, post_json, jobs):
+        """
+        Send jobs to this worker. They are tracked before they are sent, so results returned right away are not lost,
+        and forgotten again if the worker did not accept them.
+        :param post_json: JSON to post to the worker (str)
+        :param jobs: list of RegisteredJob objects
+        """
+        controller.call(self.track_jobs, jobs)
+        try:
+            with tracer.span(name='controller_start_job'):
+                response = requests.post("http://{}/start_job".format(self.remote_addr), json=post_json)
+            assert response.text.lower() == 'ok'
+        except Exception:
+            controller.call(self.untrack_jobs, jobs)
+            for job in jobs:
+                job.unregister_from_database()
+            raise
+
+    def track_jobs(self, jobs):
+        """
+        Keep track of jobs started on this worker. Runs on the controller's state loop.
+        :param jobs: list of RegisteredJob objects
+        """
+        for job in jobs:
+            self.jobs[job.job_id] = job
+        self.publish_jobs()
+        self.last_job_started_at = datetime.datetime.now()
+
+    def untrack_jobs(self, jobs):
+        """
+        Stop keeping track of jobs. Runs on the controller's state loop.
+        :param jobs: list of RegisteredJob objects
+        :return: the jobs that were still tracked (list of RegisteredJob objects)
+        """
+        untracked = [job for job in jobs if self.jobs.pop(job.job_id, None) is not None]
+        self.publish_jobs()
+        return untracked
 
-        with tracer.span(name='controller_start_job'):
-            response = requests.post("http://{}:5003/start_job".format(self.remote_addr), json=post_json)
-        assert response.text.lower() == 'ok'
-        self.jobs[kwargs['job_id']] = RegisteredJob(job_id=kwargs['job_id'], job_type=job_type, assigned_worker=self,
-                                                    email=email, args=post_json)
+    def publish_jobs(self):
+        """
+        Publish the ids of the jobs of this worker for other threads. Runs on the controller's state loop, after every
+        change of the jobs.
+        """
+        self.job_ids = frozenset(self.jobs)
 
     def shutdown(self):
         """
@@ -166,7 +517,7 @@ class RegisteredWorker(object):
         """
         try:
             with tracer.span(name='controller_shutdown'):
-                requests.post("http://{}:5003/shutdown".format(self.remote_addr))
+                requests.post("http://{}/shutdown".format(self.remote_addr))
         except Exception as e:
             logger.error("Could not shutdown '{}@{}' with: {}. perhaps it's already down?".format(
                 self.worker_id, self.remote_addr, e))
@@ -175,27 +526,46 @@ class RegisteredWorker(object):
 
 class RegisteredJob(object):
 
-    def __init__(self, job_id, job_type, args, assigned_worker=None, email=None):
+    __slots__ = ('job_id', 'attempt', 'started_at', 'trace', 'batch_id', '_type', '_email')
+
+    def __init__(self, job_id=None, job_type=None, args=None, assigned_worker=None, email=None, attempt=0, trace=None,
+                 batch_id=None, sync_from=None):
         """
         Object representing a job running on a worker. Used by controller to keep track of jobs so it can restart them
-        if they don't return, and handle results if they do return.
+        if they don't return, and handle results if they do return. Jobs of other controllers are represented with
+        a storage entity in sync_from, which is not registered again.
         :param job_id: uuid4 (str)
-        :param job_type: run-once / continuous / get-desks (str)
+        :param job_type: run-once / continuous / desk-scan / get-desks (str)
         :param args: arguments used to start the job on the worker (dict)
         :param assigned_worker: uuid4 or worker (str)
         :param email: email address to mail the results to if any (str)
-        """
+        :param attempt: number of earlier attempts of the job that failed (int)
+        :param trace: trace context of the request the job runs for, as sent by the API server (dict, optional)
+        :param batch_id: uuid4 of the batch the job was started in (str, optional)
+        :param sync_from: storage entity of a job registered before (dict, optional)
+        """
+        if sync_from is not None:
+            job_id, job_type, email = sync_from['RowKey'], sync_from['type'], sync_from.get('email')
+            attempt = int(sync_from.get('attempt') or 0)
+            trace = json.loads(sync_from['args']).get('trace')
         self.job_id = job_id
-        self.register_in_database(job_id=job_id, job_type=job_type, assigned_worker=assigned_worker.worker_id,
-                                  email=email, args=args)
+        self.attempt = attempt
+        self.started_at = time.monotonic()
+        self.trace = trace
+        self.batch_id = batch_id
+        self._type = job_type
+        self._email = email or ''
+        if sync_from is None:
+            self.register_in_database(job_id=job_id, job_type=job_type, assigned_worker=assigned_worker.worker_id,
+                                      email=email, args=args, attempt=attempt)
 
     @property
     def entity(self):
         """
-        Return table entity associated with this job.
-        :return: Azure.Data.Table.entity
+        Return storage entity associated with this job.
+        :return: dict
         """
-        return table_client.get_entity(partition_key='RegisteredJobs', row_key=self.job_id)
+        return storage.get_job(job_id=self.job_id)
 
     @property
     def assigned_worker(self):
@@ -207,16 +577,16 @@ class RegisteredJob(object):
     @property
     def type(self):
         """
-        :return: run-once / continuous / get-desks (str)
+        :return: run-once / continuous / desk-scan / get-desks (str)
         """
-        return self.entity['type']
+        return self._type
 
     @property
     def email(self):
         """
         :return: email address to mail the results to if any (str)
         """
-        return self.entity['email']
+        return self._email
 
     @property
     def started(self):
@@ -232,49 +602,51 @@ class RegisteredJob(object):
         """
         return self.entity['args']
 
-    def register_in_database(self, job_id, job_type, assigned_worker, args, email=None):
+    def register_in_database(self, job_id, job_type, assigned_worker, args, email=None, attempt=0):
         """
-        Create a table entity representing this job.
+        Create a storage entity representing this job, and the controller it was started by.
         :param job_id: uuid4 (str)
         :param job_type: run-once / continuous / get-desks (str)
         :param args: arguments used to start the job on the worker (dict)
         :param assigned_worker: uuid4 or worker (str)
         :param email: email address to mail the results to if any (str)
+        :param attempt: number of earlier attempts of the job that failed (int)
         """
-        entity = {
-            'PartitionKey': 'RegisteredJobs',
-            'RowKey': job_id,
+        storage.create_job(job_id=job_id, properties={
             'type': job_type,
             'assigned_worker': assigned_worker,
+            'controller': controller.controller_id if controller else '',
             'email': email or '',
             'args': args,
+            'attempt': attempt,
             'started': datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-        }
-        table_client.create_entity(entity)
+        })
 
     def unregister_from_database(self):
         """
-        Delete the table entity representing this job.
+        Delete the storage entity representing this job.
         """
-        try:
-            table_client.delete_entity(partition_key='RegisteredJobs', row_key=self.job_id)
-        except azure.core.exceptions.ResourceNotFoundError:
-            pass
+        storage.delete_job(job_id=self.job_id)
 
     def complete(self, results):
         """
-        Called when results are returned by a worker. Handle it by storing results in the azure.data.table and emailing
-        them if an email is set for this job.
+        Called when results are returned by a worker. Handle it by storing results and emailing
+        them if an email is set for this job. Results of date checks also update the continuous runs they answer.
         :param results: str
         """
-        job_id, job_type, email = self.job_id, self.type, self.email
+        job_id, job_type, args = self.job_id, self.type, self.args
         self.unregister_from_database()
+        if job_type in ('run-once', 'continuous', 'desk-scan'):
+            controller.store_availability(job_id=job_id, job_args=args, results=results)
+            controller.notify_watchers(job_id=job_id, job_args=args, results=results)
         if job_type == 'run-once':
             self._complete_run_once_job(results=results, job_id=job_id)
         elif job_type == 'check-desks':
             self._complete_get_desks_job(results=results)
         elif job_type == 'continuous':
-            self._complete_continuous_job(results=results, job_id=job_id, email=email)
+            self._complete_continuous_job(results=results, job_id=job_id)
+        elif job_type == 'desk-scan' and self.attempt:
+            storage.store_desk_scan(desk=json.loads(args)['desks'][0], properties={'ErrorCount': 0})
 
     @staticmethod
     def _complete_run_once_job(results, job_id):
@@ -285,46 +657,36 @@ class RegisteredJob(object):
         controller.store_results(job_id=job_id, results=results)
 
     @staticmethod
-    def _complete_continuous_job(results, job_id, email):
+    def _complete_continuous_job(results, job_id):
         """
         :param results: str
         :param job_id: uuid4 str
-        :param email: str
         """
-        entity = table_client.get_entity(partition_key='ContinuousRun', row_key=job_id)
-        if not results:
-            entity['ErrorCount'] = 0
-            table_client.update_entity(entity)
-        else:
-            controller.store_results(job_id=job_id, results=results)
-            controller.mail_results(email=email, results=results)
-            table_client.delete_entity(entity)
+        controller.update_watcher(run_id=job_id, results=results)
 
     @staticmethod
     def _complete_get_desks_job(results):
         """
         :param results: str
         """
-        entity = {
-            'PartitionKey': 'Desks',
-            'RowKey': '0',
-            'Desks': results,
-            'CheckedAt': datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-        }
-        table_client.create_entity(entity)
+        storage.store_desks(desks=results, checked_at=datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'))
 
 
 class Controller(object):
 
     def __init__(self, cool_down_time=300, heartbeat_time=30, worker_timeout=90, job_timeout=300, max_number_of_jobs=20,
-                 worker_cooldown=3, max_job_errors=3, max_worker_errors=3):
+                 worker_cooldown=3, max_job_errors=3, max_worker_errors=3, min_workers=2, max_workers=10,
+                 scaling_target_time=120, scaling_interval=15, retry_backoff=5, max_retry_backoff=300, breaker=None,
+                 upstream_rate=2, upstream_burst=5, max_batch_size=10, watcher_sync_interval=10, start_loops=True):
         """
         Objects representing a controller that workers can register to. Controllers assign jobs to workers that are
         registered to them (specifically). Controllers are also aware of workers registered to other controllers,
         in order to distribute load evenly. Jobs that were assigned are kept track of so they can be restarted if no
         results return before the timeout period. Jobs that error out too many times are cancelled, and workers that
         have an error or fail to return results too many times are shut down.
-        :param cool_down_time: how often to check a continuous run request in minutes (int)
+        The workers, their jobs and the jobs to restart are only changed by the state loop, other threads post their
+        changes to it (see call) and read snapshots, so changes made at the same time cannot get lost.
+        :param cool_down_time: time in seconds between scans of a desk watched by continuous runs (int)
         :param heartbeat_time: time in seconds between hearbeat checks to registered workers (int)
         :param worker_cooldown: time in seconds of no heartbeat until worker registration is removed (int)
         :param job_timeout: time in seconds of not hearing back from an assigned job before stopping it (int)
@@ -332,9 +694,26 @@ class Controller(object):
         :param worker_timeout: minimum time in seconds to wait before assigning another job to a worker (int)
         :param max_job_errors: maximum amount of times a job may fail in a row until it's deleted permanently (int)
         :param max_job_errors: maximum amount of times a worker may fail in total until it's shutdown (int)
-        """
-        self.registered_workers = collections.deque()
-        self.synced_workers = collections.deque()
+        :param min_workers: lowest desired number of workers published for autoscaling (int)
+        :param max_workers: highest desired number of workers published for autoscaling (int)
+        :param scaling_target_time: time in seconds in which waiting jobs should be done, used to compute the desired
+                                    number of workers (float)
+        :param scaling_interval: time in seconds between computing the desired number of workers (float)
+        :param retry_backoff: maximum time in seconds before the first retry of a failed job, doubled on every retry
+                              (float)
+        :param max_retry_backoff: maximum time in seconds before a retry (float)
+        :param breaker: circuit breaker around the IND site, shared with the other controllers through storage
+                        (CircuitBreaker.CircuitBreaker, optional, None for the default thresholds)
+        :param upstream_rate: requests per second all workers together may make to the IND site, shared by the
+                              controllers in proportion to their workers (float)
+        :param upstream_burst: number of requests to the IND site that may be made at once after a quiet period (float)
+        :param max_batch_size: maximum number of date checks a worker runs in one session (int, 1 to not batch)
+        :param watcher_sync_interval: time in seconds between reading new and deleted continuous runs (float)
+        :param start_loops: start the background loops other than the state loop (Bool, False to drive the
+                            controller from outside, e.g. in a benchmark)
+        """
+        self.registered_workers = WorkerRegistry()
+        self.synced_workers = WorkerRegistry()
         self.cool_down_time = cool_down_time
         self.heartbeat_time = heartbeat_time
         self.worker_timeout = worker_timeout
@@ -344,16 +723,66 @@ class Controller(object):
         self.max_job_errors = max_job_errors
         self.max_worker_errors = max_worker_errors
         self.jobs_to_restart = collections.deque()
-        self.months = ['januari', 'februari', 'maart', 'april', 'mei', 'juni', 'juli', 'augustus', 'september',
-                       'oktober', 'november', 'december']
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scaling_target_time = scaling_target_time
+        self.scaling_interval = scaling_interval
+        self.retry_policy = RetryPolicy(max_attempts=max_job_errors, base_delay=retry_backoff,
+                                        max_delay=max_retry_backoff)
+        # Until jobs return, assume they take as long as the page checks of a few desks
+        self.average_job_seconds = 60.0
+        self.scaling = {}
+        self.breaker = breaker or CircuitBreaker.CircuitBreaker(storage=storage, logger=logger)
+        self.upstream_rate = upstream_rate
+        self.upstream_burst = upstream_burst
+        self.upstream_tokens = TokenBucket(rate=upstream_rate, burst=upstream_burst)
+        # Stored with the jobs this controller starts, to tell them from the jobs of other controllers
+        self.controller_id = str(uuid.uuid4())
+        # Rate at which queued requests are finished, for admission control on the API servers
+        self.throughput = Admission.ThroughputMeter(storage=storage, name=self.controller_id, logger=logger)
+        self.max_batch_size = max_batch_size
+        self.watchers = Watchers.WatcherIndex()
+        self.watcher_sync_interval = watcher_sync_interval
+        self.commands = queue.Queue()
+        self.state_thread = threading.Thread(target=self.state_loop, daemon=True)
+        self.state_thread.start()
         self.heartbeat_thread = threading.Thread(target=self.check_heartbeats_loop, daemon=True)
-        self.heartbeat_thread.start()
         self.distribute_jobs_thread = threading.Thread(target=self.distribute_jobs_loop, daemon=True)
-        self.distribute_jobs_thread.start()
         self.sync_workers_thread = threading.Thread(target=self.sync_workers_loop, daemon=True)
-        self.sync_workers_thread.start()
+        self.sync_watchers_thread = threading.Thread(target=self.sync_watchers_loop, daemon=True)
         self.check_jobs_thread = threading.Thread(target=self.check_jobs_loop, daemon=True)
-        self.check_jobs_thread.start()
+        self.scaling_thread = threading.Thread(target=self.scaling_loop, daemon=True)
+        if start_loops:
+            for thread in (self.heartbeat_thread, self.distribute_jobs_thread, self.sync_workers_thread,
+                           self.sync_watchers_thread, self.check_jobs_thread, self.scaling_thread):
+                thread.start()
+
+    def state_loop(self):
+        """
+        Run the commands posted by call one by one. This is the only thread that changes the workers, their jobs and
+        the jobs to restart, commands only change memory so they never wait on storage or workers.
+        """
+        while True:
+            function, args, future = self.commands.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def call(self, function, *args):
+        """
+        Run a function on the state loop and wait for it.
+        :param function: function changing the state of the controller
+        :param args: arguments to call it with
+        :return: what the function returned
+        """
+        if threading.current_thread() is self.state_thread:
+            return function(*args)
+        future = concurrent.futures.Future()
+        self.commands.put((function, args, future))
+        return future.result()
 
     def register_worker(self, worker_id=None, remote_addr=None, worker_obj=None):
         """
@@ -363,7 +792,7 @@ class Controller(object):
         :param worker_obj: pre existing RegisteredWorker object (RegisteredWorker)
         """
         worker_obj = worker_obj or RegisteredWorker(new_worker=True, worker_id=worker_id, remote_addr=remote_addr)
-        self.registered_workers.append(worker_obj)
+        self.call(self.registered_workers.add, worker_obj)
         logger.info("Registered: {}@{}".format(worker_obj.worker_id, worker_obj.remote_addr))
         mmap.measure_int_put(workers_measure, len(self.registered_workers))
         mmap.record(tmap)
@@ -373,8 +802,46 @@ class Controller(object):
         Deregister a worker to this controller.
         :param worker: RegisteredWorker object
         """
-        worker.unregister_database()
-        self.registered_workers.remove(worker)
+        worker.unregister_from_database()
+        self.call(self.registered_workers.discard, worker)
+
+    def registered_worker(self, worker_id):
+        """
+        :param worker_id: uuid4 (str)
+        :return: worker registered to this controller (RegisteredWorker, None if not registered here)
+        """
+        return self.registered_workers.get(worker_id)
+
+    def drain_worker(self, worker):
+        """
+        Stop assigning jobs to a worker that is shutting down.
+        :param worker: RegisteredWorker object
+        """
+        self.call(setattr, worker, 'draining', True)
+        logger.info("Draining: {}@{}".format(worker.worker_id, worker.remote_addr))
+
+    def hand_off_worker(self, worker):
+        """
+        Unregister a worker that has shut down, and restart the jobs it did not finish on other workers.
+        :param worker: RegisteredWorker object
+        :return: number of jobs restarted (int)
+        """
+        jobs = self.call(self._take_worker_jobs, worker)
+        self.unregister_worker(worker=worker)
+        logger.info("Unregistered drained worker {}, restarting {} job(s)".format(worker.worker_id, len(jobs)))
+        return len(jobs)
+
+    def _take_worker_jobs(self, worker):
+        """
+        Move all jobs of a worker to the jobs to restart. Runs on the state loop.
+        :param worker: RegisteredWorker object
+        :return: list of RegisteredJob objects
+        """
+        jobs = list(worker.jobs.values())
+        worker.jobs.clear()
+        worker.publish_jobs()
+        self.jobs_to_restart.extend(jobs)
+        return jobs
 
     def adopt_worker(self, worker):
         """
@@ -383,7 +850,7 @@ class Controller(object):
         """
         try:
             with tracer.span(name='controller_adopt'):
-                response = requests.post("http://{}:5003/adopt".format(worker.remote_addr))
+                response = requests.post("http://{}/adopt".format(worker.remote_addr))
             assert response.text.lower() == 'ok'
         except Exception as e:
             logger.warning("Cannot adopt '{}@{}': {}. Unregisting it completely.".format(
@@ -397,65 +864,444 @@ class Controller(object):
     def lowest_amount_of_jobs(self):
         """
         Returns the lowest amount of jobs held by any worker across all controllers. By always assigning jobs to the
-        worker(s) with the lowest amount of jobs, load is distributed evenly.
-        :return: int
+        worker(s) with the lowest amount of jobs, load is distributed evenly. Draining workers are left out, as they
+        will not get new jobs.
+        :return: int (0 if every worker is draining)
         """
-        return max([len(worker.jobs) for worker in self.registered_workers])
+        return min([len(worker.job_ids) for worker in self.registered_workers if not worker.draining], default=0)
 
-    def handle_result(self, job_id, results):
+    def handle_result(self, job_id, results, status=JOB_SUCCEEDED, error=None, seconds=None, page_load_seconds=None,
+                      worker_id=None, timings=None):
         """
+        Handle the outcome of a job reported by a worker: complete it if it succeeded, retry or drop it if it failed.
+        Outcomes and page load times feed the circuit breaker, except failures caused by the job itself. The jobs of a
+        batch share one session, so only the last of them to be handled feeds it.
         :param job_id: uuid4 (str)
         :param results: str
+        :param status: JOB_SUCCEEDED, JOB_RETRIABLE or JOB_FAILED (str)
+        :param error: what went wrong if the job failed (str, optional)
+        :param seconds: time the job took on the worker (float, optional, None to measure it here)
+        :param page_load_seconds: slowest page load of the job (float, optional)
+        :param worker_id: uuid4 of the worker that ran the job (str, optional, None to look in all workers)
+        :param timings: time per engine step and per desk of a timed job (dict with 'steps' and 'desks', optional)
+        """
+        received = time.time()
+        worker, job, closes_batch = self.call(self._take_job, job_id, worker_id)
+        if job is None:
+            # Already timed out or reported
+            return
+        if not closes_batch:
+            pass
+        elif status == JOB_FAILED:
+            self.breaker.release()
+        else:
+            self.breaker.record(succeeded=status == JOB_SUCCEEDED, page_load_seconds=page_load_seconds,
+                                started_at=job.started_at)
+        if status == JOB_SUCCEEDED:
+            self._record_job_duration(seconds=time.monotonic() - job.started_at if seconds is None else seconds)
+            with result_seconds.time():
+                job.complete(results=results)
+            if job.type in ('run-once', 'check-desks'):
+                self.throughput.record()
+            if job.trace:
+                self.trace_result(job=job, received=received, seconds=seconds, timings=timings)
+        else:
+            self.retry_job(job=job, reason=error or 'failed on worker {}'.format(worker.worker_id),
+                           retriable=status == JOB_RETRIABLE)
+
+    @staticmethod
+    def trace_dispatch(worker_id, job, started, dequeued_at=None, batch_size=1):
         """
-        for worker in self.registered_workers:
-            if job_id in worker.jobs.keys():
-                worker.jobs[job_id].complete(results=results)
-                del worker.jobs[job_id]
+        Record how a job of a traced request waited in the queue and was dispatched, as spans of the request and in
+        its timing record if it is timed. Failing to do so only logs an error.
+        :param worker_id: uuid4 of the worker that accepted the job (str)
+        :param job: RegisteredJob object
+        :param started: time since the epoch starting the job on the worker started (float)
+        :param dequeued_at: time since the epoch the job was taken from the queue (float, None if it was restarted)
+        :param batch_size: number of jobs the job was sent to the worker with (int)
+        """
+        if not job.trace:
+            return
+        dispatched_at = time.time()
+        attributes = {'job_id': job.job_id, 'worker_id': worker_id, 'attempt': job.attempt, 'batch_size': batch_size}
+        properties = {'DispatchedAt': dispatched_at, 'WorkerId': worker_id, 'Attempt': job.attempt,
+                      'BatchSize': batch_size}
+        try:
+            if dequeued_at:
+                Telemetry.record_span(exporter=trace_exporter, parent=job.trace['traceparent'], name='queue_wait',
+                                      started=job.trace['enqueued_at'], ended=dequeued_at, attributes=attributes)
+                properties['DequeuedAt'] = dequeued_at
+            Telemetry.record_span(exporter=trace_exporter, parent=job.trace['traceparent'], name='controller_dispatch',
+                                  started=dequeued_at or started, ended=dispatched_at, attributes=attributes)
+            if job.trace.get('timed'):
+                storage.store_job_timing(run_id=job.job_id, properties=properties)
+        except Exception as e:
+            logger.error("Could not trace dispatch of job {}: {}".format(job.job_id, e))
+
+    @staticmethod
+    def trace_result(job, received, seconds=None, timings=None):
+        """
+        Record how the result of a job of a traced request was stored, as a span of the request, and store the time
+        the job took on the worker (per engine step and per desk) and when its result was stored in its timing record
+        if it is timed. Failing to do so only logs an error.
+        :param job: RegisteredJob object
+        :param received: time since the epoch the result was received (float)
+        :param seconds: time the job took on the worker (float, optional)
+        :param timings: time per engine step and per desk (dict with 'steps' and 'desks', optional)
+        """
+        stored_at = time.time()
+        try:
+            Telemetry.record_span(exporter=trace_exporter, parent=job.trace['traceparent'],
+                                  name='controller_store_result', started=received, ended=stored_at,
+                                  attributes={'job_id': job.job_id})
+            if job.trace.get('timed'):
+                properties = {'ResultStoredAt': stored_at}
+                if seconds is not None:
+                    properties['WorkerSeconds'] = seconds
+                if timings:
+                    properties.update(Steps=json.dumps(timings.get('steps', {})),
+                                      Desks=json.dumps(timings.get('desks', {})))
+                storage.store_job_timing(run_id=job.job_id, properties=properties)
+        except Exception as e:
+            logger.error("Could not trace result of job {}: {}".format(job.job_id, e))
+
+    def _take_job(self, job_id, worker_id=None):
+        """
+        Stop tracking a job, so its outcome is handled once. Runs on the state loop.
+        :param job_id: uuid4 (str)
+        :param worker_id: uuid4 of the worker that ran the job (str, optional, None to look in all workers)
+        :return: RegisteredWorker and RegisteredJob objects and whether no other job of its batch is tracked (tuple,
+                 None and None if the job is not tracked)
+        """
+        worker = self.registered_workers.get(worker_id) if worker_id else None
+        for worker in [worker] if worker and job_id in worker.jobs else self.registered_workers:
+            job = worker.jobs.pop(job_id, None)
+            if job is not None:
+                worker.publish_jobs()
+                return worker, job, self._closes_batch(worker=worker, job=job)
+        return None, None, False
+
+    @staticmethod
+    def _closes_batch(worker, job):
+        """
+        Runs on the state loop, after the job is no longer tracked.
+        :param worker: RegisteredWorker object
+        :param job: RegisteredJob object
+        :return: whether no other job of the batch of the job is tracked on the worker (Bool, True if it was started on
+                 its own)
+        """
+        return job.batch_id is None or all(other.batch_id != job.batch_id for other in worker.jobs.values())
+
+    def retry_job(self, job, reason, retriable=True):
+        """
+        Run a job that failed on a worker again after a backoff, or move it to the dead letters if it cannot succeed or
+        failed max_job_errors times. Run once requests and desk checks go back on the queue, hidden until the backoff
+        has passed, continuous runs and desk scans are due again when it has passed. Either way the retry survives this
+        controller.
+        :param job: RegisteredJob object
+        :param reason: why the job failed (str)
+        :param retriable: whether the job may succeed when retried (Bool)
+        """
+        job_type, job_args = job.type, json.loads(job.args)
+        job.unregister_from_database()
+        if job_type == 'continuous':
+            self.retry_continuous_run(run_id=job.job_id, reason=reason, retriable=retriable)
+        elif job_type == 'desk-scan':
+            self.retry_desk_scan(desk=job_args['desks'][0], reason=reason, retriable=retriable)
+        else:
+            self.retry_message(content=self._job_message(job_type=job_type, job_args=job_args,
+                                                         error_count=job.attempt),
+                               job_id=job.job_id, reason=reason, retriable=retriable)
+
+    def retry_message(self, content, job_id, reason, retriable=True):
+        """
+        Put a run once request or desk check that failed back on the queue, hidden for the backoff.
+        :param content: the queue message of the request (str)
+        :param job_id: uuid4 (str)
+        :param reason: why the request failed (str)
+        :param retriable: whether the request may succeed when retried (Bool)
+        """
+        job_type = 'check-desks' if content.startswith('check_desks') else 'run-once'
+        error_count = self._message_error_count(content=content) + 1
+        if not retriable or self.retry_policy.exhausted(attempts=error_count):
+            self._dead_letter(job_id=job_id, job_type=job_type, attempts=error_count, reason=reason,
+                              content=self._message_with_error_count(content=content, error_count=0))
+            return
+        delay = self.retry_policy.delay(attempts=error_count)
+        storage.send_message(self._message_with_error_count(content=content, error_count=error_count), delay=delay)
+        job_retries.inc(job_type=job_type, outcome='retried')
+        logger.warning("Retrying job {} in {:.1f}s (attempt {}): {}".format(job_id, delay, error_count + 1, reason))
+
+    def retry_continuous_run(self, run_id, reason, retriable=True):
+        """
+        Make a continuous run that failed due again after the backoff, instead of after the cool down time.
+        :param run_id: uuid4 (str)
+        :param reason: why the run failed (str)
+        :param retriable: whether the run may succeed when retried (Bool)
+        """
+        try:
+            entity = storage.get_continuous_run(run_id=run_id)
+        except Storage.NotFoundError:
+            return
+        error_count = int(entity.get('ErrorCount') or 0) + 1
+        if not retriable or self.retry_policy.exhausted(attempts=error_count):
+            request = {key: value for key, value in entity.items()
+                       if key not in ('PartitionKey', 'RowKey', 'LastRun', 'RetryAt', 'ErrorCount')}
+            self._dead_letter(job_id=run_id, job_type='continuous', attempts=error_count, reason=reason,
+                              content=json.dumps(request))
+            storage.delete_continuous_run(run_id=run_id)
+            return
+        delay = self.retry_policy.delay(attempts=error_count)
+        entity['ErrorCount'] = error_count
+        entity['RetryAt'] = (datetime.datetime.now() + datetime.timedelta(seconds=delay)).strftime('%d/%m/%Y %H:%M:%S')
+        storage.update_entity(entity)
+        job_retries.inc(job_type='continuous', outcome='retried')
+        logger.warning("Retrying continuous run {} in {:.1f}s (attempt {}): {}".format(run_id, delay, error_count + 1,
+                                                                                        reason))
+
+    def retry_desk_scan(self, desk, reason, retriable=True):
+        """
+        Make a desk that failed to be scanned due again after the backoff, instead of after the cool down time. Desks
+        are scanned for as long as continuous runs watch them, so a scan is never dead lettered: scans that cannot
+        succeed wait the longest backoff.
+        :param desk: str
+        :param reason: why the scan failed (str)
+        :param retriable: whether the scan may succeed when retried (Bool)
+        """
+        try:
+            error_count = int(storage.get_desk_scan(desk=desk).get('ErrorCount') or 0) + 1
+        except Storage.NotFoundError:
+            error_count = 1
+        delay = self.retry_policy.delay(attempts=error_count) if retriable else self.retry_policy.max_delay
+        storage.store_desk_scan(desk=desk, properties={'ErrorCount': error_count, 'RetryAt': (
+            datetime.datetime.now() + datetime.timedelta(seconds=delay)).strftime('%d/%m/%Y %H:%M:%S')})
+        job_retries.inc(job_type='desk-scan', outcome='retried')
+        logger.warning("Retrying scan of desk {} in {:.1f}s (attempt {}): {}".format(desk, delay, error_count + 1,
+                                                                                      reason))
+
+    @staticmethod
+    def _dead_letter(job_id, job_type, attempts, reason, content):
+        """
+        Keep a job that will not be retried, so it can be inspected and replayed through the API server.
+        :param job_id: uuid4 (str)
+        :param job_type: run-once / continuous / check-desks (str)
+        :param attempts: number of failed attempts (int)
+        :param reason: why the last attempt failed (str)
+        :param content: queue message (run once, check desks) or JSON of the continuous run request to replay (str)
+        """
+        logger.error("Moving job {} to dead letters after {} attempt(s): {}".format(job_id, attempts, reason))
+        storage.store_dead_letter(job_id=job_id, properties={
+            'Type': job_type,
+            'Content': content,
+            'Attempts': attempts,
+            'Error': reason[:1000],
+            'FailedAt': datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+        })
+        job_retries.inc(job_type=job_type, outcome='dead_lettered')
+
+    @staticmethod
+    def _job_message(job_type, job_args, error_count):
+        """
+        Queue message to run a run once or desk check job again.
+        :param job_type: run-once / check-desks (str)
+        :param job_args: arguments the job was started with (dict)
+        :param error_count: int
+        :return: str
+        """
+        if job_type == 'check-desks':
+            return 'check_desks,{}'.format(error_count)
+        plan = {'months': job_args['desired_months'], 'desks': job_args['desks'], 'start_date': job_args['start_date'],
+                'end_date': job_args['end_date'], 'max_results': job_args.get('max_results', 1)}
+        message = {'run_id': job_args['job_id'], 'plan': plan, 'error_count': error_count}
+        if job_args.get('trace'):
+            message['trace'] = job_args['trace']
+        return json.dumps(message)
+
+    @staticmethod
+    def _message_error_count(content):
+        """
+        :param content: queue message (str)
+        :return: number of failed attempts of the request (int)
+        """
+        if content.startswith('{'):
+            return int(json.loads(content)['error_count'])
+        return int(content.split(',')[-1])
+
+    @staticmethod
+    def _message_with_error_count(content, error_count):
+        """
+        :param content: queue message (str)
+        :param error_count: int
+        :return: the message with its error count replaced (str)
+        """
+        if content.startswith('{'):
+            return json.dumps(dict(json.loads(content), error_count=error_count))
+        return ','.join(content.split(',')[:-1] + [str(error_count)])
+
+    def _record_job_duration(self, seconds, weight=0.1):
+        """
+        Update the moving average of the time jobs take, from starting them to handling their results.
+        :param seconds: float
+        :param weight: weight of the new duration (float)
+        """
+        self.average_job_seconds += weight * (seconds - self.average_job_seconds)
+
+    def scaling_loop(self):
+        """
+        Periodically compute the number of workers needed for the current demand. The queue, continuous runs, jobs and
+        workers in storage are shared by all controllers, so every controller publishes the same signal.
+        """
+        while True:
+            try:
+                self.scaling = self.compute_scaling()
+                mmap.measure_int_put(desired_workers_measure, self.scaling['desired_workers'])
+                mmap.record(tmap)
+                self.share_upstream_rate(workers=self.scaling['workers'])
+                self.throughput.publish()
+            except Exception as e:
+                logger.error("Could not compute desired number of workers: {}".format(e))
+            time.sleep(self.scaling_interval)
+
+    def share_upstream_rate(self, workers):
+        """
+        Give this controller's token bucket its share of the request rate to the IND site: the share of all workers
+        that is registered to it, so the controllers together grant upstream_rate.
+        :param workers: number of workers registered to all controllers (int)
+        """
+        own_workers = max(1, len(self.registered_workers))
+        share = own_workers / max(workers, own_workers)
+        self.upstream_tokens.set_rate(rate=self.upstream_rate * share, burst=max(1.0, self.upstream_burst * share))
+
+    def compute_scaling(self):
+        """
+        :return: desired number of workers and the demand and capacity it is computed from (dict)
+        """
+        queue_depth = storage.queue_depth()
+        due_continuous_jobs = len(self._due_desk_scans())
+        in_flight_jobs = len(storage.jobs())
+        workers = len(storage.workers())
+        backlog = queue_depth + due_continuous_jobs + len(self.jobs_to_restart)
+        circuit = self.breaker.status()
+        if circuit['state'] == CircuitBreaker.OPEN:
+            # Nothing is dispatched while the site is down, more workers would only wait
+            backlog = 0
+        return {
+            'desired_workers': desired_workers(
+                backlog=backlog, in_flight=in_flight_jobs, average_job_seconds=self.average_job_seconds,
+                jobs_per_worker=self.max_number_of_jobs, target_seconds=self.scaling_target_time,
+                min_workers=self.min_workers, max_workers=self.max_workers),
+            'circuit': circuit,
+            'workers': workers,
+            'capacity': workers * self.max_number_of_jobs,
+            'queue_depth': queue_depth,
+            'due_continuous_jobs': due_continuous_jobs,
+            'jobs_to_restart': len(self.jobs_to_restart),
+            'in_flight_jobs': in_flight_jobs,
+            'average_job_seconds': round(self.average_job_seconds, 3),
+            'queued_jobs_per_second': round(self.throughput.rate(), 3),
+            'computed_at': datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+        }
 
     @staticmethod
     def store_results(job_id, results):
         """
-        Store results in Azure.Data.Table.
+        Store results so the API server can return them.
         :param job_id: uuid4 str
         :param results: str
         """
-        entity = {
-            'PartitionKey': 'Result',
-            'RowKey': job_id,
-            'Result': results
-        }
-        table_client.create_entity(entity)
+        storage.store_result(run_id=job_id, result=results)
 
     @staticmethod
-    def mail_results(email, results):
+    def store_availability(job_id, job_args, results):
         """
-        Email results using GMAIL SMTP.
-        :param email: str
+        Append what a job observed to the availability history, one entity per scraped desk. Failing to do so should
+        never prevent results from reaching the user, so errors are only logged.
+        :param job_id: uuid4 str
+        :param job_args: arguments used to start the job on the worker (json str)
         :param results: str
         """
         try:
-            mail_content = "\n".join(results.split(','))
-            message = MIMEMultipart()
-            message['From'] = sender_address
-            message['To'] = email
-            message['Subject'] = 'IND Datum gevonden!'
-            message.attach(MIMEText(mail_content, 'plain'))
-            session = smtplib.SMTP('smtp.gmail.com', 587)
-            session.starttls()
-            session.login(sender_address, sender_pass)
-            text = message.as_string()
-            session.sendmail(sender_address, email, text)
-            session.quit()
+            kwargs = json.loads(job_args)
+            window_start, window_end = Planning.month_window(months=kwargs['desired_months'])
+            if kwargs.get('start_date') and kwargs.get('end_date'):
+                window_start = max(window_start, Planning.parse_date(kwargs['start_date']))
+                window_end = min(window_end, Planning.parse_date(kwargs['end_date']))
+            for entity in Availability.observation_entities(desks=kwargs['desks'], window_start=window_start,
+                                                            window_end=window_end, results=results, job_id=job_id):
+                storage.create_entity(entity)
         except Exception as e:
-            logger.error("Could not send email: {}".format(e))
+            logger.error("Could not store availability for job {}: {}".format(job_id, e))
+
+    def notify_watchers(self, job_id, job_args, results):
+        """
+        Fan the results of a date check out to the other continuous runs it answers for one or more of their desks (see
+        Planning.covers). The runs are looked up in the watcher index by the desks and window of the check, so a
+        single scan of a desk serves every run watching it. Failing to do so should never prevent results from
+        reaching the user, so errors are only logged.
+        :param job_id: uuid4 str
+        :param job_args: arguments used to start the job on the worker (json str)
+        :param results: str
+        """
+        try:
+            found = list(filter(None, results.split(',')))
+            for run_id, watcher in self.watchers.matches(job=json.loads(job_args)).items():
+                if run_id != job_id:
+                    self.update_watcher(run_id=run_id, results=','.join(Planning.split_results(results=found,
+                                                                                               job=watcher)),
+                                        desks=watcher['desks'])
+        except Exception as e:
+            logger.error("Could not notify watchers of job {}: {}".format(job_id, e))
+
+    def update_watcher(self, run_id, results, desks=None):
+        """
+        Apply new results to a continuous run. They are stored only when availability changed in one of its
+        (desk, month) windows, and mailed only when days became available, so users are not mailed the same days on
+        every check. Runs are only read from storage when their results in the watcher index changed.
+        :param run_id: uuid4 (str)
+        :param results: results covering the run, or the desks that were checked (str)
+        :param desks: desks the results cover (list of str, optional, None for all desks of the run)
+        """
+        previous = self.watchers.get_last_results(run_id=run_id)
+        if previous is not None and not Availability.changed_windows(
+                previous=previous, current=Availability.replace_desks(previous=previous, current=results,
+                                                                      desks=desks))[0]:
+            return
+        try:
+            entity = storage.get_continuous_run(run_id=run_id)
+        except Storage.NotFoundError:
+            self.watchers.remove(run_id=run_id)
+            return
+        previous = entity.get('LastResults', '')
+        results = Availability.replace_desks(previous=previous, current=results, desks=desks)
+        changed, appeared = Availability.changed_windows(previous=previous, current=results)
+        self.watchers.set_last_results(run_id=run_id, results=results)
+        if not changed:
+            return
+        logger.info("Availability of continuous job {} changed in {}".format(run_id, changed))
+        entity['LastResults'] = results
+        storage.update_entity(entity=entity)
+        self.store_results(job_id=run_id, results=results)
+        email = self._parse_email(email_str=entity['Email'])
+        if appeared and email:
+            self.mail_results(email=email, results=results)
+
+    @staticmethod
+    def mail_results(email, results):
+        """
+        Queue results to be emailed, the mailer sends them in the background.
+        :param email: str
+        :param results: str
+        """
+        mailer.send(to=email, subject='IND Datum gevonden!', body="\n".join(results.split(',')))
 
     def check_heartbeats_loop(self):
         """
         Loop that keeps track of worker heartbeat, so workers can be unregistered if unresponsive.
         """
         while True:
-            for worker in self.registered_workers.copy():
-                self._make_heartbeat(worker=worker)
+            with heartbeat_sweep_seconds.time():
+                for worker in self.registered_workers:
+                    self._make_heartbeat(worker=worker)
             for worker in self.synced_workers:
                 self._check_possible_orphaned_synced_worker(worker=worker)
             time.sleep(10)
@@ -465,49 +1311,128 @@ class Controller(object):
         Keep aware of workers registered to other controllers. Jobs are not assigned to them, they are just used to
         distribute load evenly.
         """
-        for synced_worker in self.synced_workers.copy():
+        self.sync_workers()
+
+    def sync_workers(self):
+        """
+        Drop synced workers that were unregistered, and sync or adopt the workers of other controllers that are new,
+        from a single read of all workers.
+        """
+        entities = storage.workers()
+        worker_ids = set(entity['RowKey'] for entity in entities)
+        removed = [worker for worker in self.synced_workers if worker.worker_id not in worker_ids]
+        added = []
+        for entity in entities:
+            if entity['RowKey'] in self.registered_workers or entity['RowKey'] in self.synced_workers:
+                continue
+            worker = RegisteredWorker(sync_from=entity)
+            if datetime.datetime.now() - datetime.datetime.strptime(entity['last_heartbeat'], '%d/%m/%Y %H:%M:%S') \
+                    > datetime.timedelta(seconds=self.worker_timeout + self.heartbeat_time):
+                self._handle_orphaned_worker(worker=worker)
+            else:
+                added.append(worker)
+        self.call(self._update_synced_workers, removed, added)
+
+    def _update_synced_workers(self, removed, added):
+        """
+        Runs on the state loop.
+        :param removed: list of RegisteredWorker objects
+        :param added: list of RegisteredWorker objects
+        """
+        for worker in removed:
+            self.synced_workers.discard(worker)
+        for worker in added:
+            if worker.worker_id not in self.registered_workers:
+                self.synced_workers.add(worker)
+
+    def sync_watchers_loop(self):
+        """
+        Keep the watcher index up to date with the continuous runs in storage, which the API server adds.
+        """
+        while True:
             try:
-                table_client.get_entity(partition_key='RegisteredWorkers', row_key=synced_worker.worker_id)
-            except azure.core.exceptions.ResourceNotFoundError:
-                self.synced_workers.remove(synced_worker)
-        for entity in table_client.query_entities("PartitionKey eq 'RegisteredWorkers'"):
-            if entity['RowKey'] not in [worker.worker_id for worker in self.registered_workers + self.synced_workers]:
-                worker = RegisteredWorker(sync_from=entity)
-                if datetime.datetime.now() - datetime.datetime.strptime(worker.last_heartbeat, '%d/%m/%Y %H:%M:%S') \
-                      > datetime.timedelta(seconds=self.worker_timeout + self.heartbeat_time):
-                    self._handle_orphaned_worker(worker=worker)
+                self.sync_watchers()
+            except Exception as e:
+                logger.error("Could not sync continuous runs: {}".format(e))
+            time.sleep(self.watcher_sync_interval)
 
-                else:
-                    self.synced_workers.append(RegisteredWorker(sync_from=entity))
+    def sync_watchers(self):
+        """
+        Index continuous runs that are new, drop the ones that were deleted and delete the ones without months left to
+        check. Results stored by other controllers are adopted, so changes they mailed are not mailed again.
+        """
+        run_ids = set()
+        for entity in self._database_requests:
+            run_id = entity['RowKey']
+            run_ids.add(run_id)
+            job = self.watchers.get(run_id=run_id)
+            if job is None:
+                try:
+                    _, plan, _, _ = self._parse_database_request(entity=entity)
+                    job = self._job_kwargs(job_id=run_id, plan=plan)
+                except Exception as e:
+                    logger.error("Could not read continuous job {}: {}".format(run_id, e))
+                    self.retry_continuous_run(run_id=run_id, reason=str(e))
+                    continue
+            if not Planning.remaining_months(months=job['desired_months']):
+                logger.info("Continuous job {} has no months left to check, deleting it".format(run_id))
+                storage.delete_continuous_run(run_id=run_id)
+                self.watchers.remove(run_id=run_id)
+            elif run_id in self.watchers:
+                self.watchers.set_last_results(run_id=run_id, results=entity.get('LastResults', ''))
+            else:
+                self.watchers.add(run_id=run_id, job=job, last_results=entity.get('LastResults', ''))
+        for run_id in self.watchers.run_ids() - run_ids:
+            self.watchers.remove(run_id=run_id)
 
     def distribute_jobs_loop(self, from_queue=True, from_database=True):
         """
         Find a job to do for a worker (if any). Can be a job thats needs restarting after timing/erroring out, a job
-        from the message queue (run once/get desks) or a job from the Table (continuous). If a job is found, try to
-        find an available worker. If there's a job and an available worker, assign the job.
+        from the message queue (run once/get desks) or a scan of a desk watched by continuous runs. If a job is found,
+        try to find an available worker. If there's a job and an available worker, assign the job. Pending date checks
+        are assigned in batches of up to max_batch_size, so a worker checks them in one session. Nothing is assigned
+        while the circuit breaker is open, and only probe jobs while it is half open.
         :param from_queue: check run once requests from message queue (Bool)
-        :param from_database: check continuous run requests from database (Bool)
+        :param from_database: scan desks watched by continuous runs in database (Bool)
         """
         message_switch = True
         while True:
             worker = self._available_worker
-            if worker:
-                if self.jobs_to_restart:
-                    job = self.jobs_to_restart.popleft()
-                    self._restart_job(worker=worker, job=job)
-                elif message_switch and from_queue:
-                    self._get_job_from_message(worker=worker)
-                elif not message_switch and from_database:
-                    self._get_job_from_database(worker=worker)
+            if worker and self.breaker.allow():
+                started = False
+                job = self.call(self._next_job_to_restart)
+                if job is not None:
+                    started = self._restart_job(worker=worker, job=job)
+                else:
+                    sources = [source for source, enabled in ((self._pending_from_queue, from_queue),
+                                                              (self._pending_from_database, from_database)) if enabled]
+                    # A probe reserved while half open is spent on a single job, not on a whole batch
+                    limit = 1 if self.breaker.is_half_open() else \
+                        max(1, min(self.max_batch_size, self.max_number_of_jobs - len(worker.job_ids)))
+                    pending = []
+                    for source in sources if message_switch else reversed(sources):
+                        pending.extend(source(limit=limit - len(pending)))
+                        if len(pending) >= limit:
+                            break
+                    started = self._start_pending(worker=worker, pending=pending)
+                if not started:
+                    self.breaker.release()
                 message_switch = not message_switch
             time.sleep(1)
 
+    def _next_job_to_restart(self):
+        """
+        Runs on the state loop.
+        :return: RegisteredJob object (None if there is no job to restart)
+        """
+        return self.jobs_to_restart.popleft() if self.jobs_to_restart else None
+
     def check_jobs_loop(self):
         """
         Check if any jobs assigned by this controller are timed out. If so restart them if they have not yet reached
         max error count, or delete them if so. Check jobs not assigned to this controller, if they are lingering for
-        double the timeout time, restart them on this controller (assuming the other controller died, since it would
-        have picked up this job otherwise).
+        double the timeout time, retry them (assuming the other controller died, since it would have picked up this
+        job otherwise).
         """
         while True:
             self._check_own_jobs()
@@ -516,34 +1441,59 @@ class Controller(object):
 
     def _check_own_jobs(self):
 
+        for worker, job, errors, closes_batch in self.call(self._take_timed_out_jobs):
+            try:
+                if closes_batch:
+                    self.breaker.record(succeeded=False, started_at=job.started_at)
+                if errors >= self.max_worker_errors:
+                    worker.shutdown()
+                else:
+                    self.retry_job(job=job, reason="timed out on worker {}".format(worker.worker_id))
+            except Exception as e:
+                logger.error("Faulty job {}:{}, removing.".format(job.job_id, e))
+                job.unregister_from_database()
+
+    def _take_timed_out_jobs(self):
+        """
+        Stop tracking jobs that did not return within the job timeout, counting them as errors of their worker. Runs on
+        the state loop.
+        :return: worker, job, the errors of the worker so far and whether no other job of its batch is tracked (list of
+                 tuple)
+        """
+        timed_out = []
+        now = time.monotonic()
         for worker in self.registered_workers:
-            for job_id, job in worker.jobs.copy().items():
-                try:
-                    if datetime.datetime.now() - datetime.datetime.strptime(job.started, '%d/%m/%Y %H:%M:%S') > \
-                            datetime.timedelta(seconds=self.job_timeout):
-                        del worker.jobs[job_id]
-                        worker.errors += 1
-                        if worker.errors >= self.max_worker_errors:
-                            worker.shutdown()
-                        else:
-                            self.jobs_to_restart.append(job)
-                except Exception as e:
-                    logger.error("Faulty job {}:{}, removing.".format(job_id, e))
+            for job_id, job in list(worker.jobs.items()):
+                if now - job.started_at > self.job_timeout:
                     del worker.jobs[job_id]
-                    job.unregister_from_database()
+                    worker.errors += 1
+                    timed_out.append((worker, job, worker.errors, self._closes_batch(worker=worker, job=job)))
+            if len(worker.jobs) != len(worker.job_ids):
+                worker.publish_jobs()
+        return timed_out
 
     def _check_foreign_jobs(self):
-
-        for job_entity in table_client.query_entities("PartitionKey eq 'RegisteredJobs'"):
+        """
+        Retry jobs of other controllers that are still registered after twice the job timeout, as their controller
+        would have retried them otherwise. They are retried with the backoff and dead letter rules of retry_job,
+        counting the attempts stored with them.
+        """
+        for job_entity in storage.jobs():
+            if job_entity.get('controller') == self.controller_id or \
+                    job_entity.get('assigned_worker') in self.registered_workers:
+                continue
             if datetime.datetime.now() - datetime.datetime.strptime(job_entity['started'], '%d/%m/%Y %H:%M:%S') > \
                     datetime.timedelta(seconds=self.job_timeout * 2):
                 try:
-                    job = RegisteredJob(job_id=job_entity['job_id'], job_type=job_entity['type'], args=job_entity['args'],
-                                        email=job_entity['email'])
-                    self.jobs_to_restart.append(job)
+                    job = RegisteredJob(sync_from=job_entity)
+                    self.retry_job(job=job, reason="lingering on worker {} of another controller".format(
+                        job_entity.get('assigned_worker')))
+                except Storage.NotFoundError:
+                    # Already retried by another controller
+                    pass
                 except Exception as e:
                     logger.error("Could not restart job {}: {}. Deleting it from database".format(job_entity, e))
-                    table_client.delete_entity(job_entity)
+                    storage.delete_job(job_id=job_entity['RowKey'])
 
     def _make_heartbeat(self, worker):
         """
@@ -554,16 +1504,44 @@ class Controller(object):
         if datetime.datetime.now() - last_heartbeat_obj > datetime.timedelta(seconds=self.heartbeat_time):
             try:
                 with tracer.span(name='controller_heartbeat'):
-                    response = requests.get("http://{}:5003/heartbeat".format(worker.remote_addr), timeout=3)
-                    if response.text == 'OK':
-                        worker.entity['last_heartbeat'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-                        table_client.update_entity(worker.entity)
+                    sent_at = time.monotonic()
+                    response = requests.get("http://{}/heartbeat".format(worker.remote_addr), timeout=3)
+                    if response.text == 'OK' or response.headers.get('Content-Type') == 'application/json':
+                        entity = worker.entity
+                        entity['last_heartbeat'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+                        storage.update_entity(entity)
+                        if response.text != 'OK':
+                            self._reconcile_jobs(worker=worker, running_jobs=response.json()['running_jobs'],
+                                                 sent_at=sent_at)
                         return True
             except Exception as e:
                 logger.error("Heartbeat failed for {}@{}: {}".format(worker.worker_id, worker.remote_addr, e))
                 if datetime.datetime.now() - last_heartbeat_obj > datetime.timedelta(seconds=self.worker_timeout):
                     self.unregister_worker(worker=worker)
 
+    def _reconcile_jobs(self, worker, running_jobs, sent_at):
+        """
+        Retry jobs the controller assigned to a worker that the worker does not run anymore, without having reported
+        an outcome, e.g. because the worker restarted. Jobs started after the heartbeat was sent are left alone.
+        :param worker: RegisteredWorker object
+        :param running_jobs: ids of the jobs the worker reported as running (list of str)
+        :param sent_at: time.monotonic() when the heartbeat was sent (float)
+        """
+        for job in self.call(self._take_missing_jobs, worker, set(running_jobs), sent_at):
+            self.retry_job(job=job, reason="not running on worker {}".format(worker.worker_id))
+
+    @staticmethod
+    def _take_missing_jobs(worker, running_jobs, sent_at):
+        """
+        Stop tracking the jobs of a worker it did not report as running. Runs on the state loop.
+        :param worker: RegisteredWorker object
+        :param running_jobs: ids of the jobs the worker reported as running (set of str)
+        :param sent_at: time.monotonic() when the heartbeat was sent (float)
+        :return: list of RegisteredJob objects
+        """
+        return worker.untrack_jobs([job for job_id, job in worker.jobs.items()
+                                    if job_id not in running_jobs and job.started_at < sent_at])
+
     def _check_possible_orphaned_synced_worker(self, worker):
         """
         If the worker_timeout for a worker has been reached, and another heartbeat_time has passed (i.e. its' controller
@@ -589,18 +1567,24 @@ class Controller(object):
             logger.warning("Orphaned worker not responding, deleting from database: {}@{} ({})".format(
                 worker.worker_id, worker.remote_addr, e))
             worker.unregister_from_database()
-            if worker in self.synced_workers:
-                self.synced_workers.remove(worker)
+            self.call(self.synced_workers.discard, worker)
 
     @staticmethod
     def _restart_job(job, worker):
         """
-        Restart a job. Only happens when it previously failed or timed out.
+        Restart a job. Only happens when it previously failed or timed out, or its worker shut down.
         :param job: RegisteredJob object
         :param worker: RegisteredWorker object
+        :return: whether the job was started (Bool)
         """
+        job_type, email, kwargs = job.type, job.email, json.loads(job.args)
         job.unregister_from_database()
-        worker.start_job(job_type=job.type, email=job.email, kwargs=job.args)
+        try:
+            worker.start_job(job_type=job_type, email=email, attempt=job.attempt, **kwargs)
+            return True
+        except Exception as e:
+            logger.error("Could not restart job {} on worker '{}': {}".format(job.job_id, worker.worker_id, e))
+            return False
 
     @property
     def _available_worker(self):
@@ -608,87 +1592,121 @@ class Controller(object):
         Returns the first available worker found.
         :return: RegisteredWorker object
         """
-        for worker in self.registered_workers:
-            if worker.ready:
+        workers = list(self.registered_workers)
+        if not workers:
+            return None
+        lowest_amount_of_jobs = self.lowest_amount_of_jobs
+        for worker in workers:
+            if worker.is_ready(lowest_amount_of_jobs=lowest_amount_of_jobs):
                 return worker
 
-    def _get_job_from_database(self, worker):
-        """
-        Find a database request (if any) and run it.
-        """
-        for entity in self._database_requests:
-            if not self._check_request_cool_down(entity=entity):
-                error_count = None
-                original_last_run_time = entity['LastRun']
-                try:
-                    self._update_request_timer(entity=entity)
-                    job_id, desired_months, desks, email, error_count = self._parse_database_request(entity=entity)
-                    kwargs = {'job_id': job_id, 'desired_months': desired_months, 'desks': desks}
-                    worker.start_job(job_type='continuous', **kwargs)
-                except Exception as e:
-                    logger.error("Could not start job on worker '{}': {}".format(worker.worker_id, e))
-                    if error_count:
-                        error_count += 1
-                        if error_count < self.max_job_errors:
-                            self._update_request_timer(entity=entity, date_time=original_last_run_time)
-                return
-
-    def _get_job_from_message(self, worker):
-        """
-        Find a request from message queue (if any) and run it.
-        """
-        message = queue_run_once_client.receive_message()
-        if message:
-            queue_run_once_client.delete_message(message)
-            error_count = None
+    def _pending_from_database(self, limit):
+        """
+        Take up to limit scans of desks watched by continuous runs that are due. Every desk is scanned once per cool
+        down time for all runs watching it, whose results are fanned out to them, so the number of scans grows with
+        the number of desks instead of the number of runs. The scan time is stored right away, so other controllers
+        do not scan the desk as well.
+        :param limit: int
+        :return: pending jobs with 'job_type', 'email', 'attempt', 'kwargs' and a 'retry' function (list of dict)
+        """
+        pending = []
+        for desk, entity in self._due_desk_scans():
+            if len(pending) >= limit:
+                break
+            kwargs = self.watchers.desk_scan(desk=desk, job_id=str(uuid.uuid4()))
+            if kwargs is None:
+                continue
+            storage.store_desk_scan(desk=desk, properties={
+                'LastRun': datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'), 'RetryAt': ''})
+            pending.append({'job_type': 'desk-scan', 'email': None, 'attempt': int(entity.get('ErrorCount') or 0),
+                            'kwargs': kwargs, 'retry': functools.partial(self.retry_desk_scan, desk=desk)})
+        return pending
+
+    def _due_desk_scans(self):
+        """
+        :return: desks watched by continuous runs that are due to be scanned, with their last scan (list of (str,
+                 dict))
+        """
+        scans = {entity['RowKey']: entity for entity in storage.desk_scans()}
+        return [(desk, scans.get(desk, {})) for desk in self.watchers.desks()
+                if not self._check_request_cool_down(entity=scans.get(desk, {}))]
+
+    def _pending_from_queue(self, limit):
+        """
+        Take up to limit requests from the message queue. Malformed messages are dead lettered, and run once requests
+        without months left to check are answered right away.
+        :param limit: int
+        :return: pending jobs with 'job_type', 'email', 'attempt', 'kwargs', 'dequeued_at' and a 'retry' function
+                 (list of dict)
+        """
+        pending = []
+        while len(pending) < limit:
+            message = storage.receive_message()
+            if not message:
+                break
+            storage.delete_message(message)
+            dequeued_at = time.time()
             try:
                 if message.content.startswith("check_desks"):
-                    error_count = message.content.split(',')[-1]
-                    kwargs = {'job_id': str(uuid.uuid4())}
-                    worker.start_job(job_type='check-desks', check_desks=True, **kwargs)
+                    job_id, error_count = str(uuid.uuid4()), self._message_error_count(content=message.content)
+                    job_type, kwargs = 'check-desks', {'job_id': job_id, 'check_desks': True}
                 else:
-                    job_id, desired_months, desks, error_count = self._parse_message_request(message=message)
-                    kwargs = {'job_id': job_id, 'desired_months': desired_months, 'desks': desks}
-                    worker.start_job(job_type='run-once', **kwargs)
+                    job_id, plan, error_count, trace = self._parse_message_request(message=message)
+                    job_type, kwargs = 'run-once', self._job_kwargs(job_id=job_id, plan=plan, trace=trace)
+            except (KeyError, ValueError) as e:
+                self._dead_letter(job_id=str(uuid.uuid4()), job_type='run-once', attempts=1, content=message.content,
+                                  reason="Malformed message: {}".format(e))
+                continue
+            if job_type == 'run-once' and not kwargs['desired_months']:
+                logger.info("Run once job {} has no months left to check".format(job_id))
+                self.store_results(job_id=job_id, results='')
+                continue
+            pending.append({'job_type': job_type, 'email': None, 'attempt': error_count, 'kwargs': kwargs,
+                            'dequeued_at': dequeued_at,
+                            'retry': functools.partial(self.retry_message, content=message.content, job_id=job_id)})
+        return pending
+
+    def _start_pending(self, worker, pending):
+        """
+        Start pending jobs on a worker. Date checks (run once and continuous) are started together as one batch, which
+        the worker checks in a single session, desk checks on their own. Jobs that could not be started are retried.
+        :param worker: RegisteredWorker object
+        :param pending: pending jobs (list of dict)
+        :return: whether a job was started (Bool)
+        """
+        date_checks = [job for job in pending if job['job_type'] != 'check-desks']
+        groups = [[job] for job in pending if job['job_type'] == 'check-desks']
+        if date_checks:
+            groups.append(date_checks)
+        started = False
+        for group in groups:
+            try:
+                if len(group) == 1:
+                    worker.start_job(job_type=group[0]['job_type'], email=group[0]['email'],
+                                     attempt=group[0]['attempt'], dequeued_at=group[0].get('dequeued_at'),
+                                     **group[0]['kwargs'])
+                else:
+                    worker.start_batch(jobs=group)
+                started = True
             except Exception as e:
                 logger.error("Could not start job on worker '{}': {}".format(worker.worker_id, e))
-                if error_count:
-                    error_count += 1
-                    if error_count < self.max_job_errors:
-                        queue_run_once_client.send_message(message)
+                for job in group:
+                    job['retry'](reason=str(e))
+        return started
 
     def _check_request_cool_down(self, entity):
         """
-        Check if a database request is still cooling down.
-        :param entity: Azure.Data.Tables.Entity
+        Check if a database request or desk scan is still cooling down.
+        :param entity: dict
         :return: Bool
         """
-        return entity['LastRun'] and \
+        if entity.get('RetryAt'):
+            # Failed runs are retried after their backoff instead of the cool down time
+            return datetime.datetime.now() < datetime.datetime.strptime(entity['RetryAt'], '%d/%m/%Y %H:%M:%S')
+        return bool(entity.get('LastRun')) and \
                datetime.datetime.now() - datetime.datetime.strptime(entity['LastRun'], '%d/%m/%Y %H:%M:%S') < \
                datetime.timedelta(seconds=self.cool_down_time)
 
-    @staticmethod
-    def _update_request_timer(entity, date_time=None):
-        """
-        Update the LastRun property of a database request so the request is not ran again until the cool down time has
-        passed.
-        :param entity: Azure.Data.Tables.Entity
-        :param date_time: time to update with (optional, None for current time)
-        """
-        entity['LastRun'] = date_time or datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-        table_client.update_entity(entity=entity)
-
-    def _parse_desired_months(self, start_date, end_date):
-        """
-        From a start and end date, find the months in which to search for an available date.
-        :param start_date: datetime
-        :param end_date: datetime
-        :return:
-        """
-        start_date_obj = datetime.datetime.strptime(start_date, "%d/%m/%Y")
-        end_date_obj = datetime.datetime.strptime(end_date, "%d/%m/%Y")
-        return [self.months[i - 1] for i in range(start_date_obj.month, end_date_obj.month + 1)]
-
     @staticmethod
     def _parse_desks(desks_str):
         """
@@ -708,35 +1726,58 @@ class Controller(object):
 
     def _parse_database_request(self, entity):
         """
-        Parse run parameters from a database continuous run request.
-        :param entity: Azure.Data.Tables.Entity
-        :return: run_id (str), desired_months (list of str), desks (list of str), email (str)
+        Parse run parameters from a database continuous run request. Requests are planned when they are made, requests
+        made before that are planned here.
+        :param entity: dict
+        :return: run_id (str), plan (dict), email (str), error_count (int)
         """
         run_id = entity['RowKey']
-        desired_months = self._parse_desired_months(start_date=entity['StartDate'], end_date=entity['EndDate'])
-        desks = self._parse_desks(desks_str=entity['Desks'])
+        if entity.get('Plan'):
+            plan = json.loads(entity['Plan'])
+        else:
+            plan = Planning.plan_request(start_date=entity['StartDate'], end_date=entity['EndDate'],
+                                         desks=self._parse_desks(desks_str=entity['Desks']))
         email = self._parse_email(email_str=entity['Email'])
         error_count = entity['ErrorCount']
-        return run_id, desired_months, desks, email, error_count
+        return run_id, plan, email, error_count
 
     def _parse_message_request(self, message):
         """
-        Parse run parameters from a database continuous run request.
-        :param message: Azure.Storage.Queue.Message
-        :return: run_id (str), desired_months (list of str), desks (list of str), email (str)
+        Parse run parameters from a message queue run once request. Messages are JSON holding the plan made by the API
+        server and the trace context of the request, older comma separated messages are planned here.
+        :param message: message with content attribute
+        :return: run_id (str), plan (dict), error_count (int), trace (dict, None if the message has none)
         """
+        if message.content.startswith('{'):
+            content = json.loads(message.content)
+            return content['run_id'], content['plan'], int(content['error_count']), content.get('trace')
         run_id, start_date, end_date, desks, error_count = message.content.split(',')
-        desks = self._parse_desks(desks_str=desks)
-        desired_months = self._parse_desired_months(start_date=start_date, end_date=end_date)
-        return run_id, desired_months, desks, int(error_count)
+        plan = Planning.plan_request(start_date=start_date, end_date=end_date,
+                                     desks=self._parse_desks(desks_str=desks))
+        return run_id, plan, int(error_count), None
+
+    @staticmethod
+    def _job_kwargs(job_id, plan, trace=None):
+        """
+        Parameters to start a job with on a worker. Months that have passed since the request was planned are dropped.
+        :param job_id: uuid4 (str)
+        :param plan: dict
+        :param trace: trace context of the request, passed on to the worker (dict, optional)
+        :return: dict
+        """
+        kwargs = {'job_id': job_id, 'desired_months': Planning.remaining_months(months=plan['months']),
+                  'desks': plan['desks'], 'start_date': plan['start_date'], 'end_date': plan['end_date'],
+                  'max_results': plan.get('max_results', 1)}
+        if trace:
+            kwargs['trace'] = trace
+        return kwargs
 
     @property
     def _database_requests(self):
         """
-        :return: List of azure.data.table.entity
+        :return: list of dict
         """
-        my_filter = "PartitionKey eq 'ContinuousRun'"
-        return table_client.query_entities(my_filter)
+        return storage.continuous_runs()
 
 
 def shutdown_server():
@@ -749,20 +1790,74 @@ def shutdown_server():
 @app.route("/register", methods=['POST'])
 def register():
 
+    if controller is None:
+        return "Controller is starting", 503
     worker_id = request.args['worker_id']
-    controller.register_worker(worker_id=worker_id, remote_addr=request.remote_addr)
+    remote_addr = '{}:{}'.format(request.remote_addr, request.args.get('port', 5003))
+    controller.register_worker(worker_id=worker_id, remote_addr=remote_addr)
     return "OK,{}".format(request.host)
 
 
+@app.route("/scaling", methods=['GET'])
+def scaling():
+
+    if controller is None or not controller.scaling:
+        return "Controller is starting", 503
+    return app.response_class(json.dumps(controller.scaling), mimetype='application/json')
+
+
+@app.route("/drain", methods=['POST'])
+def drain():
+
+    worker = controller.registered_worker(worker_id=request.args['worker_id']) if controller else None
+    if worker is None:
+        return "Unknown worker", 404
+    controller.drain_worker(worker=worker)
+    return "OK"
+
+
+@app.route("/hand_off", methods=['POST'])
+def hand_off():
+
+    worker = controller.registered_worker(worker_id=request.args['worker_id']) if controller else None
+    if worker is None:
+        return "Unknown worker", 404
+    return "OK,{}".format(controller.hand_off_worker(worker=worker))
+
+
+@app.route("/upstream_token", methods=['POST'])
+def upstream_token():
+    """
+    Reserve a token for a request to the IND site, returns the time in seconds the worker has to wait before using it.
+    """
+    if controller is None:
+        return "Controller is starting", 503
+    delay = controller.upstream_tokens.reserve()
+    upstream_token_delay.observe(delay)
+    return '{:.3f}'.format(delay)
+
+
 @app.route("/return_result", methods=['POST'])
 def return_result():
 
     job_id = request.args['job_id']
     results = request.args['result']
-    controller.handle_result(job_id=job_id, results=results)
+    seconds = request.args.get('seconds')
+    page_load_seconds = request.args.get('page_load_seconds')
+    timings = request.args.get('timings')
+    controller.handle_result(job_id=job_id, results=results, status=request.args.get('status', JOB_SUCCEEDED),
+                             error=request.args.get('error'), seconds=float(seconds) if seconds else None,
+                             page_load_seconds=float(page_load_seconds) if page_load_seconds else None,
+                             worker_id=request.args.get('worker_id'), timings=json.loads(timings) if timings else None)
     return "OK"
 
 
+def start_controller_service():
+
+    startup.in_background(name='telemetry', target=start_telemetry)
+    startup.in_background(name='controller', target=start_controller, required=True)
+
+
 if __name__ == '__main__':
-    controller = Controller()
-    app.run(host='0.0.0.0', port=5002)
+    # Workers and jobs are kept in memory, so the controller runs in a single process
+    Serving.run(app=app, port=5002, on_start=start_controller_service, processes=1, logger=logger)
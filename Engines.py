@@ -0,0 +1,518 @@
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
+from webdriver_manager.chrome import ChromeDriverManager
+from selenium.webdriver.support.ui import Select
+from selenium.webdriver.common.by import By
+import contextlib
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+import requests
+import Planning
+
+DATEPICKER_XPATH = "/html/body/app/div/div[2]/div/div/div/oap-appointment/div/div/oap-appointment-reservation/div/" \
+                   "form/div[4]/available-date-picker/div/datepicker/datepicker-inner/div"
+# Desks as named in the desk dropdown of the appointment page, and the codes the page uses to request their slots.
+DESK_CODES = {
+    'ind amsterdam': 'AM',
+    'ind den haag': 'DH',
+    'ind zwolle': 'ZW',
+    'ind den bosch': 'DB'
+}
+
+
+class Engine(object):
+
+    def __init__(self, logger=None):
+        """
+        Base class of the ways a worker can read availability from the IND site. Engines are stateless between calls,
+        every call opens (and closes) whatever session it needs.
+        :param logger: logger to log progress to (logging.Logger, optional)
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.step_listener = None
+        self.throttle = None
+        # Time the thread running a check waited for throttle, left out of the steps holding the wait
+        self.throttled = threading.local()
+
+    @contextlib.contextmanager
+    def step(self, name, upstream=False, desk=None):
+        """
+        Time a step of a check (page load, desk selection, ...) and report it to step_listener if one is set. Listeners
+        are called from the thread running the check, as listener(name, seconds, desk). Steps that make a request to
+        the IND site first call throttle if one is set, e.g. to wait for a rate limiter. The wait is reported as an
+        'upstream_wait' step of its own and left out of the time of every step, including steps holding the step that
+        waited. Checks time the scrape of every desk as a 'scrape_desk' step, which holds the steps made for the desk.
+        :param name: str
+        :param upstream: whether the step makes a request to the IND site (Bool)
+        :param desk: desk the step is made for (str, optional)
+        """
+        if upstream and self.throttle:
+            waiting = time.perf_counter()
+            self.throttle()
+            waited = time.perf_counter() - waiting
+            self.throttled.seconds = getattr(self.throttled, 'seconds', 0.0) + waited
+            if self.step_listener:
+                self.step_listener('upstream_wait', waited, desk)
+        started, throttled = time.perf_counter(), getattr(self.throttled, 'seconds', 0.0)
+        try:
+            yield
+        finally:
+            if self.step_listener:
+                waited = getattr(self.throttled, 'seconds', 0.0) - throttled
+                self.step_listener(name, time.perf_counter() - started - waited, desk)
+
+    @property
+    def browser_pool(self):
+        """
+        :return: the pool of browsers the engine checks with (DriverPool, None if it does not use browsers)
+        """
+        return None
+
+    def get_desks(self):
+        """
+        Get all desks that can be chosen on the site.
+        :return: list of str
+        """
+        raise NotImplementedError
+
+    def check_available_dates(self, desired_months, desks, window, max_results=1):
+        """
+        Find available days in the window for the given desks.
+        :param desired_months: list of [year, month]
+        :param desks: lower case desk names (list of str)
+        :param window: first and last acceptable day (tuple of datetime.date)
+        :param max_results: number of earliest days to find per desk (int, None for all days)
+        :return: results formatted by Planning.format_result (list of str)
+        """
+        raise NotImplementedError
+
+
+class DriverPool(object):
+
+    def __init__(self, factory, size=None):
+        """
+        Pool of browsers. Without a size every check starts and quits its own browser. With a size at most that many
+        browsers run at once, and they are kept open to be reused by later checks, saving a browser start per check.
+        :param factory: function returning a new driver
+        :param size: maximum number of browsers (int, optional, None for no pooling)
+        """
+        self.factory = factory
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.semaphore = threading.BoundedSemaphore(size) if size else None
+        self.lock = threading.Lock()
+        self.drivers = set()
+
+    @contextlib.contextmanager
+    def driver(self):
+        """
+        Hand out a browser for the duration of a check. Browsers that raised during a check are not reused.
+        """
+        if self.semaphore:
+            self.semaphore.acquire()
+        try:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                driver = self.factory()
+                with self.lock:
+                    self.drivers.add(driver)
+            reusable = False
+            try:
+                yield driver
+                reusable = bool(self.size)
+            finally:
+                if reusable:
+                    driver.get('about:blank')
+                    self.idle.put(driver)
+                else:
+                    self._quit(driver=driver)
+        finally:
+            if self.semaphore:
+                self.semaphore.release()
+
+    def _quit(self, driver):
+
+        with self.lock:
+            self.drivers.discard(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def browser_pids(self):
+        """
+        :return: process id of the chromedriver of every open browser (list of int)
+        """
+        with self.lock:
+            return [driver.service.process.pid for driver in self.drivers if driver.service.process]
+
+    def occupancy(self):
+        """
+        :return: maximum number of browsers (None without pooling), and number of open, idle and in use browsers (dict)
+        """
+        with self.lock:
+            open_browsers = len(self.drivers)
+        idle = self.idle.qsize()
+        return {'size': self.size, 'open': open_browsers, 'idle': idle, 'in_use': max(0, open_browsers - idle)}
+
+    def close(self):
+        """
+        Quit all idle browsers.
+        """
+        while True:
+            try:
+                self._quit(driver=self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class SeleniumEngine(Engine):
+
+    def __init__(self, url, logger=None, step_delay=2, pool_size=None):
+        """
+        Read availability by driving the appointment page in a headless Chrome.
+        :param url: URL of the appointment page (str)
+        :param logger: logger to log progress to (logging.Logger, optional)
+        :param step_delay: time in seconds to let the page settle after each click (int)
+        :param pool_size: number of browsers to keep open and reuse (int, optional, None for a browser per check)
+        """
+        super().__init__(logger=logger)
+        self.url = url
+        self.step_delay = step_delay
+        self.pool = DriverPool(factory=self._init_driver, size=pool_size)
+
+    @property
+    def browser_pool(self):
+
+        return self.pool
+
+    def _init_driver(self):
+        """
+        Start a headless chrome driver.
+        """
+        with self.step('browser_start'):
+            chrome_options = webdriver.ChromeOptions()
+            chrome_options.add_argument('--headless')
+            return webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
+
+    def _load_page(self, driver):
+
+        with self.step('page_load', upstream=True):
+            driver.get(self.url)
+            return Select(driver.find_element(by=By.ID, value='desk'))
+
+    def get_desks(self):
+
+        with self.pool.driver() as driver:
+            desk_dropdown = self._load_page(driver=driver)
+            return [desk.text.strip() for desk in desk_dropdown.options if desk.text]
+
+    def check_available_dates(self, desired_months, desks, window, max_results=1):
+
+        results = []
+        # click_month_picker should be True initially and when the month picker element was clicked on the website,
+        # because it disappears when clicked and should be reacquired in that case.
+        click_month_picker = True
+        with self.pool.driver() as driver:
+            desk_dropdown = self._load_page(driver=driver)
+            desk_values = [option for option in desk_dropdown.options if option.text.lower() in desks]
+            for desk_value in desk_values:
+                if not desk_value:  # There's an empty option in the dropdown
+                    continue
+                with self.step('scrape_desk', desk=desk_value.text.lower()):
+                    click_month_picker = self._check_desk_for_available_date(
+                        driver=driver, desk_value=desk_value, desk_dropdown=desk_dropdown,
+                        click_month_picker=click_month_picker, desired_months=desired_months, results=results,
+                        window=window, max_results=max_results)
+        return results
+
+    def _click_month_picker(self, driver):
+        """
+        Click month picker to reveal available months on website.
+        """
+        with self.step('month_picker'):
+            month_picker_element = driver.find_element(
+                by=By.XPATH, value=DATEPICKER_XPATH + "/daypicker/table/thead/tr[1]/th[2]/button")
+            month_picker_element.click()
+            time.sleep(self.step_delay)
+
+    def _navigate_to_year(self, driver, year, max_pages=5):
+        """
+        Page the month picker to the given year, so months are matched on year as well as name.
+        :param year: int
+        :param max_pages: maximum number of years to page through (int)
+        :return: True if the year is shown (Bool)
+        """
+        header_xpath = DATEPICKER_XPATH + "/monthpicker/table/thead/tr[1]/th[{}]/button"
+        with self.step('navigate_year'):
+            for _ in range(max_pages):
+                shown_year = int(driver.find_element(by=By.XPATH, value=header_xpath.format(2)).text.strip())
+                if shown_year == year:
+                    return True
+                driver.find_element(by=By.XPATH, value=header_xpath.format(1 if shown_year > year else 3)).click()
+                time.sleep(self.step_delay / 2)
+            return False
+
+    def _check_desk_for_available_date(self, driver, desk_value, desk_dropdown, desired_months, results, window,
+                                       max_results=1, click_month_picker=True):
+        """
+        Check a specific desk for available days in the requested window.
+        :param desk_value:
+        :param desk_dropdown:
+        :param desired_months: list of [year, month]
+        :param results: list of results found so far (list of str)
+        :param window: first and last acceptable day (tuple of datetime.date)
+        :param max_results: number of earliest days to find for this desk (int, None for all days)
+        :param click_month_picker: Selenium element of month picker widget on site
+        :return: True if a month has been clicked to find a day (Bool)
+        """
+        with self.step('select_desk'):
+            desk_dropdown.select_by_visible_text(desk_value.text)
+            time.sleep(self.step_delay)
+        self.logger.info('[{}] Do {}'.format(datetime.datetime.now(), desk_value.text))
+        if click_month_picker:
+            self._click_month_picker(driver=driver)
+        desk_results = []
+        month_clicked = self._check_desk_for_available_months(
+            driver=driver, desk_value=desk_value, desired_months=desired_months, results=desk_results, window=window,
+            max_results=max_results)
+        if desk_results:
+            self.logger.info('[{}] Found {} result(s): {}'.format(datetime.datetime.now(), len(desk_results),
+                                                                  desk_value.text))
+        else:
+            self.logger.info('[{}] No result: {}'.format(datetime.datetime.now(), desk_value.text))
+        results.extend(desk_results)
+        return month_clicked
+
+    def _check_desk_for_available_months(self, driver, desk_value, desired_months, results, window, max_results=1):
+        """
+        Check which months are available for the current desk. Desired months are visited in order, paging the month
+        picker to their year. Each available desired month is clicked to find days in it, until enough days have been
+        found.
+        :param desk_value: str
+        :param desired_months: list of [year, month]
+        :param results: list of results found so far for this desk (list of str)
+        :param window: first and last acceptable day (tuple of datetime.date)
+        :param max_results: number of earliest days to find (int, None for all days)
+        :return: True if the day picker of a month is shown (Bool)
+        """
+        month_clicked = False
+        for year, month in desired_months:
+            if month_clicked:
+                self._click_month_picker(driver=driver)
+                month_clicked = False
+            if not self._navigate_to_year(driver=driver, year=year):
+                continue
+            for potential_month_button in driver.find_elements(by=By.CLASS_NAME, value="btn-default"):
+                if potential_month_button.text.lower() != Planning.month_name(month):
+                    continue
+                if potential_month_button.is_enabled():
+                    with self.step('open_month'):
+                        potential_month_button.click()
+                        time.sleep(self.step_delay)
+                    month_clicked = True
+                    with self.step('scan_days'):
+                        self._check_month_for_available_dates(driver=driver, desk_value=desk_value, year=year,
+                                                              month=month, results=results, window=window,
+                                                              max_results=max_results)
+                break
+            if max_results and len(results) >= max_results:
+                break
+        return month_clicked
+
+    @staticmethod
+    def _check_month_for_available_dates(driver, desk_value, year, month, results, window, max_results=1):
+        """
+        A month has been selected, now check for available days within the requested window. Add them to results
+        earliest first, as we now have a desk, month and day, until max_results days have been found. The day picker
+        also shows the tail of the previous and the head of the next month, those are skipped.
+        :param desk_value: str
+        :param year: int
+        :param month: int
+        :param results: list of results found so far for this desk (list of str)
+        :param window: first and last acceptable day (tuple of datetime.date)
+        :param max_results: number of earliest days to find (int, None for all days)
+        """
+        in_month = False
+        for potential_day_button in driver.find_elements(by=By.CLASS_NAME, value="btn-sm"):
+            day_text = potential_day_button.text.strip()
+            if not day_text.isdigit():
+                continue
+            if day_text == '1':
+                if in_month:
+                    break
+                in_month = True
+            if not in_month:
+                continue
+            day = datetime.date(year, month, int(day_text))
+            if day < window[0]:
+                continue
+            if day > window[1]:
+                break
+            if not potential_day_button.is_enabled():
+                continue
+            results.append(Planning.format_result(desk=desk_value.text, date=day))
+            if max_results and len(results) >= max_results:
+                break
+
+
+class HttpEngine(Engine):
+
+    def __init__(self, base_url='https://oap.ind.nl', product_key='DOC', persons=1, desk_codes=None, logger=None,
+                 timeout=10):
+        """
+        Read availability from the JSON endpoint the appointment page itself calls for the slots of a desk, without a
+        browser. One GET per desk returns every open slot of that desk.
+        :param base_url: scheme and host of the IND site (str)
+        :param product_key: appointment type as in the page URL, '#/doc' (str)
+        :param persons: number of persons to book for (int)
+        :param desk_codes: lower case desk name to desk code (dict, optional, None for DESK_CODES)
+        :param logger: logger to log progress to (logging.Logger, optional)
+        :param timeout: time in seconds to wait for a response (int)
+        """
+        super().__init__(logger=logger)
+        self.base_url = base_url.rstrip('/')
+        self.product_key = product_key
+        self.persons = persons
+        self.desk_codes = desk_codes or DESK_CODES
+        self.timeout = timeout
+
+    def get_desks(self):
+        """
+        The desk dropdown is part of the page itself rather than of an endpoint, so desks are listed by the Selenium
+        engine.
+        """
+        raise NotImplementedError("Desks can only be read from the appointment page")
+
+    def get_slots(self, session, desk_code):
+        """
+        :param session: requests.Session
+        :param desk_code: str
+        :return: list of slot dicts ('date', 'startTime', 'endTime', ...)
+        """
+        with self.step('fetch_slots', upstream=True):
+            response = session.get("{}/oap/api/desks/{}/slots/".format(self.base_url, desk_code),
+                                   params={'productKey': self.product_key, 'persons': self.persons},
+                                   timeout=self.timeout)
+            response.raise_for_status()
+        # The endpoint prefixes its JSON with an anti hijacking line: ")]}',"
+        body = response.text
+        body = body[body.index('\n') + 1:] if body.startswith(")]}'") else body
+        content = json.loads(body)
+        if content.get('status') != 'OK':
+            raise RuntimeError("Slots of desk {} returned status {}".format(desk_code, content.get('status')))
+        return content['data']
+
+    def check_available_dates(self, desired_months, desks, window, max_results=1):
+
+        unknown_desks = [desk for desk in desks if desk not in self.desk_codes]
+        if unknown_desks:
+            raise KeyError("No desk code known for: {}".format(', '.join(unknown_desks)))
+        months = set((year, month) for year, month in desired_months)
+        results = []
+        with requests.Session() as session:
+            for desk, desk_code in self.desk_codes.items():
+                if desk not in desks:
+                    continue
+                with self.step('scrape_desk', desk=desk):
+                    slots = self.get_slots(session=session, desk_code=desk_code)
+                days = sorted(set(datetime.datetime.strptime(slot['date'], '%Y-%m-%d').date() for slot in slots))
+                days = [day for day in days if window[0] <= day <= window[1] and (day.year, day.month) in months]
+                days = days[:max_results] if max_results else days
+                self.logger.info('[{}] Found {} result(s): {}'.format(datetime.datetime.now(), len(days), desk))
+                results.extend(Planning.format_result(desk=self.desk_name(desk), date=day) for day in days)
+        return results
+
+    @staticmethod
+    def desk_name(desk):
+        """
+        Desk name as shown in the desk dropdown, so results read the same as those of the Selenium engine.
+        :param desk: lower case desk name (str)
+        :return: str
+        """
+        return 'IND ' + desk[len('ind '):].title() if desk.startswith('ind ') else desk.title()
+
+
+class FallbackEngine(Engine):
+
+    def __init__(self, primary, fallback, logger=None):
+        """
+        Use the primary engine, and the fallback engine for any call the primary engine fails on.
+        :param primary: Engine
+        :param fallback: Engine
+        :param logger: logger to log progress to (logging.Logger, optional)
+        """
+        self.primary = primary
+        self.fallback = fallback
+        super().__init__(logger=logger)
+
+    @property
+    def step_listener(self):
+
+        return self.primary.step_listener
+
+    @step_listener.setter
+    def step_listener(self, listener):
+
+        self.primary.step_listener = listener
+        self.fallback.step_listener = listener
+
+    @property
+    def throttle(self):
+
+        return self.primary.throttle
+
+    @throttle.setter
+    def throttle(self, throttle):
+
+        self.primary.throttle = throttle
+        self.fallback.throttle = throttle
+
+    @property
+    def browser_pool(self):
+
+        return self.primary.browser_pool or self.fallback.browser_pool
+
+    def get_desks(self):
+
+        try:
+            return self.primary.get_desks()
+        except NotImplementedError:
+            return self.fallback.get_desks()
+        except Exception as e:
+            self.logger.warning("{} could not get desks, falling back: {}".format(type(self.primary).__name__, e))
+            return self.fallback.get_desks()
+
+    def check_available_dates(self, desired_months, desks, window, max_results=1):
+
+        try:
+            return self.primary.check_available_dates(desired_months=desired_months, desks=desks, window=window,
+                                                      max_results=max_results)
+        except Exception as e:
+            self.logger.warning("{} could not check dates, falling back: {}".format(type(self.primary).__name__, e))
+            return self.fallback.check_available_dates(desired_months=desired_months, desks=desks, window=window,
+                                                       max_results=max_results)
+
+
+def create_engine(name, url, logger=None, pool_size=None):
+    """
+    :param name: 'selenium' or 'http' (the latter falls back to selenium for listing desks, desks it has no code for
+                 and failures) (str)
+    :param url: URL of the appointment page (str)
+    :param logger: logger to log progress to (logging.Logger, optional)
+    :param pool_size: number of browsers to keep open and reuse (int, optional, None for a browser per check)
+    :return: Engine
+    """
+    selenium_engine = SeleniumEngine(url=url, logger=logger, pool_size=pool_size)
+    if name == 'selenium':
+        return selenium_engine
+    elif name == 'http':
+        base_url = url.split('/oap/')[0]
+        return FallbackEngine(primary=HttpEngine(base_url=base_url, logger=logger), fallback=selenium_engine,
+                              logger=logger)
+    raise ValueError("Unknown engine: {}".format(name))
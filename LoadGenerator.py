@@ -1,12 +1,422 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request
+from werkzeug.serving import make_server
+import Benchmark
+import Engines
+import Planning
+import ReplayServer
+import Storage
+import argparse
+import collections
+import datetime
+import threading
+import requests
+import logging
+import random
+import json
+import time
 import uuid
-from Common import connect_str, queue_name
-from azure.storage.queue import QueueClient
+import sys
+import os
+import re
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('STORAGE_BACKEND', 'sqlite')
+for service_dir in ('APIServer', 'Controller', 'Worker'):
+    sys.path.append(os.path.join(root_dir, service_dir))
+
+
+class CountingStorage(Storage.SQLiteStorage):
+
+    def __init__(self, path=':memory:', on_create=None):
+        """
+        SQLite storage shared by all services of the harness, counting the storage operations they make.
+        :param path: database file (str, optional, ':memory:' for in memory)
+        :param on_create: function called with every created entity (optional)
+        """
+        super().__init__(path=path)
+        self.on_create = on_create
+        self.counts_lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.call_listener = self.count
+
+    def count(self, operation, seconds):
+
+        with self.counts_lock:
+            self.counts[operation] += 1
+
+    def _create_entity(self, entity):
+
+        super()._create_entity(entity=entity)
+        if self.on_create:
+            self.on_create(entity)
+
+
+class StubEngine(Engines.Engine):
+
+    def __init__(self, latency=0.5, failure_rate=0.0, logger=None):
+        """
+        Engine that pretends to check the IND site: it waits for about latency seconds, fails with the given
+        probability and otherwise finds the first day of the window available at every desk.
+        :param latency: mean time in seconds a check takes (float)
+        :param failure_rate: probability of a check raising (float)
+        :param logger: logger to log progress to (logging.Logger, optional)
+        """
+        super().__init__(logger=logger)
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def _pretend(self):
+
+        with self.step('page_load', upstream=True):
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.failure_rate:
+            raise RuntimeError("Stub engine failure")
+
+    def get_desks(self):
+
+        self._pretend()
+        return [desk['name'] for desk in ReplayServer.load_fixture_desks()['desks']]
+
+    def check_available_dates(self, desired_months, desks, window, max_results=1):
+
+        self._pretend()
+        return [Planning.format_result(desk=Engines.HttpEngine.desk_name(desk), date=window[0]) for desk in desks]
+
+
+class SimulatedWorker(object):
+
+    def __init__(self, controller_address, engine, job_listener=None):
+        """
+        A worker running in this process: a Worker.DateChecker with its own HTTP endpoint for the controller.
+        :param controller_address: host:port of the controller (str)
+        :param engine: Engines.Engine
+        :param job_listener: function called with the arguments of every started job (optional)
+        """
+        import Worker
+        self.app = Flask('simulated_worker')
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        self.date_checker = Worker.DateChecker(url='http://ind.invalid/oap/nl/#/doc', engine=engine,
+                                               controller_address=controller_address, port=self.server.port)
+        self.job_listener = job_listener
+        self.app.add_url_rule('/start_job', 'start_job', self.start_job, methods=['POST'])
+        self.app.add_url_rule('/heartbeat', 'heartbeat', self.heartbeat, methods=['GET'])
+        self.app.add_url_rule('/adopt', 'adopt', self.adopt, methods=['POST'])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+
+        self.thread.start()
+        self.date_checker.register()
+
+    def stop(self):
+
+        self.server.shutdown()
+
+    def drain(self, timeout):
+        """
+        Drain the worker as on SIGTERM, and stop serving.
+        :param timeout: time in seconds to wait for running jobs (float)
+        :return: number of jobs handed off to the controller (int)
+        """
+        handed_off = self.date_checker.drain(timeout=timeout)
+        self.server.shutdown()
+        return handed_off
+
+    def start_job(self):
+
+        if self.date_checker.draining:
+            return "Draining", 503
+        kwargs = json.loads(request.json)
+        if self.job_listener:
+            self.job_listener(kwargs)
+        self.date_checker.run(**kwargs)
+        return "OK"
+
+    def heartbeat(self):
+
+        self.date_checker.last_heard_from_controller = datetime.datetime.now()
+        return self.app.response_class(json.dumps({'status': 'OK', 'running_jobs': self.date_checker.running_job_ids(),
+                                                   'draining': self.date_checker.draining}),
+                                       mimetype='application/json')
+
+    def adopt(self):
+
+        self.date_checker.last_heard_from_controller = datetime.datetime.now()
+        self.date_checker.controller = request.remote_addr + ":{}".format(self.controller_port)
+        return "OK"
+
+    @property
+    def controller_port(self):
+
+        return self.date_checker.controller_address.split(':')[1]
+
+
+class Harness(object):
+
+    def __init__(self, args):
+        """
+        APIServer, Controller and simulated workers in one process, sharing one SQLite storage.
+        :param args: parsed command line arguments (argparse.Namespace)
+        """
+        self.args = args
+        self.lock = threading.Lock()
+        self.submitted = {}
+        self.completed = {}
+        self.dispatched = collections.Counter()
+        self.batches = []
+        self.requests = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.rejected = collections.Counter()
+        self.handed_off = []
+        self.storage = CountingStorage(path=args.storage_path, on_create=self.on_entity_created)
+        import APIServer
+        import Controller
+        APIServer.storage = self.storage
+        Controller.storage = self.storage
+        self.controller = Controller.Controller(cool_down_time=args.cool_down_time, job_timeout=args.job_timeout,
+                                                max_number_of_jobs=args.max_jobs, worker_cooldown=args.worker_cooldown,
+                                                max_batch_size=args.max_batch_size)
+        Controller.controller = self.controller
+        self.controller_server = make_server('127.0.0.1', 0, Controller.app, threaded=True)
+        self.api_server = make_server('127.0.0.1', 0, APIServer.app, threaded=True)
+        self.api_url = 'http://127.0.0.1:{}'.format(self.api_server.port)
+        self.workers = [SimulatedWorker(controller_address='127.0.0.1:{}'.format(self.controller_server.port),
+                                        engine=StubEngine(latency=args.engine_latency,
+                                                          failure_rate=args.failure_rate),
+                                        job_listener=self.on_job_dispatched)
+                        for _ in range(args.workers)]
+        self.desks = [desk['name'] for desk in ReplayServer.load_fixture_desks()['desks']]
+
+    def on_entity_created(self, entity):
+
+        if entity['PartitionKey'] == 'Result':
+            with self.lock:
+                self.completed.setdefault(entity['RowKey'], time.perf_counter())
+
+    def on_job_dispatched(self, kwargs):
+
+        with self.lock:
+            if 'batch' in kwargs:
+                self.batches.append(len(kwargs['batch']))
+                self.dispatched['date-check'] += len(kwargs['batch'])
+            else:
+                self.dispatched['check-desks' if kwargs.get('check_desks') else 'date-check'] += 1
+
+    def start(self):
+
+        for server in (self.controller_server, self.api_server):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+
+        for server in [self.controller_server, self.api_server] + [worker.server for worker in self.workers]:
+            server.shutdown()
+
+    def scale_down(self):
+        """
+        Halfway through the run, drain the configured number of workers as if their pods were terminated.
+        """
+        time.sleep(self.args.duration / 2)
+        threads = [threading.Thread(target=lambda worker=worker: self.handed_off.append(
+            worker.drain(timeout=self.args.drain_timeout))) for worker in self.workers[:self.args.scale_down]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def request_parameters(self):
+
+        start_date = datetime.date.today() + datetime.timedelta(days=random.randint(0, 30))
+        end_date = start_date + datetime.timedelta(days=random.randint(7, 120))
+        return {'start_date': start_date.strftime(Planning.DATE_FORMAT),
+                'end_date': end_date.strftime(Planning.DATE_FORMAT),
+                'desks': random.sample(self.desks, random.randint(1, len(self.desks))), 'email': ''}
+
+    def make_request(self, session, kind):
+        """
+        Make one request of the given kind to the API server and record its latency.
+        :param session: requests.Session
+        :param kind: run_once / run_continuous / desks / get_result (str)
+        """
+        started = time.perf_counter()
+        try:
+            if kind == 'run_once':
+                response = session.post(self.api_url + '/run_once', json=json.dumps(self.request_parameters()))
+                if response.ok:
+                    with self.lock:
+                        self.submitted[response.text] = started
+            elif kind == 'run_continuous':
+                response = session.post(self.api_url + '/run_continuous', json=json.dumps(self.request_parameters()))
+            elif kind == 'desks':
+                response = session.get(self.api_url + '/desks')
+            else:
+                with self.lock:
+                    run_ids = list(self.submitted)
+                run_id = random.choice(run_ids) if run_ids else str(uuid.uuid4())
+                response = session.get(self.api_url + '/get_result', params={'run_id': run_id})
+            if response.status_code == 429:
+                with self.lock:
+                    self.rejected[kind] += 1
+                return
+            response.raise_for_status()
+        except Exception:
+            with self.lock:
+                self.errors[kind] += 1
+            return
+        with self.lock:
+            self.requests[kind].append(time.perf_counter() - started)
+
+    def drive(self):
+        """
+        Send the traffic mix to the API server for the configured duration, in open loop (requests are started at a
+        fixed rate, whether earlier ones finished or not) or closed loop (a fixed number of clients that each wait
+        for their previous request).
+        """
+        kinds, weights = zip(*self.args.mix.items())
+        deadline = time.perf_counter() + self.args.duration
+        if self.args.mode == 'open':
+            sessions = threading.local()
+
+            def open_loop_request(kind):
+                if not hasattr(sessions, 'session'):
+                    sessions.session = client_session()
+                self.make_request(session=sessions.session, kind=kind)
+
+            with ThreadPoolExecutor(max_workers=self.args.clients) as executor:
+                next_request = time.perf_counter()
+                while next_request < deadline:
+                    executor.submit(open_loop_request, random.choices(kinds, weights)[0])
+                    next_request += 1.0 / self.args.rate
+                    time.sleep(max(0.0, next_request - time.perf_counter()))
+        else:
+            def closed_loop_client():
+                with client_session() as session:
+                    while time.perf_counter() < deadline:
+                        self.make_request(session=session, kind=random.choices(kinds, weights)[0])
+                        time.sleep(self.args.think_time)
+
+            clients = [threading.Thread(target=closed_loop_client) for _ in range(self.args.clients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+
+    def wait_for_results(self):
+        """
+        Give outstanding run once requests until the drain timeout to complete.
+        """
+        deadline = time.perf_counter() + self.args.drain
+        while time.perf_counter() < deadline:
+            with self.lock:
+                if all(run_id in self.completed for run_id in self.submitted):
+                    return
+            time.sleep(0.1)
+
+    def report(self, elapsed):
+
+        print("Load: mode={} duration={}s workers={} engine_latency={}s failure_rate={}".format(
+            self.args.mode, self.args.duration, self.args.workers, self.args.engine_latency, self.args.failure_rate))
+        print("Requests:")
+        for kind in sorted(set(self.requests) | set(self.errors) | set(self.rejected)):
+            print("    {:<15} {:>6} ok {:>4} failed {:>4} rejected  p50/p95/p99 ms {}".format(
+                kind, len(self.requests[kind]), self.errors[kind], self.rejected[kind],
+                Benchmark.format_latencies(self.requests[kind])))
+        print("Dispatch: {} job(s) started on workers, {:.2f} jobs/s {}".format(
+            sum(self.dispatched.values()), sum(self.dispatched.values()) / elapsed, dict(self.dispatched)))
+        if self.batches:
+            print("Batches: {}, {:.1f} jobs per batch on average".format(len(self.batches),
+                                                                       sum(self.batches) / len(self.batches)))
+        end_to_end = [self.completed[run_id] - submitted for run_id, submitted in self.submitted.items()
+                      if run_id in self.completed]
+        print("Run once end-to-end: {}/{} completed, p50/p95/p99 ms {}".format(
+            len(end_to_end), len(self.submitted), Benchmark.format_latencies(end_to_end)))
+        print("Queue depth at end: {}".format(self.storage.queue_depth()))
+        if self.args.scale_down:
+            print("Scaled down: {} worker(s) drained, {} job(s) handed off".format(len(self.handed_off),
+                                                                               sum(self.handed_off)))
+        scaling = self.controller.compute_scaling()
+        print("Desired workers at end: {} (average job {:.1f}s)".format(scaling['desired_workers'],
+                                                                         scaling['average_job_seconds']))
+        print("Circuit breaker at end: {}".format(scaling['circuit']))
+        print("Watchers at end: {} continuous run(s) on {} desk(s), {} desk(s) scanned".format(
+            len(self.controller.watchers), len(self.controller.watchers.desks()), len(self.storage.desk_scans())))
+        import Worker
+        counts, total = Worker.upstream_wait_seconds.values.get((), ([0], 0.0))
+        print("Upstream tokens: {} wait(s), {:.1f} ms on average".format(sum(counts),
+                                                                          1000 * total / max(1, sum(counts))))
+        print("Storage operations:")
+        for operation, count in sorted(self.storage.counts.items()):
+            print("    {:<24} {:>8} ({:.1f}/s)".format(operation, count, count / elapsed))
+        import APIServer
+        stages = collections.defaultdict(list)
+        for timing in self.storage.get_job_timings(run_ids=list(self.submitted)).values():
+            for stage, seconds in APIServer._timing_stages(timing=timing)['seconds'].items():
+                if seconds is not None:
+                    stages[stage].append(seconds)
+        print("Run once stages (timed runs):")
+        for stage in ('queued', 'dispatch', 'worker', 'delivery', 'fetch', 'total'):
+            print("    {:<15} {:>6} run(s)  p50/p95/p99 ms {}".format(stage, len(stages[stage]),
+                                                                      Benchmark.format_latencies(stages[stage])))
+
+
+def client_session():
+    """
+    :return: session of a simulated user, with an address of its own so the API server rate limits users apart
+             (requests.Session)
+    """
+    session = requests.Session()
+    session.headers['X-Forwarded-For'] = '10.{}.{}.{}'.format(*(random.randint(0, 255) for _ in range(3)))
+    return session
+
+
+def parse_mix(mix):
+    """
+    :param mix: comma separated kind=weight pairs (str)
+    :return: kind to weight (dict)
+    """
+    weights = dict((kind.strip(), float(weight)) for kind, weight in (pair.split('=') for pair in mix.split(',')))
+    unknown = set(weights) - {'run_once', 'run_continuous', 'desks', 'get_result'}
+    if unknown:
+        raise argparse.ArgumentTypeError("Unknown request kind(s): {}".format(', '.join(unknown)))
+    return weights
 
-run_once_queue_client = QueueClient.from_connection_string(connect_str, queue_name)
 
-requests = 40
 if __name__ == '__main__':
-    for _ in range(0, requests):
-        guid = str(uuid.uuid4())
-        message = "{},23/03/2022,23/06/2022,IND Amsterdam+IND Den Haag,0".format(guid)
-        run_once_queue_client.send_message(message)
+
+    parser = argparse.ArgumentParser(
+        description="End-to-end load test of APIServer, Controller and simulated workers on SQLite storage")
+    parser.add_argument('--mode', choices=['open', 'closed'], default='closed')
+    parser.add_argument('--duration', type=float, default=30, help="seconds to send traffic for")
+    parser.add_argument('--rate', type=float, default=20, help="requests per second in open loop")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients (closed loop) or senders (open)")
+    parser.add_argument('--think-time', type=float, default=0.1,
+                        help="seconds between requests of a closed loop client")
+    parser.add_argument('--mix', type=parse_mix, default='run_once=0.3,run_continuous=0.05,desks=0.05,get_result=0.6',
+                        help="comma separated request kind=weight pairs")
+    parser.add_argument('--workers', type=int, default=4, help="simulated workers")
+    parser.add_argument('--engine-latency', type=float, default=0.5, help="mean seconds a stub check takes")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="probability of a stub check failing")
+    parser.add_argument('--max-jobs', type=int, default=20, help="maximum jobs per worker")
+    parser.add_argument('--max-batch-size', type=int, default=10, help="maximum date checks per batch, 1 to not batch")
+    parser.add_argument('--worker-cooldown', type=int, default=0, help="seconds between jobs assigned to a worker")
+    parser.add_argument('--cool-down-time', type=int, default=30, help="seconds between checks of a continuous job")
+    parser.add_argument('--job-timeout', type=int, default=30, help="seconds until a job is restarted")
+    parser.add_argument('--storage-path', default=':memory:', help="SQLite database file, in memory by default")
+    parser.add_argument('--drain', type=float, default=10, help="seconds to wait for outstanding run once results")
+    parser.add_argument('--scale-down', type=int, default=0, help="workers to drain halfway through the run")
+    parser.add_argument('--drain-timeout', type=float, default=1, help="seconds a drained worker waits for its jobs")
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    harness = Harness(args=args)
+    harness.start()
+    started = time.perf_counter()
+    if args.scale_down:
+        threading.Thread(target=harness.scale_down, daemon=True).start()
+    harness.drive()
+    harness.wait_for_results()
+    harness.report(elapsed=time.perf_counter() - started)
+    harness.stop()
@@ -0,0 +1,149 @@
+from email.mime.text import MIMEText
+import threading
+import logging
+import smtplib
+import queue
+
+# Errors of a single message, after which the connection can still be used for the next one
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class Mailer(object):
+
+    def __init__(self, host, port, sender, password=None, starttls=True, batch_size=20, idle_timeout=30,
+                 max_queued=1000, logger=None):
+        """
+        Sends mail in the background over a single SMTP connection, so callers never wait on SMTP. Mails queued while
+        sending are sent as one batch on the same connection, which is kept open until no mail was queued for
+        idle_timeout seconds and opened again (once) when the server dropped it.
+        :param host: SMTP server (str)
+        :param port: int
+        :param sender: address to send from, and user name to log in with (str)
+        :param password: password to log in with (str, optional, None to not log in, e.g. for a local SMTP sink)
+        :param starttls: whether to upgrade the connection to TLS (Bool)
+        :param batch_size: maximum number of mails sent in one go (int)
+        :param idle_timeout: time in seconds after which an unused connection is closed (float)
+        :param max_queued: maximum number of mails waiting to be sent, more are dropped (int)
+        :param logger: logger to report failures to (logging.Logger, optional)
+        """
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.password = password
+        self.starttls = starttls
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.connection = None
+        # Counts are updated by callers (dropped) and the send thread (sent, failed), and read by metrics
+        self.lock = threading.Lock()
+        self.counts = {'sent': 0, 'failed': 0, 'dropped': 0}
+        self.thread = threading.Thread(target=self.send_loop, daemon=True)
+        self.thread.start()
+
+    def send(self, to, subject, body):
+        """
+        Queue a plain text mail.
+        :param to: address (str)
+        :param subject: str
+        :param body: str
+        :return: whether the mail was queued (Bool)
+        """
+        message = MIMEText(body, 'plain')
+        message['From'] = self.sender
+        message['To'] = to
+        message['Subject'] = subject
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self._count(outcome='dropped')
+            self.logger.error("Mail queue full, dropped mail to {}".format(to))
+            return False
+
+    def flush(self):
+        """
+        Wait until every queued mail has been sent (or failed).
+        """
+        self.queue.join()
+
+    def stats(self):
+        """
+        :return: number of mails queued, sent, failed and dropped (dict)
+        """
+        with self.lock:
+            return dict(self.counts, queued=self.queue.qsize())
+
+    def _count(self, outcome, mails=1):
+        """
+        :param outcome: sent / failed / dropped (str)
+        :param mails: int
+        """
+        with self.lock:
+            self.counts[outcome] += mails
+
+    def send_loop(self):
+
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.idle_timeout)]
+            except queue.Empty:
+                self._disconnect()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._send_batch(batch=batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _send_batch(self, batch):
+        """
+        :param batch: list of email.message.Message
+        """
+        remaining = list(batch)
+        for attempt in range(2):
+            try:
+                connection = self._connect()
+                while remaining:
+                    try:
+                        connection.send_message(remaining[0])
+                        self._count(outcome='sent')
+                    except MESSAGE_ERRORS as e:
+                        self._count(outcome='failed')
+                        self.logger.error("Could not send email to {}: {}".format(remaining[0]['To'], e))
+                    remaining.pop(0)
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                # The server may have dropped the connection since the last batch, reconnect once
+                self._disconnect()
+                if attempt:
+                    self._count(outcome='failed', mails=len(remaining))
+                    self.logger.error("Could not send {} email(s): {}".format(len(remaining), e))
+
+    def _connect(self):
+        """
+        :return: smtplib.SMTP, connected and logged in
+        """
+        if self.connection is None:
+            connection = smtplib.SMTP(self.host, self.port, timeout=30)
+            if self.starttls:
+                connection.starttls()
+            if self.password:
+                connection.login(self.sender, self.password)
+            self.connection = connection
+        return self.connection
+
+    def _disconnect(self):
+
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
@@ -0,0 +1,243 @@
+from flask import request, g
+import contextlib
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names, values, extra=None):
+    """
+    :param names: label names (tuple of str)
+    :param values: label values (tuple)
+    :param extra: additional label name and value (tuple, optional)
+    :return: '{name="value",...}' or '' without labels (str)
+    """
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        """
+        :param name: metric name (str)
+        :param description: help text (str)
+        :param labels: label names (tuple of str)
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        """
+        :param labels: label name to value (dict)
+        :return: label values in order of the label names (tuple)
+        """
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        """
+        :return: (name suffix, label values, extra label or None, value) tuples (list)
+        """
+        raise NotImplementedError
+
+    def render(self):
+        """
+        :return: metric in Prometheus text exposition format (list of str)
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.type)]
+        for suffix, values, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(self.labels, values, extra),
+                                            _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name=name, description=description, labels=labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+
+        with self.lock:
+            return [('_total', key, None, value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name, description, labels=(), function=None):
+        """
+        Gauges are set, or read from a function when scraped. Functions of gauges with labels return a dict of label
+        values (tuple) to value.
+        :param function: function returning the current value (optional)
+        """
+        super().__init__(name=name, description=description, labels=labels)
+        self.function = function
+        self.values = {}
+
+    def set(self, value, **labels):
+
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+
+        if self.function:
+            value = self.function()
+            values = value if isinstance(value, dict) else {(): value}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [('', key, None, value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: upper bounds in seconds (tuple of float)
+        """
+        super().__init__(name=name, description=description, labels=labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+
+    def observe(self, seconds, **labels):
+        """
+        :param seconds: float
+        """
+        key = self._key(labels)
+        with self.lock:
+            # The last count is of observations above the highest bucket
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            index = next((index for index, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+            counts[index] += 1
+            self.values[key] = (counts, total + seconds)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of a block of code.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+
+        samples = []
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, ('le', _format_value(float(bound))), cumulative))
+            samples.append(('_sum', key, None, total))
+            samples.append(('_count', key, None, cumulative))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        """
+        The metrics of a service, served by the /metrics endpoint.
+        """
+        self.metrics = []
+
+    def _add(self, metric):
+
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        """
+        :return: Counter
+        """
+        return self._add(Counter(name=name, description=description, labels=labels))
+
+    def gauge(self, name, description, labels=(), function=None):
+        """
+        :return: Gauge
+        """
+        return self._add(Gauge(name=name, description=description, labels=labels, function=function))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        :return: Histogram
+        """
+        return self._add(Histogram(name=name, description=description, labels=labels, buckets=buckets))
+
+    def render(self):
+        """
+        :return: all metrics in Prometheus text exposition format (str)
+        """
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append('# {} could not be read: {}'.format(metric.name, e))
+        return '\n'.join(lines) + '\n'
+
+
+def add_endpoint(app, registry, telemetry=None):
+    """
+    Serve a registry on /metrics of a Flask app, and time every request of the app by route.
+    :param app: flask.Flask
+    :param registry: Registry
+    :param telemetry: name to object with a stats() method, e.g. Telemetry.TraceExporter (dict, optional)
+    """
+    request_seconds = registry.histogram('http_request_seconds', "Time taken to handle a request",
+                                         labels=('route', 'method', 'status'))
+    if telemetry is not None:
+        registry.gauge('telemetry_items', "Telemetry items by exporter and state (queued, dropped, exported, ...)",
+                       labels=('exporter', 'state'), function=lambda: {
+                           (name, state): value for name, exporter in list(telemetry.items())
+                           for state, value in exporter.stats().items()})
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        if 'metrics_started' in g:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            request_seconds.observe(time.perf_counter() - g.metrics_started, route=route, method=request.method,
+                                    status=response.status_code)
+        return response
+
+    def metrics():
+        return app.response_class(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
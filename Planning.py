@@ -0,0 +1,186 @@
+import datetime
+
+MONTHS = ['januari', 'februari', 'maart', 'april', 'mei', 'juni', 'juli', 'augustus', 'september', 'oktober',
+          'november', 'december']
+DATE_FORMAT = '%d/%m/%Y'
+
+
+def parse_date(date_str):
+    """
+    :param date_str: date as entered in the front end ('%d/%m/%Y' str)
+    :return: datetime.date
+    """
+    return datetime.datetime.strptime(date_str.strip(), DATE_FORMAT).date()
+
+
+def plan_months(start_date, end_date):
+    """
+    Return every month from the start date up to and including the month of the end date, across year boundaries.
+    :param start_date: datetime.date
+    :param end_date: datetime.date
+    :return: list of [year, month] (list of list of int)
+    """
+    months = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append([year, month])
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def plan_request(start_date, end_date, desks, max_results=1):
+    """
+    Parse a date check request once, at ingestion, into the plan that is stored with the job and sent to workers as is.
+    :param start_date: '%d/%m/%Y' str
+    :param end_date: '%d/%m/%Y' str
+    :param desks: list of str
+    :param max_results: number of earliest available days to find per desk (int, 0 or None for all days)
+    :return: dict
+    """
+    start_date_obj, end_date_obj = parse_date(start_date), parse_date(end_date)
+    if end_date_obj < start_date_obj:
+        raise ValueError("End date {} lies before start date {}".format(end_date, start_date))
+    return {
+        'start_date': start_date_obj.strftime(DATE_FORMAT),
+        'end_date': end_date_obj.strftime(DATE_FORMAT),
+        'months': plan_months(start_date=start_date_obj, end_date=end_date_obj),
+        'desks': [desk.strip().lower() for desk in desks if desk.strip()],
+        'max_results': int(max_results) if max_results else None
+    }
+
+
+def remaining_months(months, today=None):
+    """
+    Drop months that have passed, so long running continuous jobs stop asking workers for them.
+    :param months: list of [year, month]
+    :param today: datetime.date (optional, None for today)
+    :return: list of [year, month]
+    """
+    today = today or datetime.date.today()
+    return [[year, month] for year, month in months if (year, month) >= (today.year, today.month)]
+
+
+def month_window(months):
+    """
+    :param months: list of [year, month]
+    :return: first day of the first month (datetime.date), last day of the last month (datetime.date)
+    """
+    first_year, first_month = min(months)
+    last_year, last_month = max(months)
+    window_end = datetime.date(last_year + last_month // 12, last_month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return datetime.date(first_year, first_month, 1), window_end
+
+
+def month_name(month):
+    """
+    :param month: 1-12 (int)
+    :return: Dutch name of the month as shown on the IND site (str)
+    """
+    return MONTHS[month - 1]
+
+
+def format_result(desk, date):
+    """
+    Format an available slot the way workers report results.
+    :param desk: str
+    :param date: datetime.date
+    :return: str
+    """
+    return '{} - {} {} {}'.format(desk, date.day, month_name(date.month), date.year)
+
+
+def parse_result(result, now=None):
+    """
+    Parse a single result string as returned by a worker ('<desk> - <day> <month> <year>') into a desk and date.
+    Results of workers that do not report a year yet are resolved to the first occurrence of the month from now on.
+    :param result: str
+    :param now: datetime to resolve a missing year against (optional, None for current time)
+    :return: desk (str), date (datetime.date) or None if the result could not be parsed
+    """
+    now = now or datetime.datetime.now()
+    try:
+        desk, date_str = result.rsplit(' - ', 1)
+        parts = date_str.split()
+        month = MONTHS.index(parts[1].lower()) + 1
+        if len(parts) > 2:
+            year = int(parts[2])
+        else:
+            year = now.year if month >= now.month else now.year + 1
+        return desk.strip(), datetime.date(year, month, int(parts[0]))
+    except (ValueError, IndexError):
+        return None
+
+
+def job_window(job):
+    """
+    :param job: parameters of a date check job ('desired_months', optional 'start_date' and 'end_date') (dict)
+    :return: first and last acceptable day (tuple of datetime.date)
+    """
+    window_start, window_end = month_window(months=job['desired_months'])
+    return (parse_date(job['start_date']) if job.get('start_date') else window_start,
+            parse_date(job['end_date']) if job.get('end_date') else window_end)
+
+
+def merge_jobs(jobs):
+    """
+    Plan a single check for a batch of date check jobs: the union of their desks and months, within a window spanning
+    all of theirs. Each desk and month is visited once for the whole batch. The earliest days of one job may lie
+    outside the window of another, so every day is looked for unless the jobs share their window.
+    :param jobs: parameters of the jobs as sent to workers (list of dict)
+    :return: 'desired_months', 'desks', 'window' and 'max_results' of the batch (dict)
+    """
+    windows = [job_window(job) for job in jobs]
+    limits = set(job.get('max_results', 1) for job in jobs)
+    return {
+        'desired_months': sorted(set(tuple(month) for job in jobs for month in job['desired_months'])),
+        'desks': sorted(set(desk for job in jobs for desk in job['desks'])),
+        'window': (min(start for start, _ in windows), max(end for _, end in windows)),
+        'max_results': max(limits) if len(set(windows)) == 1 and None not in limits else None
+    }
+
+
+def covers(job, watcher):
+    """
+    Whether the results of a job contain everything another job asks for, so they answer it as well: the job checked
+    all of its desks and months, from the same first day or for every day.
+    :param job: parameters of the job that ran, as sent to workers (dict)
+    :param watcher: parameters of the other job, as sent to workers (dict)
+    :return: Bool
+    """
+    if not set(watcher['desks']) <= set(job['desks']):
+        return False
+    job_months = set(tuple(month) for month in job['desired_months'])
+    if not set(tuple(month) for month in watcher['desired_months']) <= job_months:
+        return False
+    (job_start, job_end), (watcher_start, watcher_end) = job_window(job), job_window(watcher)
+    if watcher_start < job_start or watcher_end > job_end:
+        return False
+    job_limit, watcher_limit = job.get('max_results', 1), watcher.get('max_results', 1)
+    return not job_limit or (watcher_start == job_start and bool(watcher_limit) and watcher_limit <= job_limit)
+
+
+def split_results(results, job):
+    """
+    Pick the results of one job out of the results of its batch.
+    :param results: results of the batch, earliest first per desk (list of str)
+    :param job: parameters of the job as sent to workers (dict)
+    :return: results of the job (list of str)
+    """
+    window_start, window_end = job_window(job)
+    months = set(tuple(month) for month in job['desired_months'])
+    desks = set(job['desks'])
+    max_results = job.get('max_results', 1)
+    found, counts = [], {}
+    for result in results:
+        parsed = parse_result(result)
+        if not parsed:
+            continue
+        desk, date = parsed
+        if (desk.lower() not in desks or not window_start <= date <= window_end
+                or (date.year, date.month) not in months):
+            continue
+        if max_results and counts.get(desk, 0) >= max_results:
+            continue
+        counts[desk] = counts.get(desk, 0) + 1
+        found.append(result)
+    return found
@@ -0,0 +1,135 @@
+from flask import Flask, render_template, Response, abort
+from werkzeug.serving import make_server
+import Engines
+import Planning
+import argparse
+import datetime
+import threading
+import logging
+import json
+import time
+import os
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Fixtures')
+
+app = Flask(__name__, template_folder=fixtures_dir)
+app.config['REPLAY_LATENCY'] = 0.0
+
+
+def load_fixture_desks():
+    """
+    :return: recorded desks and the moment they were recorded at (dict)
+    """
+    with open(os.path.join(fixtures_dir, 'desks.json')) as desks_file:
+        return json.load(desks_file)
+
+
+@app.route("/oap/nl/")
+def appointment_page():
+
+    time.sleep(app.config['REPLAY_LATENCY'])
+    fixture = load_fixture_desks()
+    return render_template('appointment.html', desks=fixture['desks'], recorded_at=fixture['recorded_at'],
+                           product_key=fixture['product_key'])
+
+
+@app.route("/oap/api/desks/<desk_code>/slots/")
+def slots(desk_code):
+
+    path = os.path.join(fixtures_dir, 'slots', '{}.json'.format(os.path.basename(desk_code)))
+    time.sleep(app.config['REPLAY_LATENCY'])
+    if not os.path.exists(path):
+        abort(404)
+    with open(path) as slots_file:
+        return Response(slots_file.read(), mimetype='application/json')
+
+
+class ReplayServer(object):
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        """
+        Serve the recorded fixtures in a background thread, e.g. to point engines at instead of the IND site.
+        :param host: str
+        :param port: port to listen on, 0 for any free port (int)
+        :param latency: time in seconds to delay every response with, to mimic the IND site (float)
+        """
+        app.config['REPLAY_LATENCY'] = latency
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.server = make_server(host, port, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        """
+        :return: scheme, host and port of the server (str)
+        """
+        return "http://{}:{}".format(self.server.host, self.server.port)
+
+    @property
+    def url(self):
+        """
+        :return: URL of the replayed appointment page (str)
+        """
+        return self.base_url + "/oap/nl/#/doc"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+
+
+def fixture_request():
+    """
+    A request covering every recorded desk from the recording date on, so all fixtures are exercised.
+    :return: desired_months (list of [year, month]), desks (list of str), window (tuple of datetime.date)
+    """
+    fixture = load_fixture_desks()
+    start_date = datetime.datetime.strptime(fixture['recorded_at'], '%Y-%m-%d').date()
+    end_date = start_date.replace(year=start_date.year + 1)
+    desks = [desk['name'].lower() for desk in fixture['desks']]
+    return Planning.plan_months(start_date=start_date, end_date=end_date), desks, (start_date, end_date)
+
+
+def compare_engines(engines, max_results=None):
+    """
+    Run every engine against the same fixture request and report time taken and whether results match.
+    :param engines: name to Engines.Engine (dict)
+    :param max_results: number of earliest days to find per desk (int, None for all days)
+    :return: True if all engines returned the same results (Bool)
+    """
+    desired_months, desks, window = fixture_request()
+    outcomes = {}
+    for name, engine in engines.items():
+        started = time.perf_counter()
+        results = engine.check_available_dates(desired_months=desired_months, desks=desks, window=window,
+                                               max_results=max_results)
+        outcomes[name] = sorted(results)
+        print("{}: {:.3f}s, {} result(s)".format(name, time.perf_counter() - started, len(results)))
+        for result in results:
+            print("    {}".format(result))
+    identical = len(set(tuple(results) for results in outcomes.values())) <= 1
+    print("Results {}".format("match" if identical else "differ"))
+    return identical
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serve recorded IND appointment page fixtures")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5004)
+    parser.add_argument('--compare', action='store_true',
+                        help="compare the Selenium and HTTP engines against the fixtures and exit")
+    parser.add_argument('--max-results', type=int, default=0, help="earliest days per desk, 0 for all")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds to delay every response with")
+    args = parser.parse_args()
+    app.config['REPLAY_LATENCY'] = args.latency
+    if args.compare:
+        with ReplayServer(host=args.host, port=args.port, latency=args.latency) as replay_server:
+            matched = compare_engines(engines={
+                'selenium': Engines.SeleniumEngine(url=replay_server.url, step_delay=0.2),
+                'http': Engines.HttpEngine(base_url=replay_server.base_url)
+            }, max_results=args.max_results or None)
+        raise SystemExit(0 if matched else 1)
+    app.run(host=args.host, port=args.port)
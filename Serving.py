@@ -0,0 +1,146 @@
+import threading
+import logging
+import signal
+import os
+
+try:
+    import gunicorn.app.base
+except ImportError:
+    gunicorn = None
+
+_stopping = threading.Lock()
+_stopped = threading.Lock()
+_server = {'on_stop': None, 'master': None}
+
+
+def settings(processes=None, graceful_timeout=None):
+    """
+    Settings of the production server, read from the environment:
+    WEB_PROCESSES worker processes (default 1), WEB_THREADS threads per process (default 8), WEB_TIMEOUT seconds a
+    process may hang on a request before it is killed and replaced (default 150, above the longest wait of /desks),
+    WEB_KEEPALIVE seconds an idle keep-alive connection is kept open (default 5) and WEB_GRACEFUL_TIMEOUT seconds
+    running requests (and on_stop) get to finish when the server stops or reloads (default 30).
+    Every service keeps state in memory (metrics, and rate limits and admission counts on the API server), which
+    separate processes would each keep part of, so services scale with threads and replicas. More processes only suit
+    a service whose state does not matter, e.g. in a benchmark.
+    :param processes: number of processes, overriding WEB_PROCESSES (int, optional, 1 for services that cannot run in
+    more processes at all)
+    :param graceful_timeout: default of WEB_GRACEFUL_TIMEOUT (int, optional)
+    :return: gunicorn settings (dict)
+    """
+    return {'workers': processes or int(os.environ.get('WEB_PROCESSES', 1)),
+            'threads': int(os.environ.get('WEB_THREADS', 8)),
+            'timeout': int(os.environ.get('WEB_TIMEOUT', 150)),
+            'keepalive': int(os.environ.get('WEB_KEEPALIVE', 5)),
+            'graceful_timeout': int(os.environ.get('WEB_GRACEFUL_TIMEOUT', graceful_timeout or 30))}
+
+
+def run(app, port, on_start=None, on_stop=None, processes=None, graceful_timeout=None, logger=None):
+    """
+    Serve a Flask app with gunicorn, in threaded worker processes, or with the Werkzeug development server when
+    WEB_SERVER=dev or gunicorn is not installed. on_start runs in every process once it serves, so background threads
+    are started after gunicorn forked. on_stop runs on SIGTERM while the process still serves requests, e.g. from a
+    controller it drains to, and only then gunicorn stops accepting connections and finishes the running requests.
+    Under gunicorn, SIGHUP reloads gracefully: new processes are started and the old ones run on_stop and finish
+    their requests before they exit.
+    :param app: flask.Flask
+    :param port: int
+    :param on_start: function starting the service, e.g. its startup phases (optional)
+    :param on_stop: function run before a process exits, e.g. to drain (optional)
+    :param processes: number of processes, see settings (int, optional)
+    :param graceful_timeout: default time in seconds to finish requests and on_stop when stopping (int, optional)
+    :param logger: logging.Logger (optional)
+    """
+    logger = logger or logging.getLogger(__name__)
+    _server['on_stop'] = on_stop
+    if os.environ.get('WEB_SERVER', 'gunicorn') == 'dev' or gunicorn is None:
+        if gunicorn is None:
+            logger.warning("gunicorn is not installed, serving with the development server")
+        _run_development_server(app=app, port=port, on_start=on_start, on_stop=on_stop)
+        return
+    options = dict(settings(processes=processes, graceful_timeout=graceful_timeout), bind='0.0.0.0:{}'.format(port),
+                   worker_class='gthread')
+    logger.info("Serving on port {} with gunicorn, {} process(es) of {} threads".format(
+        port, options['workers'], options['threads']))
+
+    def post_worker_init(worker):
+        _server['master'] = worker.ppid
+        if on_stop:
+            signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+                target=_stop_worker, args=(worker, signum, frame), daemon=True).start())
+        if on_start:
+            on_start()
+
+    def worker_exit(server, worker):
+        _run_on_stop()
+
+    options.update(post_worker_init=post_worker_init, worker_exit=worker_exit)
+    _Application(app=app, options=options).run()
+
+
+def stop():
+    """
+    Stop the service from within, e.g. when a worker is asked to shut down. Under gunicorn the master is asked to
+    stop, which runs on_stop in every process, the development server runs on_stop and exits. Only the first call
+    does anything.
+    """
+    if not _stopping.acquire(blocking=False):
+        return
+    if _server['master'] is not None:
+        os.kill(_server['master'], signal.SIGTERM)
+        return
+    _run_on_stop()
+    os._exit(0)
+
+
+def _run_on_stop():
+    """
+    Run on_stop once per process, whether it stops on SIGTERM or exits otherwise (e.g. killed by gunicorn's timeout).
+    """
+    if _server['on_stop'] and _stopped.acquire(blocking=False):
+        _server['on_stop']()
+
+
+def _stop_worker(worker, signum, frame):
+    """
+    SIGTERM handler of a gunicorn process, run in a thread: run on_stop while the process still serves requests,
+    then let gunicorn finish the running requests and exit.
+    :param worker: gunicorn worker of the process
+    :param signum: int
+    :param frame: frame
+    """
+    try:
+        _run_on_stop()
+    finally:
+        worker.handle_exit(signum, frame)
+
+
+def _run_development_server(app, port, on_start=None, on_stop=None):
+
+    if on_start:
+        on_start()
+    if on_stop:
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=stop, daemon=True).start())
+    app.run(host='0.0.0.0', port=port, threaded=True)
+
+
+if gunicorn is not None:
+
+    class _Application(gunicorn.app.base.BaseApplication):
+
+        def __init__(self, app, options):
+            """
+            Runs a WSGI app with the given gunicorn settings instead of reading them from the command line.
+            :param app: WSGI app
+            :param options: gunicorn settings (dict)
+            """
+            self.application = app
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
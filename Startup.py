@@ -0,0 +1,171 @@
+import collections
+import threading
+import logging
+import json
+import time
+
+
+class Startup(object):
+
+    def __init__(self, service, logger=None):
+        """
+        Keeps track of the startup of a service: every phase is timed, and the service is ready once all phases
+        marked as required have finished. Phases that are not needed to serve traffic (e.g. starting exporters) run in
+        the background instead of delaying readiness.
+        :param service: name of the service (str)
+        :param logger: logger to report phases to (logging.Logger, optional)
+        """
+        self.service = service
+        self.logger = logger or logging.getLogger(__name__)
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+        self.required = set()
+        self.failed = {}
+        self.ready_after = None
+
+    def require(self, *names):
+        """
+        Mark phases as required for readiness, before they have started.
+        :param names: str
+        """
+        with self.lock:
+            self.required.update(names)
+            self.phases.update((name, None) for name in names if name not in self.phases)
+
+    def phase(self, name):
+        """
+        Time a phase of startup.
+        :param name: str
+        :return: context manager
+        """
+        return _Phase(startup=self, name=name)
+
+    def in_background(self, name, target, required=False):
+        """
+        Run a phase in a daemon thread.
+        :param name: str
+        :param target: function to run
+        :param required: whether the service is only ready when this phase finished (Bool)
+        :return: threading.Thread
+        """
+        if required:
+            self.require(name)
+
+        def run():
+            try:
+                with self.phase(name):
+                    target()
+            except Exception:
+                pass  # Reported by the phase
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _finish(self, name, seconds, error=None):
+
+        with self.lock:
+            self.phases[name] = seconds
+            if error:
+                self.failed[name] = str(error)
+                self.phases[name] = None
+            elif self.ready_after is None and all(self.phases.get(phase) is not None for phase in self.required):
+                self.ready_after = time.perf_counter() - self.started
+        if error:
+            self.logger.error("Startup phase {} failed after {:.3f}s: {}".format(name, seconds, error))
+        else:
+            self.logger.info("Startup phase {} took {:.3f}s".format(name, seconds))
+
+    @property
+    def ready(self):
+        """
+        :return: Bool
+        """
+        with self.lock:
+            return all(self.phases.get(phase) is not None for phase in self.required)
+
+    def status(self):
+        """
+        :return: dict
+        """
+        with self.lock:
+            return {
+                'service': self.service,
+                'ready': all(self.phases.get(phase) is not None for phase in self.required),
+                'ready_after': self.ready_after,
+                'uptime': time.perf_counter() - self.started,
+                'phases': dict(self.phases),
+                'failed': dict(self.failed)
+            }
+
+
+class _Phase(object):
+
+    def __init__(self, startup, name):
+        self.startup = startup
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        with self.startup.lock:
+            self.startup.phases.setdefault(self.name, None)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.startup._finish(name=self.name, seconds=time.perf_counter() - self.started, error=exc_value)
+
+
+class Lazy(object):
+
+    def __init__(self, factory):
+        """
+        Stand-in for an object that is created on first use, e.g. a storage client or exporter. Attribute access is
+        forwarded to the object, which is created once (thread safe). Call load from a startup phase to create it
+        before it is first needed.
+        :param factory: function returning the object
+        """
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._target = None
+
+    def load(self):
+        """
+        Create the object if it was not created yet.
+        :return: the object
+        """
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    @property
+    def loaded(self):
+        """
+        :return: Bool
+        """
+        return self._target is not None
+
+    def __getattr__(self, item):
+        return getattr(self.load(), item)
+
+
+def add_probes(app, startup):
+    """
+    Add a liveness probe (/healthz, answers as soon as the process serves HTTP) and a readiness probe (/ready, 503
+    until all required startup phases have finished) to a Flask app. Both return the startup status as JSON.
+    :param app: flask.Flask
+    :param startup: Startup
+    """
+    def healthz():
+        return app.response_class(json.dumps(startup.status()), mimetype='application/json')
+
+    def ready():
+        status = startup.status()
+        return app.response_class(json.dumps(status), status=200 if status['ready'] else 503,
+                                  mimetype='application/json')
+
+    app.add_url_rule('/healthz', 'healthz', healthz)
+    app.add_url_rule('/ready', 'ready', ready)
@@ -0,0 +1,718 @@
+from azure.storage.queue import QueueClient
+from azure.data.tables import TableServiceClient, TableTransactionError, TableErrorCode
+from concurrent.futures import ThreadPoolExecutor
+import azure.core.exceptions
+import collections
+import contextlib
+import threading
+import sqlite3
+import json
+import time
+
+RESULTS = 'Result'
+DESKS = 'Desks'
+CONTINUOUS_RUNS = 'ContinuousRun'
+WORKERS = 'RegisteredWorkers'
+JOBS = 'RegisteredJobs'
+DEAD_LETTERS = 'DeadLetter'
+CIRCUITS = 'CircuitBreaker'
+DESK_SCANS = 'DeskScan'
+THROUGHPUT = 'Throughput'
+JOB_TIMINGS = 'JobTiming'
+
+QueueMessage = collections.namedtuple('QueueMessage', ['id', 'content'])
+
+
+def _chunks(items, size):
+    """
+    :param items: list
+    :param size: int
+    :return: consecutive slices of at most size items (generator of list)
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class NotFoundError(KeyError):
+    pass
+
+
+class ExistsError(ValueError):
+    pass
+
+
+class Storage(object):
+    """
+    Base class of the places the API server and controllers keep their shared state: the run once request queue, and
+    entities holding results, desks, continuous runs, workers, jobs and availability history. Entities are dicts
+    keyed by 'PartitionKey' and 'RowKey', as in an Azure Table. Implementations provide the queue and entity
+    primitives (as _send_message, _get_entity, ...), the methods per kind of entity are built on top of those.
+    """
+
+    # Called after every primitive as call_listener(operation, seconds), from the thread that made the call
+    call_listener = None
+
+    @contextlib.contextmanager
+    def timed(self, operation):
+        """
+        Time a call to the underlying storage and report it to call_listener if one is set.
+        :param operation: str
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.call_listener:
+                self.call_listener(operation, time.perf_counter() - started)
+
+    def queue_depth(self):
+        """
+        :return: approximate number of messages in the queue (int)
+        """
+        with self.timed(operation='queue_depth'):
+            return self._queue_depth()
+
+    def send_message(self, content, delay=0):
+        """
+        :param content: str
+        :param delay: time in seconds before the message can be received (float)
+        """
+        with self.timed(operation='send_message'):
+            self._send_message(content=content, delay=delay)
+
+    def receive_message(self):
+        """
+        Receive the oldest message and hide it from other receivers until it is deleted or its visibility times out.
+        :return: message with content attribute, or None if the queue is empty
+        """
+        with self.timed(operation='receive_message'):
+            return self._receive_message()
+
+    def delete_message(self, message):
+        """
+        :param message: message as returned by receive_message
+        """
+        with self.timed(operation='delete_message'):
+            self._delete_message(message=message)
+
+    def get_entity(self, partition_key, row_key):
+        """
+        :param partition_key: str
+        :param row_key: str
+        :return: dict
+        :raises NotFoundError: if the entity does not exist
+        """
+        with self.timed(operation='get_entity'):
+            return self._get_entity(partition_key=partition_key, row_key=row_key)
+
+    def create_entity(self, entity):
+        """
+        :param entity: dict
+        :raises ExistsError: if an entity with the same keys exists
+        """
+        with self.timed(operation='create_entity'):
+            self._create_entity(entity=entity)
+
+    def update_entity(self, entity):
+        """
+        Merge the properties of an entity into the stored entity with the same keys.
+        :param entity: dict
+        :raises NotFoundError: if the entity does not exist
+        """
+        with self.timed(operation='update_entity'):
+            self._update_entity(entity=entity)
+
+    def delete_entity(self, partition_key, row_key):
+        """
+        Delete an entity, if it exists.
+        :param partition_key: str
+        :param row_key: str
+        """
+        with self.timed(operation='delete_entity'):
+            self._delete_entity(partition_key=partition_key, row_key=row_key)
+
+    def query_partition(self, partition_key, row_key_from=None):
+        """
+        :param partition_key: str
+        :param row_key_from: only return entities with a RowKey at or after this one (str, optional)
+        :return: entities ordered by RowKey (list of dict)
+        """
+        with self.timed(operation='query_partition'):
+            return self._query_partition(partition_key=partition_key, row_key_from=row_key_from)
+
+    def send_messages(self, contents):
+        """
+        Send several messages at once.
+        :param contents: list of str
+        """
+        with self.timed(operation='send_messages'):
+            self._send_messages(contents=contents)
+
+    def create_entities(self, entities):
+        """
+        Create several entities at once, in transactions where the implementation has them: the entities of a
+        transaction are either all created or none is.
+        :param entities: list of dict
+        :raises ExistsError: if an entity with the same keys as one of them exists
+        """
+        with self.timed(operation='create_entities'):
+            self._create_entities(entities=entities)
+
+    def get_entities(self, partition_key, row_keys):
+        """
+        :param partition_key: str
+        :param row_keys: list of str
+        :return: row key to entity, for the entities that exist (dict of dict)
+        """
+        with self.timed(operation='get_entities'):
+            return self._get_entities(partition_key=partition_key, row_keys=row_keys)
+
+    def get_result(self, run_id):
+        """
+        :param run_id: uuid4 (str)
+        :return: str
+        :raises NotFoundError: if no result is stored (yet)
+        """
+        return self.get_entity(partition_key=RESULTS, row_key=run_id)['Result']
+
+    def store_result(self, run_id, result):
+        """
+        Store the result of a request, replacing an earlier result of a continuous run.
+        :param run_id: uuid4 (str)
+        :param result: str
+        """
+        entity = {'PartitionKey': RESULTS, 'RowKey': run_id, 'Result': result}
+        try:
+            self.create_entity(entity)
+        except ExistsError:
+            self.update_entity(entity)
+
+    def get_results(self, run_ids):
+        """
+        :param run_ids: list of uuid4 (str)
+        :return: run id to result, for the runs that have one (dict of str)
+        """
+        return {run_id: entity['Result'] for run_id, entity in
+                self.get_entities(partition_key=RESULTS, row_keys=run_ids).items()}
+
+    def create_results(self, results):
+        """
+        Store the results of new requests at once.
+        :param results: run id to result (dict of str)
+        """
+        self.create_entities([{'PartitionKey': RESULTS, 'RowKey': run_id, 'Result': result}
+                              for run_id, result in results.items()])
+
+    def get_desks(self):
+        """
+        :return: dict with 'Desks' and 'CheckedAt'
+        :raises NotFoundError: if desks were never checked or expired
+        """
+        return self.get_entity(partition_key=DESKS, row_key='0')
+
+    def store_desks(self, desks, checked_at):
+        """
+        :param desks: comma separated desks (str)
+        :param checked_at: '%d/%m/%Y %H:%M:%S' (str)
+        """
+        self.create_entity({'PartitionKey': DESKS, 'RowKey': '0', 'Desks': desks, 'CheckedAt': checked_at})
+
+    def delete_desks(self):
+
+        self.delete_entity(partition_key=DESKS, row_key='0')
+
+    def continuous_runs(self):
+        """
+        :return: list of dict
+        """
+        return self.query_partition(partition_key=CONTINUOUS_RUNS)
+
+    def get_continuous_run(self, run_id):
+        """
+        :param run_id: uuid4 (str)
+        :return: dict
+        :raises NotFoundError: if the run does not exist
+        """
+        return self.get_entity(partition_key=CONTINUOUS_RUNS, row_key=run_id)
+
+    def create_continuous_run(self, run_id, properties):
+        """
+        :param run_id: uuid4 (str)
+        :param properties: dict
+        :return: created entity (dict)
+        """
+        entity = dict(properties, PartitionKey=CONTINUOUS_RUNS, RowKey=run_id)
+        self.create_entity(entity)
+        return entity
+
+    def create_continuous_runs(self, runs):
+        """
+        :param runs: run id to properties (dict of dict)
+        :return: created entities (list of dict)
+        """
+        entities = [dict(properties, PartitionKey=CONTINUOUS_RUNS, RowKey=run_id)
+                    for run_id, properties in runs.items()]
+        self.create_entities(entities)
+        return entities
+
+    def delete_continuous_run(self, run_id):
+        """
+        :param run_id: uuid4 (str)
+        """
+        self.delete_entity(partition_key=CONTINUOUS_RUNS, row_key=run_id)
+
+    def workers(self):
+        """
+        :return: list of dict
+        """
+        return self.query_partition(partition_key=WORKERS)
+
+    def get_worker(self, worker_id):
+        """
+        :param worker_id: uuid4 (str)
+        :return: dict
+        :raises NotFoundError: if the worker is not registered
+        """
+        return self.get_entity(partition_key=WORKERS, row_key=worker_id)
+
+    def create_worker(self, worker_id, properties):
+        """
+        :param worker_id: uuid4 (str)
+        :param properties: dict
+        """
+        self.create_entity(dict(properties, PartitionKey=WORKERS, RowKey=worker_id))
+
+    def delete_worker(self, worker_id):
+        """
+        :param worker_id: uuid4 (str)
+        """
+        self.delete_entity(partition_key=WORKERS, row_key=worker_id)
+
+    def jobs(self):
+        """
+        :return: list of dict
+        """
+        return self.query_partition(partition_key=JOBS)
+
+    def get_job(self, job_id):
+        """
+        :param job_id: uuid4 (str)
+        :return: dict
+        :raises NotFoundError: if the job is not registered
+        """
+        return self.get_entity(partition_key=JOBS, row_key=job_id)
+
+    def create_job(self, job_id, properties):
+        """
+        :param job_id: uuid4 (str)
+        :param properties: dict
+        """
+        self.create_entity(dict(properties, PartitionKey=JOBS, RowKey=job_id))
+
+    def delete_job(self, job_id):
+        """
+        :param job_id: uuid4 (str)
+        """
+        self.delete_entity(partition_key=JOBS, row_key=job_id)
+
+    def dead_letters(self):
+        """
+        :return: list of dict
+        """
+        return self.query_partition(partition_key=DEAD_LETTERS)
+
+    def get_dead_letter(self, job_id):
+        """
+        :param job_id: uuid4 (str)
+        :return: dict
+        :raises NotFoundError: if the job is not in the dead letters
+        """
+        return self.get_entity(partition_key=DEAD_LETTERS, row_key=job_id)
+
+    def store_dead_letter(self, job_id, properties):
+        """
+        Store a job that failed too often, replacing an earlier dead letter of the same job.
+        :param job_id: uuid4 (str)
+        :param properties: dict
+        """
+        entity = dict(properties, PartitionKey=DEAD_LETTERS, RowKey=job_id)
+        try:
+            self.create_entity(entity)
+        except ExistsError:
+            self.update_entity(entity)
+
+    def delete_dead_letter(self, job_id):
+        """
+        :param job_id: uuid4 (str)
+        """
+        self.delete_entity(partition_key=DEAD_LETTERS, row_key=job_id)
+
+    def get_circuit(self, name):
+        """
+        :param name: name of the upstream site (str)
+        :return: dict
+        :raises NotFoundError: if the circuit breaker never changed state
+        """
+        return self.get_entity(partition_key=CIRCUITS, row_key=name)
+
+    def store_circuit(self, name, properties):
+        """
+        Store the state of a circuit breaker, replacing its earlier state.
+        :param name: name of the upstream site (str)
+        :param properties: dict
+        """
+        entity = dict(properties, PartitionKey=CIRCUITS, RowKey=name)
+        try:
+            self.create_entity(entity)
+        except ExistsError:
+            self.update_entity(entity)
+
+    def desk_scans(self):
+        """
+        :return: when each desk watched by continuous runs was scanned (list of dict)
+        """
+        return self.query_partition(partition_key=DESK_SCANS)
+
+    def get_desk_scan(self, desk):
+        """
+        :param desk: str
+        :return: dict
+        :raises NotFoundError: if the desk was never scanned
+        """
+        return self.get_entity(partition_key=DESK_SCANS, row_key=desk)
+
+    def store_desk_scan(self, desk, properties):
+        """
+        Store when a desk was scanned for continuous runs, merging with what was stored before.
+        :param desk: str
+        :param properties: dict
+        """
+        entity = dict(properties, PartitionKey=DESK_SCANS, RowKey=desk)
+        try:
+            self.create_entity(entity)
+        except ExistsError:
+            self.update_entity(entity)
+
+    def throughputs(self):
+        """
+        :return: rate at which each controller finished queued requests recently (list of dict)
+        """
+        return self.query_partition(partition_key=THROUGHPUT)
+
+    def store_throughput(self, name, properties):
+        """
+        Store the rate at which a controller finished queued requests, replacing its earlier rate.
+        :param name: unique name of the controller (str)
+        :param properties: dict
+        """
+        entity = dict(properties, PartitionKey=THROUGHPUT, RowKey=name)
+        try:
+            self.create_entity(entity)
+        except ExistsError:
+            self.update_entity(entity)
+
+    def delete_throughput(self, name):
+        """
+        :param name: unique name of the controller (str)
+        """
+        self.delete_entity(partition_key=THROUGHPUT, row_key=name)
+
+    def get_job_timing(self, run_id):
+        """
+        :param run_id: uuid4 (str)
+        :return: dict
+        :raises NotFoundError: if the run was not timed
+        """
+        return self.get_entity(partition_key=JOB_TIMINGS, row_key=run_id)
+
+    def get_job_timings(self, run_ids):
+        """
+        :param run_ids: list of uuid4 (str)
+        :return: run id to timing record, for the runs that were timed (dict of dict)
+        """
+        return self.get_entities(partition_key=JOB_TIMINGS, row_keys=run_ids)
+
+    def create_job_timings(self, timings):
+        """
+        Start the timing records of new requests at once.
+        :param timings: run id to properties (dict of dict)
+        """
+        self.create_entities([dict(properties, PartitionKey=JOB_TIMINGS, RowKey=run_id)
+                              for run_id, properties in timings.items()])
+
+    def store_job_timing(self, run_id, properties):
+        """
+        Store when a run passed stages of its handling, merging with the stages stored before.
+        :param run_id: uuid4 (str)
+        :param properties: dict
+        """
+        entity = dict(properties, PartitionKey=JOB_TIMINGS, RowKey=run_id)
+        try:
+            self.create_entity(entity)
+        except ExistsError:
+            self.update_entity(entity)
+
+
+class AzureStorage(Storage):
+
+    def __init__(self, connect_str, table_name, queue_name):
+        """
+        Storage in an Azure Table and Storage Queue.
+        :param connect_str: Azure Storage connection string (str)
+        :param table_name: str
+        :param queue_name: str
+        """
+        self.queue_client = QueueClient.from_connection_string(connect_str, queue_name)
+        self.table_client = TableServiceClient.from_connection_string(conn_str=connect_str).get_table_client(
+            table_name=table_name)
+        self.executor = ThreadPoolExecutor(max_workers=16)
+
+    # Entities per transaction, and row keys per query (a filter may compare at most 15 times, one is the partition)
+    TRANSACTION_SIZE = 100
+    LOOKUP_SIZE = 14
+
+    def _send_message(self, content, delay=0):
+
+        self.queue_client.send_message(content, visibility_timeout=int(delay) or None)
+
+    def _receive_message(self):
+
+        return self.queue_client.receive_message()
+
+    def _queue_depth(self):
+
+        return self.queue_client.get_queue_properties().approximate_message_count
+
+    def _delete_message(self, message):
+
+        self.queue_client.delete_message(message)
+
+    def _get_entity(self, partition_key, row_key):
+
+        try:
+            return self.table_client.get_entity(partition_key=partition_key, row_key=row_key)
+        except azure.core.exceptions.ResourceNotFoundError:
+            raise NotFoundError((partition_key, row_key))
+
+    def _create_entity(self, entity):
+
+        try:
+            self.table_client.create_entity(entity)
+        except azure.core.exceptions.ResourceExistsError:
+            raise ExistsError((entity['PartitionKey'], entity['RowKey']))
+
+    def _update_entity(self, entity):
+
+        try:
+            self.table_client.update_entity(entity)
+        except azure.core.exceptions.ResourceNotFoundError:
+            raise NotFoundError((entity['PartitionKey'], entity['RowKey']))
+
+    def _delete_entity(self, partition_key, row_key):
+
+        try:
+            self.table_client.delete_entity(partition_key=partition_key, row_key=row_key)
+        except azure.core.exceptions.ResourceNotFoundError:
+            pass
+
+    def _query_partition(self, partition_key, row_key_from=None):
+
+        query_filter = "PartitionKey eq @partition"
+        parameters = {'partition': partition_key}
+        if row_key_from:
+            query_filter += " and RowKey ge @row_key_from"
+            parameters['row_key_from'] = row_key_from
+        return list(self.table_client.query_entities(query_filter, parameters=parameters))
+
+    def _send_messages(self, contents):
+
+        # Storage queues cannot send messages in one call, send them in parallel instead
+        list(self.executor.map(self._send_message, contents))
+
+    def _create_entities(self, entities):
+
+        partitions = collections.defaultdict(list)
+        for entity in entities:
+            partitions[entity['PartitionKey']].append(entity)
+        for partition in partitions.values():
+            for chunk in _chunks(partition, self.TRANSACTION_SIZE):
+                try:
+                    self.table_client.submit_transaction([('create', entity) for entity in chunk])
+                except TableTransactionError as e:
+                    if e.error_code == TableErrorCode.ENTITY_ALREADY_EXISTS:
+                        raise ExistsError([(entity['PartitionKey'], entity['RowKey']) for entity in chunk])
+                    raise
+
+    def _get_entities(self, partition_key, row_keys):
+
+        found = {}
+        for chunk in _chunks(list(row_keys), self.LOOKUP_SIZE):
+            parameters = dict(('row_key{}'.format(index), row_key) for index, row_key in enumerate(chunk))
+            query_filter = "PartitionKey eq @partition and ({})".format(
+                ' or '.join("RowKey eq @{}".format(name) for name in parameters))
+            parameters['partition'] = partition_key
+            found.update((entity['RowKey'], entity) for entity in self.table_client.query_entities(
+                query_filter, parameters=parameters))
+        return found
+
+
+class SQLiteStorage(Storage):
+
+    def __init__(self, path=':memory:', visibility_timeout=30):
+        """
+        Storage in a single SQLite database, for local profiling and small single controller deployments. Entities
+        are stored as JSON under their primary key, which is also the index partition queries range over. The queue
+        is indexed on the time messages become visible.
+        :param path: database file (str, optional, ':memory:' for a database that lives as long as this object)
+        :param visibility_timeout: time in seconds a received message is hidden until it is received again (int)
+        """
+        self.visibility_timeout = visibility_timeout
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS entities (
+                partition_key TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                properties TEXT NOT NULL,
+                PRIMARY KEY (partition_key, row_key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT NOT NULL,
+                visible_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS queue_visible_at ON queue (visible_at, id);
+        """)
+
+    # Row keys per query, below the number of parameters any SQLite version allows
+    LOOKUP_SIZE = 500
+
+    @contextlib.contextmanager
+    def _transaction(self):
+
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def _send_message(self, content, delay=0):
+
+        with self.lock:
+            self.connection.execute("INSERT INTO queue (content, visible_at) VALUES (?, ?)",
+                                    (content, time.time() + delay))
+
+    def _send_messages(self, contents):
+
+        now = time.time()
+        with self._transaction():
+            self.connection.executemany("INSERT INTO queue (content, visible_at) VALUES (?, ?)",
+                                        [(content, now) for content in contents])
+
+    def _receive_message(self):
+
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, content FROM queue WHERE visible_at <= ? ORDER BY visible_at, id LIMIT 1",
+                (now,)).fetchone()
+            if not row:
+                return None
+            self.connection.execute("UPDATE queue SET visible_at = ? WHERE id = ?",
+                                    (now + self.visibility_timeout, row[0]))
+        return QueueMessage(*row)
+
+    def _delete_message(self, message):
+
+        with self.lock:
+            self.connection.execute("DELETE FROM queue WHERE id = ?", (message.id,))
+
+    def _queue_depth(self):
+
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def _get_entity(self, partition_key, row_key):
+
+        with self.lock:
+            row = self.connection.execute("SELECT properties FROM entities WHERE partition_key = ? AND row_key = ?",
+                                          (partition_key, row_key)).fetchone()
+        if not row:
+            raise NotFoundError((partition_key, row_key))
+        return json.loads(row[0])
+
+    def _create_entity(self, entity):
+
+        try:
+            with self.lock:
+                self.connection.execute("INSERT INTO entities VALUES (?, ?, ?)",
+                                        (entity['PartitionKey'], entity['RowKey'], json.dumps(entity)))
+        except sqlite3.IntegrityError:
+            raise ExistsError((entity['PartitionKey'], entity['RowKey']))
+
+    def _update_entity(self, entity):
+
+        keys = (entity['PartitionKey'], entity['RowKey'])
+        with self.lock:
+            row = self.connection.execute("SELECT properties FROM entities WHERE partition_key = ? AND row_key = ?",
+                                          keys).fetchone()
+            if not row:
+                raise NotFoundError(keys)
+            properties = dict(json.loads(row[0]), **entity)
+            self.connection.execute("UPDATE entities SET properties = ? WHERE partition_key = ? AND row_key = ?",
+                                    (json.dumps(properties),) + keys)
+
+    def _delete_entity(self, partition_key, row_key):
+
+        with self.lock:
+            self.connection.execute("DELETE FROM entities WHERE partition_key = ? AND row_key = ?",
+                                    (partition_key, row_key))
+
+    def _query_partition(self, partition_key, row_key_from=None):
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT properties FROM entities WHERE partition_key = ? AND row_key >= ? ORDER BY row_key",
+                (partition_key, row_key_from or '')).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _create_entities(self, entities):
+
+        try:
+            with self._transaction():
+                self.connection.executemany("INSERT INTO entities VALUES (?, ?, ?)", [
+                    (entity['PartitionKey'], entity['RowKey'], json.dumps(entity)) for entity in entities])
+        except sqlite3.IntegrityError:
+            raise ExistsError([(entity['PartitionKey'], entity['RowKey']) for entity in entities])
+
+    def _get_entities(self, partition_key, row_keys):
+
+        found = {}
+        for chunk in _chunks(list(row_keys), self.LOOKUP_SIZE):
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT row_key, properties FROM entities WHERE partition_key = ? AND row_key IN ({})".format(
+                        ', '.join('?' * len(chunk))), [partition_key] + chunk).fetchall()
+            found.update((row_key, json.loads(properties)) for row_key, properties in rows)
+        return found
+
+
+def create_storage(name, path=None, connect_str=None, table_name=None, queue_name=None):
+    """
+    :param name: 'azure' or 'sqlite' (str)
+    :param path: SQLite database file (str, optional, None for in memory)
+    :param connect_str: Azure Storage connection string (str, required for azure)
+    :param table_name: Azure Table name (str, required for azure)
+    :param queue_name: Azure Storage Queue name (str, required for azure)
+    :return: Storage
+    """
+    if name == 'azure':
+        return AzureStorage(connect_str=connect_str, table_name=table_name, queue_name=queue_name)
+    elif name == 'sqlite':
+        return SQLiteStorage(path=path or ':memory:')
+    raise ValueError("Unknown storage: {}".format(name))
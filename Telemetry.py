@@ -0,0 +1,322 @@
+from opencensus.trace import base_exporter, execution_context, span_context, span_data, status, trace_options
+from opencensus.trace.propagation.trace_context_http_header_format import TraceContextPropagator
+from opencensus.trace.span import SpanKind
+from opencensus.common import utils
+from urllib.parse import urlparse
+import threading
+import datetime
+import logging
+import queue
+import time
+import os
+
+# Span names and routes sampled at a lower rate than the default, as they are made continuously by every worker and
+# browser that is waiting for a result. Probes are not traced at all (see UNTRACED_PATHS).
+DEFAULT_SAMPLING_RULES = {
+    '/heartbeat': 0.01,
+    'controller_heartbeat': 0.01,
+    '/get_result': 0.01,
+    'frontend_get_result': 0.01,
+    '/upstream_token': 0.01
+}
+UNTRACED_PATHS = ['ready', 'healthz', 'metrics', 'scaling']
+_propagator = TraceContextPropagator()
+
+
+def traceparent():
+    """
+    Trace context of the current span, to continue its trace where no HTTP headers carry it, e.g. in a queue message.
+    :return: W3C traceparent (str, '' outside a traced request or span)
+    """
+    span = execution_context.get_current_span()
+    tracer = execution_context.get_opencensus_tracer()
+    trace_id = getattr(getattr(tracer, 'span_context', None), 'trace_id', None)
+    if span is None or not trace_id or not getattr(span, 'span_id', None):
+        return ''
+    return _traceparent(trace_id=trace_id, span_id=span.span_id)
+
+
+def _traceparent(trace_id, span_id):
+    """
+    :param trace_id: 32 hex characters (str)
+    :param span_id: 16 hex characters (str)
+    :return: W3C traceparent of a sampled span (str)
+    """
+    context = span_context.SpanContext(trace_id=trace_id, span_id=span_id,
+                                       trace_options=trace_options.TraceOptions('1'))
+    return _propagator.to_headers(context)['traceparent']
+
+
+def record_span(exporter, parent, name, started, ended, attributes=None):
+    """
+    Export a finished span with explicit start and end times as a child of a span in another service. Unlike
+    tracer.span, this does not touch the current span of the thread, so it works for many jobs handled in one thread
+    (e.g. a batch) and for time that passed before the span was recorded (e.g. the wait in the queue).
+    :param exporter: exporter to export the span with, e.g. a TraceExporter
+    :param parent: W3C traceparent of the parent span (str, see traceparent)
+    :param name: str
+    :param started: time since the epoch in seconds (float)
+    :param ended: time since the epoch in seconds (float)
+    :param attributes: dict (optional)
+    :return: W3C traceparent of the recorded span, to record children of it (str, '' if parent is not valid)
+    """
+    context = _propagator.from_headers({'traceparent': parent or ''})
+    if not context.from_header:
+        return ''
+    span_id = span_context.generate_span_id()
+    exporter.export([span_data.SpanData(
+        name=name, context=context, span_id=span_id, parent_span_id=context.span_id, attributes=attributes or {},
+        start_time=utils.to_iso_str(datetime.datetime.fromtimestamp(started, datetime.timezone.utc)),
+        end_time=utils.to_iso_str(datetime.datetime.fromtimestamp(max(started, ended), datetime.timezone.utc)),
+        child_span_count=0, stack_trace=None, annotations=None, message_events=None, links=None,
+        status=status.Status(code=0), same_process_as_parent_span=False, span_kind=SpanKind.UNSPECIFIED)])
+    return _traceparent(trace_id=context.trace_id, span_id=span_id)
+
+
+def parse_rules(rules_str):
+    """
+    :param rules_str: comma separated name=rate pairs, e.g. '/heartbeat=0.01,controller_start_job=1' (str)
+    :return: name to rate (dict)
+    """
+    rules = {}
+    for rule in filter(None, rules_str.split(',')):
+        name, rate = rule.rsplit('=', 1)
+        rules[name.strip()] = float(rate)
+    return rules
+
+
+class SamplingRules(object):
+
+    def __init__(self, rules=None, default_rate=1.0, log_rate=1.0):
+        """
+        Decides which finished spans and log records are exported. Spans that errored are always exported, other
+        spans are exported at the rate of the first rule matching their route, path or name, or the default rate.
+        The decision is made on the trace id, so spans of a trace sampled at the same rate are kept or dropped
+        together. Warnings and errors are always exported, other log records at log_rate.
+        :param rules: span name, route or path to rate between 0 and 1 (dict, optional, None for
+                      DEFAULT_SAMPLING_RULES)
+        :param default_rate: rate of spans no rule matches (float)
+        :param log_rate: rate of log records below warning level (float)
+        """
+        self.rules = DEFAULT_SAMPLING_RULES if rules is None else rules
+        self.default_rate = default_rate
+        self.log_rate = log_rate
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Rules from TRACE_SAMPLING (name=rate pairs, added to the default rules), TRACE_SAMPLE_RATE and LOG_SAMPLE_RATE.
+        :return: SamplingRules
+        """
+        rules = dict(DEFAULT_SAMPLING_RULES, **parse_rules(os.environ.get('TRACE_SAMPLING', '')))
+        return cls(rules=rules, default_rate=float(os.environ.get('TRACE_SAMPLE_RATE', 1.0)),
+                   log_rate=float(os.environ.get('LOG_SAMPLE_RATE', 1.0)))
+
+    @staticmethod
+    def _sampled(trace_id, rate):
+        """
+        :param trace_id: 32 hex characters (str)
+        :param rate: float
+        :return: Bool
+        """
+        if rate >= 1:
+            return True
+        if rate <= 0 or not trace_id:
+            return False
+        return int(trace_id[:8], 16) / 0xffffffff < rate
+
+    def rate(self, span_data):
+        """
+        :param span_data: opencensus.trace.span_data.SpanData
+        :return: float
+        """
+        attributes = span_data.attributes or {}
+        names = [attributes.get('http.route'), attributes.get('http.path'), span_data.name]
+        if attributes.get('http.url'):
+            names.append(urlparse(attributes['http.url']).path)
+        for name in names:
+            if name in self.rules:
+                return self.rules[name]
+        return self.default_rate
+
+    @staticmethod
+    def failed(span_data):
+        """
+        :param span_data: opencensus.trace.span_data.SpanData
+        :return: Bool
+        """
+        try:
+            if int((span_data.attributes or {}).get('http.status_code', 0)) >= 400:
+                return True
+        except (TypeError, ValueError):
+            pass
+        return bool(span_data.status and span_data.status.canonical_code)
+
+    def keep_span(self, span_data):
+        """
+        :param span_data: opencensus.trace.span_data.SpanData
+        :return: Bool
+        """
+        return self.failed(span_data) or self._sampled(span_data.context.trace_id, self.rate(span_data))
+
+    def keep_record(self, record):
+        """
+        :param record: logging.LogRecord
+        :return: Bool
+        """
+        return record.levelno >= logging.WARNING or self._sampled(getattr(record, 'traceId', None), self.log_rate)
+
+
+class BackgroundBatcher(object):
+
+    def __init__(self, name, send, capacity=2048, max_batch_size=100, interval=5.0):
+        """
+        Bounded queue emptied in batches by a daemon thread. Adding never blocks: items that do not fit are dropped
+        and counted, so a slow telemetry backend cannot slow down the threads producing telemetry.
+        :param name: name of the thread (str)
+        :param send: function called with every batch (list) from the thread
+        :param capacity: maximum number of queued items (int)
+        :param max_batch_size: int
+        :param interval: maximum time in seconds an item waits for its batch to fill (float)
+        """
+        self.name = name
+        self.send = send
+        self.max_batch_size = max_batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=capacity)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counts = {'queued': 0, 'dropped': 0, 'exported': 0, 'failed': 0, 'batches': 0}
+
+    def put(self, items):
+        """
+        :param items: list
+        """
+        if self.thread is None:
+            self._start()
+        queued = 0
+        for item in items:
+            try:
+                self.queue.put_nowait(item)
+                queued += 1
+            except queue.Full:
+                break
+        with self.lock:
+            self.counts['queued'] += queued
+            self.counts['dropped'] += len(items) - queued
+
+    def _start(self):
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+
+        # Requests made while exporting should not be traced themselves
+        execution_context.set_is_exporter(True)
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.send(batch)
+                with self.lock:
+                    self.counts['exported'] += len(batch)
+                    self.counts['batches'] += 1
+            except Exception:
+                with self.lock:
+                    self.counts['failed'] += len(batch)
+
+    def stats(self):
+        """
+        :return: counts of queued, dropped, exported and failed items and sent batches, and current queue depth (dict)
+        """
+        with self.lock:
+            return dict(self.counts, depth=self.queue.qsize())
+
+
+class TraceExporter(base_exporter.Exporter):
+
+    def __init__(self, target, rules=None, **batching):
+        """
+        Exporter that samples finished spans and hands the ones it keeps to another exporter in batches, from a
+        background thread.
+        :param target: exporter with an emit(span_datas) method, e.g. a Startup.Lazy AzureExporter
+        :param rules: SamplingRules (optional, None for the defaults)
+        :param batching: keyword arguments for BackgroundBatcher
+        """
+        self.target = target
+        self.rules = rules or SamplingRules()
+        self.sampled_out = 0
+        self.batcher = BackgroundBatcher(name='TraceExporter', send=lambda batch: self.target.emit(batch), **batching)
+
+    def export(self, span_datas):
+
+        kept = [span_data for span_data in span_datas if self.rules.keep_span(span_data)]
+        with self.batcher.lock:
+            self.sampled_out += len(span_datas) - len(kept)
+        if kept:
+            self.batcher.put(kept)
+
+    def emit(self, span_datas):
+
+        self.export(span_datas)
+
+    def stats(self):
+        """
+        :return: dict
+        """
+        with self.batcher.lock:
+            sampled_out = self.sampled_out
+        return dict(self.batcher.stats(), sampled_out=sampled_out)
+
+
+class LogHandler(logging.Handler):
+
+    def __init__(self, target, rules=None, **batching):
+        """
+        Log handler that samples records and hands the ones it keeps to an opencensus log handler in batches, from a
+        background thread.
+        :param target: handler to hand the records to, e.g. an opencensus.ext.azure.log_exporter.AzureLogHandler
+        :param rules: SamplingRules (optional, None for the defaults)
+        :param batching: keyword arguments for BackgroundBatcher
+        """
+        super().__init__()
+        self.target = target
+        self.rules = rules or SamplingRules()
+        self.sampled_out = 0
+        self.batcher = BackgroundBatcher(name='LogHandler', send=self._send, **batching)
+
+    def _send(self, records):
+        """
+        Hand sampled records to the target through its public handler interface, which applies its own level and
+        filters and exports from its own worker thread.
+        :param records: list of logging.LogRecord
+        """
+        for record in records:
+            self.target.handle(record)
+
+    def emit(self, record):
+
+        if not self.rules.keep_record(record):
+            with self.batcher.lock:
+                self.sampled_out += 1
+            return
+        # Render the message now, its arguments may change before the batch is sent
+        record.msg = record.getMessage()
+        record.args = None
+        self.batcher.put([record])
+
+    def stats(self):
+        """
+        :return: dict
+        """
+        with self.batcher.lock:
+            sampled_out = self.sampled_out
+        return dict(self.batcher.stats(), sampled_out=sampled_out)
@@ -0,0 +1,265 @@
+import collections
+import threading
+import random
+import Planning
+
+
+class _Node(object):
+
+    __slots__ = ('key', 'end', 'value', 'priority', 'left', 'right', 'min_end', 'max_end')
+
+    def __init__(self, key, end, value):
+        self.key = key
+        self.end = end
+        self.value = value
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.min_end = end
+        self.max_end = end
+
+    def update(self):
+
+        children = [child for child in (self.left, self.right) if child is not None]
+        self.min_end = min([self.end] + [child.min_end for child in children])
+        self.max_end = max([self.end] + [child.max_end for child in children])
+
+
+def _split(node, key, inclusive=False):
+    """
+    :return: the nodes with keys below key (up to and including it when inclusive), and the others (tuple of _Node)
+    """
+    if node is None:
+        return None, None
+    if node.key < key or (inclusive and node.key == key):
+        node.right, right = _split(node.right, key, inclusive)
+        node.update()
+        return node, right
+    left, node.left = _split(node.left, key, inclusive)
+    node.update()
+    return left, node
+
+
+def _merge(left, right):
+    """
+    :return: the nodes of both trees, every key of left being below every key of right (_Node)
+    """
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    right.left = _merge(left, right.left)
+    right.update()
+    return right
+
+
+class IntervalTree(object):
+
+    def __init__(self):
+        """
+        Intervals in a treap ordered by their start, every node knowing the lowest and highest end in its subtree.
+        Looking for the intervals within a window only descends into subtrees that can hold one, so it takes
+        O(log n + k) for k matches in the usual case, and adding or removing an interval O(log n).
+        """
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, start, end, value):
+        """
+        :param start: first point of the interval (comparable)
+        :param end: last point of the interval (comparable)
+        :param value: unique value to identify the interval by (str)
+        """
+        key = (start, value)
+        left, right = _split(self.root, key)
+        replaced, right = _split(right, key, inclusive=True)
+        self.root = _merge(_merge(left, _Node(key=key, end=end, value=value)), right)
+        if replaced is None:
+            self.size += 1
+
+    def remove(self, start, value):
+        """
+        :param start: first point of the interval (comparable)
+        :param value: value the interval was added with (str)
+        """
+        key = (start, value)
+        left, right = _split(self.root, key)
+        removed, right = _split(right, key, inclusive=True)
+        self.root = _merge(left, right)
+        if removed is not None:
+            self.size -= 1
+
+    def within(self, start, end):
+        """
+        :param start: first point of the window (comparable)
+        :param end: last point of the window (comparable)
+        :return: values of the intervals that lie within the window (list)
+        """
+        found, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.min_end > end:
+                continue
+            node_start = node.key[0]
+            if node_start >= start:
+                stack.append(node.left)
+            if node_start <= end:
+                stack.append(node.right)
+            if start <= node_start and node.end <= end:
+                found.append(node.value)
+        return found
+
+    def span(self):
+        """
+        :return: lowest start and highest end of all intervals (tuple, None if there are none)
+        """
+        if self.root is None:
+            return None
+        node = self.root
+        while node.left is not None:
+            node = node.left
+        return node.key[0], self.root.max_end
+
+
+class WatcherIndex(object):
+
+    def __init__(self):
+        """
+        Continuous runs by desk, each desk holding the windows of the runs watching it in an interval tree. A check of
+        a desk is matched to the runs it answers without looking at the runs watching other desks or other days.
+        """
+        self.lock = threading.Lock()
+        self.watchers = {}
+        self.last_results = {}
+        self.trees = collections.defaultdict(IntervalTree)
+        self.months = collections.defaultdict(collections.Counter)
+
+    def __contains__(self, run_id):
+        return run_id in self.watchers
+
+    def __len__(self):
+        return len(self.watchers)
+
+    def run_ids(self):
+        """
+        :return: set of str
+        """
+        with self.lock:
+            return set(self.watchers)
+
+    def desks(self):
+        """
+        :return: desks watched by at least one run (sorted list of str)
+        """
+        with self.lock:
+            return sorted(self.trees)
+
+    def add(self, run_id, job, last_results=''):
+        """
+        :param run_id: uuid4 (str)
+        :param job: parameters to check the run with, as sent to workers (dict)
+        :param last_results: results the run was last updated with (str)
+        """
+        start, end = Planning.job_window(job)
+        with self.lock:
+            if run_id in self.watchers:
+                self._remove(run_id=run_id)
+            self.watchers[run_id] = job
+            self.last_results[run_id] = last_results
+            for desk in job['desks']:
+                self.trees[desk].add(start=start, end=end, value=run_id)
+                self.months[desk].update(tuple(month) for month in job['desired_months'])
+
+    def remove(self, run_id):
+        """
+        :param run_id: uuid4 (str)
+        """
+        with self.lock:
+            self._remove(run_id=run_id)
+
+    def _remove(self, run_id):
+
+        job = self.watchers.pop(run_id, None)
+        self.last_results.pop(run_id, None)
+        if job is None:
+            return
+        start, _ = Planning.job_window(job)
+        for desk in job['desks']:
+            self.trees[desk].remove(start=start, value=run_id)
+            self.months[desk].subtract(tuple(month) for month in job['desired_months'])
+            for month in [month for month, count in self.months[desk].items() if count <= 0]:
+                del self.months[desk][month]
+            if not len(self.trees[desk]):
+                del self.trees[desk], self.months[desk]
+
+    def get(self, run_id):
+        """
+        :param run_id: uuid4 (str)
+        :return: parameters the run is checked with (dict, None if the run is not indexed)
+        """
+        with self.lock:
+            return self.watchers.get(run_id)
+
+    def set_last_results(self, run_id, results):
+        """
+        :param run_id: uuid4 (str)
+        :param results: str
+        """
+        with self.lock:
+            if run_id in self.watchers:
+                self.last_results[run_id] = results
+
+    def get_last_results(self, run_id):
+        """
+        :param run_id: uuid4 (str)
+        :return: results the run was last updated with (str, None if the run is not indexed)
+        """
+        with self.lock:
+            return self.last_results.get(run_id)
+
+    def desk_scan(self, desk, job_id, today=None):
+        """
+        Parameters of a check of one desk that answers every run watching it: every day in the months that have not
+        passed, within a window spanning all of theirs.
+        :param desk: str
+        :param job_id: uuid4 (str)
+        :param today: datetime.date (optional, None for today)
+        :return: parameters as sent to workers (dict, None if no run watches the desk anymore)
+        """
+        with self.lock:
+            if desk not in self.trees:
+                return None
+            start, end = self.trees[desk].span()
+            months = Planning.remaining_months(months=sorted(self.months[desk]), today=today)
+        if not months:
+            return None
+        return {'job_id': job_id, 'desired_months': months, 'desks': [desk],
+                'start_date': start.strftime(Planning.DATE_FORMAT), 'end_date': end.strftime(Planning.DATE_FORMAT),
+                'max_results': None}
+
+    def matches(self, job, today=None):
+        """
+        Find the runs answered by the results of a date check. A run watching several desks is answered for the
+        desks that were checked, see Planning.covers.
+        :param job: parameters of the check, as sent to workers (dict)
+        :param today: datetime.date to drop passed months of the runs by (optional, None for today)
+        :return: run to the parameters of the run, limited to the desks it was answered for (dict of dict)
+        """
+        start, end = Planning.job_window(job)
+        found = {}
+        with self.lock:
+            for desk in job['desks']:
+                if desk not in self.trees:
+                    continue
+                for run_id in self.trees[desk].within(start=start, end=end):
+                    watcher = self.watchers[run_id]
+                    watcher = dict(watcher, desks=[desk], desired_months=Planning.remaining_months(
+                        months=watcher['desired_months'], today=today))
+                    if watcher['desired_months'] and Planning.covers(job=job, watcher=watcher):
+                        found.setdefault(run_id, dict(watcher, desks=[]))['desks'].append(desk)
+        return found
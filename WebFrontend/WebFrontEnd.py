@@ -7,6 +7,10 @@ from opencensus.trace.tracer import Tracer
 from flask import Flask, render_template, flash, request
 from dateutil.relativedelta import relativedelta
 from Common import secret_key, instrumentation_key
+import Startup
+import Serving
+import Telemetry
+import Metrics
 import datetime
 import requests
 import logging
@@ -17,49 +21,81 @@ import uuid
 guid = str(uuid.uuid4())
 FORMAT = '[%(asctime)s] [FRONTEND] [{}] %(message)s'.format(guid)
 config_integration.trace_integrations(['logging', 'requests'])
-tracer = Tracer(exporter=AzureExporter(connection_string=instrumentation_key), sampler=ProbabilitySampler(1.0))
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-logger.addHandler(AzureLogHandler(connection_string=instrumentation_key))
+startup = Startup.Startup(service='web-frontend', logger=logger)
+sampling_rules = Telemetry.SamplingRules.from_environment()
+trace_exporter = Telemetry.TraceExporter(
+    target=Startup.Lazy(factory=lambda: AzureExporter(connection_string=instrumentation_key)), rules=sampling_rules)
+tracer = Tracer(exporter=trace_exporter, sampler=ProbabilitySampler(1.0))
 
 api_server = 'ind-api-server-ci:5001'
 
 app = Flask(__name__)
-middleware = FlaskMiddleware(app,exporter=AzureExporter(connection_string=instrumentation_key),
-                             sampler=ProbabilitySampler(rate=1.0),)
+middleware = FlaskMiddleware(app, exporter=trace_exporter, sampler=ProbabilitySampler(rate=1.0),
+                             excludelist_paths=Telemetry.UNTRACED_PATHS)
 app.secret_key = secret_key
+Startup.add_probes(app=app, startup=startup)
+metrics = Metrics.Registry()
+telemetry = {'traces': trace_exporter}
+Metrics.add_endpoint(app=app, registry=metrics, telemetry=telemetry)
+available_desks = None
 
 
-def get_desks():
-    with tracer.span(name='frontend_desks'):
-        desks = requests.get("http://{}/desks".format(api_server)).text
-    if not desks:
-        raise RuntimeError("Could not get desks from API server")
-    return desks.split(',')
+def start_telemetry():
+    """
+    Create the trace exporter and start exporting sampled logs to Application Insights. Runs in the background so
+    exporters do not delay readiness, logs from before are only written to the console.
+    """
+    trace_exporter.target.load()
+    telemetry['logs'] = Telemetry.LogHandler(target=AzureLogHandler(connection_string=instrumentation_key),
+                                             rules=sampling_rules)
+    logger.addHandler(telemetry['logs'])
 
 
-timeout = 0
-while True:
-    if timeout >= 10:
-        raise RuntimeError("Could not get desks from API server")
-    try:
-        available_desks = get_desks()
-        break
-    except Exception as e:
-        logging.error("Failed to get desks: {}".format(e))
-        timeout += 1
-        time.sleep(5)
+def get_desks():
+    with tracer.span(name='frontend_desks'):
+        response = requests.get("http://{}/desks".format(api_server))
+    if response.status_code != 200 or not response.text:
+        raise RuntimeError("Could not get desks from API server: {} {}".format(response.status_code, response.text))
+    return response.text.split(',')
+
+
+def load_desks(attempts=10):
+    """
+    Get desks from the API server in the background, retrying while it starts. Until desks are loaded, pages get them
+    from the API server themselves.
+    :param attempts: int
+    """
+    global available_desks
+    for _ in range(attempts):
+        try:
+            available_desks = get_desks()
+            return
+        except Exception as e:
+            logger.error("Failed to get desks: {}".format(e))
+            time.sleep(5)
+    raise RuntimeError("Could not get desks from API server")
+
+
+def client_headers():
+    """
+    :return: headers telling the API server which user a request is made for, so users are rate limited apart (dict)
+    """
+    return {'X-Forwarded-For': request.headers.get('X-Forwarded-For', request.remote_addr)}
 
 
 def request_run_once(parameters):
     with tracer.span(name='frontend_runonce'):
-        return requests.post("http://{}/run_once".format(api_server), json=json.dumps(parameters))
+        return requests.post("http://{}/run_once".format(api_server), json=json.dumps(parameters),
+                             headers=client_headers())
 
 
 def request_run_continuous(parameters):
     with tracer.span(name='frontend_continuous'):
-        return requests.post("http://{}/run_continuous".format(api_server), json=json.dumps(parameters))
+        return requests.post("http://{}/run_continuous".format(api_server), json=json.dumps(parameters),
+                             headers=client_headers())
 
 
 @app.route("/", methods=('GET', 'POST'))
@@ -86,8 +122,19 @@ def root():
                 else:
                     response = request_run_continuous(parameters={'start_date': start_date, 'end_date': end_date,
                                                                   'email': email, 'desks': desks})
-                return render_template('/result.html', run_id=response.text, continuous=method != 'run_once',
-                                       email=email)
+                if response.status_code == 429:
+                    flash('Het is te druk, probeer het over {} seconden opnieuw.'.format(
+                        response.headers.get('Retry-After', 60)))
+                elif response.status_code == 503:
+                    flash('De IND site is niet bereikbaar, probeer het over {} seconden opnieuw.'.format(
+                        response.headers.get('Retry-After', 60)))
+                elif response.status_code != 200:
+                    logger.error("API server refused {} request: {} {}".format(method, response.status_code,
+                                                                                response.text))
+                    flash('Het verzoek kon niet worden verwerkt: {}'.format(response.text))
+                else:
+                    return render_template('/result.html', run_id=response.text, continuous=method != 'run_once',
+                                           email=email)
             except Exception as e:
                 logger.error("No connection to API server: {}".format(e))
                 flash('No connection to API server: {}'.format(e))
@@ -95,7 +142,15 @@ def root():
     start_date = "{}/{}/{}".format(now.day, now.month, now.year)
     three_months_later = datetime.datetime.now() + relativedelta(months=3)
     end_date = "{}/{}/{}".format(three_months_later.day, three_months_later.month, three_months_later.year)
-    return render_template('index.html', desks=available_desks, start_date=start_date, end_date=end_date)
+    desks = available_desks
+    if not desks:
+        try:
+            desks = get_desks()
+        except Exception as e:
+            logger.error("Failed to get desks: {}".format(e))
+            flash('De desks konden niet worden opgehaald, probeer het later opnieuw.')
+            desks = []
+    return render_template('index.html', desks=desks, start_date=start_date, end_date=end_date)
 
 
 @app.route("/index", methods=('GET', 'POST'))
@@ -115,5 +170,11 @@ def get_result():
         return "Still waiting.."
 
 
+def start_web_frontend():
+
+    startup.in_background(name='telemetry', target=start_telemetry)
+    startup.in_background(name='desks', target=load_desks)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    Serving.run(app=app, port=5000, on_start=start_web_frontend, logger=logger)
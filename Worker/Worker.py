@@ -1,9 +1,5 @@
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.support.ui import Select
-from selenium.webdriver.common.by import By
 from flask import Flask, request
+import os
 import time
 import uuid
 import json
@@ -24,14 +20,23 @@ from opencensus.tags import tag_map as tag_map_module
 import logging
 import threading
 from Common import instrumentation_key
+import Planning
+import Engines
+import Startup
+import Serving
+import Telemetry
+import Metrics
 
 config_integration.trace_integrations(['logging', 'requests'])
-tracer = Tracer(exporter=AzureExporter(connection_string=instrumentation_key), sampler=ProbabilitySampler(1.0))
 FORMAT = '[%(asctime)s] [CONTROLLER] [traceId=%(traceId)s spanId=%(spanId)s] %(message)s'
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-logger.addHandler(AzureLogHandler(connection_string=instrumentation_key))
+startup = Startup.Startup(service='worker', logger=logger)
+sampling_rules = Telemetry.SamplingRules.from_environment()
+trace_exporter = Telemetry.TraceExporter(
+    target=Startup.Lazy(factory=lambda: AzureExporter(connection_string=instrumentation_key)), rules=sampling_rules)
+tracer = Tracer(exporter=trace_exporter, sampler=ProbabilitySampler(1.0))
 
 stats = stats_module.stats
 view_manager = stats.view_manager
@@ -42,25 +47,114 @@ workers_view = view_module.View("jobs view", "number of jobs", [], number_of_job
 view_manager.register_view(workers_view)
 mmap = stats_recorder.new_measurement_map()
 tmap = tag_map_module.TagMap()
-exporter = metrics_exporter.new_metrics_exporter(connection_string=instrumentation_key)
-view_manager.register_exporter(exporter)
 
 
 app = Flask(__name__)
-middleware = FlaskMiddleware(app,exporter=AzureExporter(connection_string=instrumentation_key),
-                             sampler=ProbabilitySampler(rate=1.0),)
+middleware = FlaskMiddleware(app, exporter=trace_exporter, sampler=ProbabilitySampler(rate=1.0),
+                             excludelist_paths=Telemetry.UNTRACED_PATHS)
+Startup.add_probes(app=app, startup=startup)
+
+metrics = Metrics.Registry()
+job_seconds = metrics.histogram('worker_job_seconds', "Time taken by a job, until its results are returned",
+                                labels=('job_type',))
+engine_step_seconds = metrics.histogram('worker_engine_step_seconds',
+                                        "Time taken by steps of a check (page load, desk selection, ...)",
+                                        labels=('step',))
+upstream_wait_seconds = metrics.histogram('worker_upstream_wait_seconds',
+                                          "Time waited for a token from the controller before a request to the IND "
+                                          "site")
+result_delivery_seconds = metrics.histogram('worker_result_delivery_seconds',
+                                            "Time taken to return results to the controller")
+telemetry = {'traces': trace_exporter}
+date_checker = None
+
+# Outcomes of jobs reported to the controller. Errors in the job itself (InvalidJobError) are not retried, anything
+# else (the site or browser failing) is.
+JOB_SUCCEEDED = 'ok'
+JOB_RETRIABLE = 'retry'
+JOB_FAILED = 'failed'
+# Engine steps of traced jobs recorded as spans, the others are only summed in the timings of timed jobs
+TRACED_STEPS = ('browser_start', 'upstream_wait', 'page_load', 'scrape_desk')
+
+
+class InvalidJobError(ValueError):
+    pass
+
+
+def browser_pool_occupancy():
+    """
+    :return: number of open, idle and in use browsers, and the maximum number of browsers if pooled (dict)
+    """
+    pool = date_checker.engine.browser_pool if date_checker else None
+    if pool is None:
+        return {}
+    return {(state,): value for state, value in pool.occupancy().items() if value is not None}
+
+
+metrics.gauge('worker_in_flight_jobs', "Jobs running on this worker",
+              function=lambda: date_checker.running_jobs if date_checker else 0)
+metrics.gauge('worker_browser_pool', "Browsers by state", labels=('state',), function=browser_pool_occupancy)
+Metrics.add_endpoint(app=app, registry=metrics, telemetry=telemetry)
+
+
+def start_telemetry():
+    """
+    Create the trace exporter and start exporting sampled logs and metrics to Application Insights. Runs in the
+    background so exporters do not delay readiness, logs from before are only written to the console.
+    """
+    trace_exporter.target.load()
+    telemetry['logs'] = Telemetry.LogHandler(target=AzureLogHandler(connection_string=instrumentation_key),
+                                             rules=sampling_rules)
+    logger.addHandler(telemetry['logs'])
+    view_manager.register_exporter(metrics_exporter.new_metrics_exporter(connection_string=instrumentation_key))
+
+
+def register_to_controller(attempts=120):
+    """
+    Register to the controller, retrying every second while it starts. The worker already serves HTTP meanwhile, so
+    it can accept jobs as soon as it is registered. Exits the process if the controller cannot be reached, so the
+    container is restarted.
+    :param attempts: int
+    """
+    for _ in range(attempts):
+        try:
+            date_checker.register()
+            return
+        except Exception as e:
+            logger.error("Could not register to controller: {}".format(e))
+            time.sleep(1)
+    logger.error("Giving up registering to controller")
+    os._exit(1)
 
 
 class DateChecker:
 
-    def __init__(self, url, controller_timeout=300):
+    def __init__(self, url, engine=None, controller_timeout=300, controller_address='ind-controller-ci:5002',
+                 port=5003):
         """
         Check available dates on website.
         :param url: URL of website to check dates for (str)
+        :param engine: engine used to read availability from the website (Engines.Engine, optional, None for Selenium)
         :param controller_timeout: time of no heartbeat check from controller in seconds until shutdown (int)
+        :param controller_address: host:port to register to (str)
+        :param port: port this worker accepts jobs on (int)
         """
         self.url = url
+        self.controller_address = controller_address
+        self.port = port
+        self.engine = engine or Engines.SeleniumEngine(url=url, logger=logger)
+        # Steps run in the thread of their job, the slowest page load of a job is reported with its outcome, and the
+        # steps of traced jobs with their trace
+        self.job_steps = threading.local()
+        if self.engine.step_listener is None:
+            self.engine.step_listener = self._observe_step
+        if self.engine.throttle is None:
+            self.engine.throttle = self.wait_for_upstream_token
         self.controller_timeout = controller_timeout
+        self.jobs_lock = threading.Lock()
+        self.jobs = {}
+        self.draining = False
+        self.worker_id = None
         self.controller = None
         self.last_heard_from_controller = None
         self.check_controller_thread = threading.Thread(target=self.check_controller_loop, daemon=True)
@@ -71,7 +165,7 @@ class DateChecker:
         while True:
             if self.controller and datetime.datetime.now() - self.last_heard_from_controller > \
                     datetime.timedelta(seconds=self.controller_timeout):
-                shutdown_server()
+                Serving.stop()
                 return
             time.sleep(5)
 
@@ -79,61 +173,146 @@ class DateChecker:
 
         worker_id = str(uuid.uuid4())
         with tracer.span(name='worker_register'):
-            response = requests.post("http://ind-controller-ci:5002/register?worker_id={}".format(worker_id))
+            response = requests.post("http://{}/register?worker_id={}&port={}".format(
+                self.controller_address, worker_id, self.port))
         if response.text.lower().startswith('ok'):
+            self.worker_id = worker_id
             self.controller = response.text.split(',')[1]
             self.last_heard_from_controller = datetime.datetime.now()
         else:
             raise RuntimeError("Could not register to controller")
 
-    def check_available_dates(self, job_id, desired_months, desks):
-        """
-        Check all available dates in desired months on url.
-        :return:
-        """
-        results = []
-        # click_month_picker should be True initially and when the month picker element was clicked on the website,
-        # because it disappears when clicked and should be reacquired in that case.
-        click_month_picker = True
-        driver = self._init_driver()
-        driver.get(self.url)
-        desk_dropdown = Select(driver.find_element(by=By.ID, value='desk'))
-        desk_values = [option for option in desk_dropdown.options if option.text.lower() in desks]
-        for desk_value in desk_values:
-            if not desk_value:  # There's an empty option in the dropdown
-                continue
-            click_month_picker = self._check_desk_for_available_date(
-                driver=driver, desk_value=desk_value, desk_dropdown=desk_dropdown,
-                click_month_picker=click_month_picker, desired_months=desired_months, results=results)
-        driver.quit()
-        results = ",".join(results) if results else ''
-        self.return_results(job_id=job_id, results=results)
-
-    def return_results(self, job_id, results):
-
-        with tracer.span(name='worker_return_results'):
-            requests.post("http://{}/return_result?job_id={}&result={}".format(self.controller, job_id, results))
-
-    def get_available_desks(self, job_id):
-
-        self._get_available_desks(job_id=job_id)
+    def drain(self, timeout=60):
+        """
+        Stop accepting jobs and give running jobs until the timeout to return their results. The controller stops
+        assigning jobs to this worker when draining starts, and restarts the jobs that are still running when it ends
+        on other workers right away, instead of after its job timeout.
+        :param timeout: time in seconds to wait for running jobs (float)
+        :return: number of jobs handed off to the controller (int)
+        """
+        self.draining = True
+        self._notify_controller(action='drain')
+        deadline = time.monotonic() + timeout
+        while self.running_jobs and time.monotonic() < deadline:
+            time.sleep(0.5)
+        handed_off = self.running_jobs
+        self._notify_controller(action='hand_off')
+        return handed_off
+
+    def _notify_controller(self, action):
+        """
+        :param action: drain / hand_off (str)
+        """
+        if not self.controller:
+            return
+        try:
+            with tracer.span(name='worker_{}'.format(action)):
+                response = requests.post("http://{}/{}?worker_id={}".format(self.controller, action, self.worker_id),
+                                         timeout=5)
+            response.raise_for_status()
+        except Exception as e:
+            logger.error("Could not notify controller of {}: {}".format(action, e))
 
-    def _get_available_desks(self, job_id):
+    def check_available_dates(self, job_id, desired_months, desks, start_date=None, end_date=None, max_results=1):
+        """
+        Check available dates in desired months on url. Only days between start and end date are accepted, and a desk
+        is no longer scanned once max_results days have been found for it.
+        :param job_id: uuid4 (str)
+        :param desired_months: list of [year, month]
+        :param desks: list of str
+        :param start_date: first acceptable day ('%d/%m/%Y' str, optional, None for start of first month)
+        :param end_date: last acceptable day ('%d/%m/%Y' str, optional, None for end of last month)
+        :param max_results: number of earliest days to find per desk (int, None for all days)
+        :return: comma separated results (str)
+        """
+        window = self.validate_job(desired_months=desired_months, desks=desks, start_date=start_date,
+                                   end_date=end_date, max_results=max_results)
+        results = self.engine.check_available_dates(desired_months=desired_months, desks=desks, window=window,
+                                                    max_results=max_results)
+        return ",".join(results) if results else ''
 
-        driver = self._init_driver()
-        driver.get(self.url)
-        desks = self._get_desk_options(driver=driver)
-        driver.quit()
-        self.return_results(job_id=job_id, results=','.join(desks))
+    def check_batch(self, job_id, batch):
+        """
+        Check a batch of date check jobs in one session: every desk and month any of the valid jobs asks for is visited
+        once, and the results are split per job. Invalid jobs fail on their own, if the session fails all valid jobs
+        fail with its error.
+        :param job_id: uuid4 of the batch (str)
+        :param batch: parameters of the jobs, as for check_available_dates (list of dict)
+        :return: job id to comma separated results, or to the exception the job failed with (dict)
+        """
+        outcomes, jobs = {}, []
+        for job in batch:
+            try:
+                self.validate_job(**job)
+                jobs.append(job)
+            except InvalidJobError as e:
+                outcomes[job['job_id']] = e
+        if not jobs:
+            return outcomes
+        merged = Planning.merge_jobs(jobs=jobs)
+        try:
+            results = self.engine.check_available_dates(desired_months=merged['desired_months'], desks=merged['desks'],
+                                                        window=merged['window'], max_results=merged['max_results'])
+        except Exception as e:
+            logger.error("Batch {} failed: {}".format(job_id, e))
+            outcomes.update((job['job_id'], e) for job in jobs)
+            return outcomes
+        outcomes.update((job['job_id'], ','.join(Planning.split_results(results=results, job=job))) for job in jobs)
+        return outcomes
 
     @staticmethod
-    def _init_driver():
+    def validate_job(desired_months, desks, start_date=None, end_date=None, max_results=1, **kwargs):
         """
-        Start a headless chrome driver.
+        Check the parameters of a date check job before the site is visited. Only jobs failing this check fail for
+        good, errors raised while checking the site are retried.
+        :param desired_months: list of [year, month]
+        :param desks: list of str
+        :param start_date: first acceptable day ('%d/%m/%Y' str, optional, None for start of first month)
+        :param end_date: last acceptable day ('%d/%m/%Y' str, optional, None for end of last month)
+        :param max_results: number of earliest days to find per desk (int, None for all days)
+        :param kwargs: other parameters of the job, not checked
+        :return: first and last acceptable day (tuple of datetime.date)
         """
-        chrome_options = webdriver.ChromeOptions()
-        chrome_options.headless = True
-        return webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
+        try:
+            if not desks or not all(isinstance(desk, str) for desk in desks):
+                raise ValueError("desks must be a non-empty list of names, got {!r}".format(desks))
+            if max_results is not None and (not isinstance(max_results, int) or max_results < 0):
+                raise ValueError("max_results must be a number of days, got {!r}".format(max_results))
+            return Planning.job_window(job={'desired_months': desired_months, 'start_date': start_date,
+                                            'end_date': end_date})
+        except (KeyError, TypeError, ValueError) as e:
+            raise InvalidJobError("{}: {}".format(type(e).__name__, e))
+
+    def return_results(self, job_id, results, status=JOB_SUCCEEDED, error=None, seconds=None,
+                       page_load_seconds=None, timings=None):
+        """
+        Report the outcome of a job to the controller.
+        :param job_id: uuid4 (str)
+        :param results: str
+        :param status: JOB_SUCCEEDED, JOB_RETRIABLE or JOB_FAILED (str)
+        :param error: what went wrong if the job failed (str, optional)
+        :param seconds: time the job took (float, optional)
+        :param page_load_seconds: slowest page load of the job (float, optional)
+        :param timings: time per engine step and per desk of a timed job (dict with 'steps' and 'desks', optional)
+        """
+        params = {'job_id': job_id, 'result': results, 'status': status, 'worker_id': self.worker_id}
+        if error:
+            params['error'] = error
+        if timings:
+            params['timings'] = json.dumps(timings)
+        if seconds is not None:
+            params['seconds'] = '{:.3f}'.format(seconds)
+        if page_load_seconds is not None:
+            params['page_load_seconds'] = '{:.3f}'.format(page_load_seconds)
+        with tracer.span(name='worker_return_results'), result_delivery_seconds.time():
+            requests.post("http://{}/return_result".format(self.controller), params=params)
+
+    def get_available_desks(self, job_id):
+        """
+        :param job_id: uuid4 (str)
+        :return: comma separated desks (str)
+        """
+        return ','.join(self.engine.get_desks())
 
     def run(self, **kwargs):
         """
@@ -141,109 +320,186 @@ class DateChecker:
         """
         if 'check_desks' in kwargs and kwargs['check_desks'] is True:
             del kwargs['check_desks']
-            thread = threading.Thread(target=self.get_available_desks, kwargs=kwargs, daemon=True)
+            job_type, target = 'check-desks', self.get_available_desks
+        elif 'batch' in kwargs:
+            job_type, target = 'batch', self.check_batch
         else:
-            thread = threading.Thread(target=self.check_available_dates, kwargs=kwargs, daemon=True)
+            job_type, target = 'check-dates', self.check_available_dates
+        traces = self._pop_traces(job_type=job_type, kwargs=kwargs)
+        with self.jobs_lock:
+            # The controller keeps track of the jobs of a batch, not of the batch itself
+            for job_id in self._job_ids(job_type=job_type, kwargs=kwargs):
+                self.jobs[job_id] = job_type
+        thread = threading.Thread(target=self._run_job, args=(job_type, target, kwargs, traces), daemon=True)
         thread.start()
         with tracer.span(name=kwargs['job_id']):
             logger.info("Started job: {}".format(kwargs))
         mmap.measure_int_put(number_of_jobs_measure, 1)
         mmap.record(tmap)
 
-    @staticmethod
-    def _get_desk_options(driver):
+    @property
+    def running_jobs(self):
+        """
+        :return: number of jobs running (int)
+        """
+        return len(self.jobs)
+
+    def running_job_ids(self):
+        """
+        :return: ids of the jobs running (list of str)
         """
-        Get all available desks from site.
-        :return: list of str
+        with self.jobs_lock:
+            return list(self.jobs)
+
+    def wait_for_upstream_token(self):
+        """
+        Wait for a token from the controller before making a request to the IND site, so all workers together stay
+        below the controllers' request rate. Requests are not held up if the controller cannot be reached.
         """
-        desk_dropdown = Select(driver.find_element(by=By.ID, value='desk'))
-        return [desk.text.strip() for desk in desk_dropdown.options if desk.text]
+        started = time.perf_counter()
+        try:
+            if self.controller:
+                response = requests.post("http://{}/upstream_token".format(self.controller), timeout=10)
+                response.raise_for_status()
+                time.sleep(float(response.text))
+        except Exception as e:
+            logger.error("Could not get upstream token from controller: {}".format(e))
+        finally:
+            upstream_wait_seconds.observe(time.perf_counter() - started)
+
+    def _observe_step(self, step, seconds, desk=None):
+        """
+        Step listener of the engine: time steps, keep the slowest page load of the job running in this thread, and its
+        steps if it is traced.
+        :param step: str
+        :param seconds: float
+        :param desk: desk the step was made for (str, optional)
+        """
+        engine_step_seconds.observe(seconds, step=step)
+        if step == 'page_load':
+            self.job_steps.page_load_seconds = max(seconds, getattr(self.job_steps, 'page_load_seconds', None) or 0.0)
+        steps = getattr(self.job_steps, 'steps', None)
+        if steps is not None:
+            steps.append((step, desk, time.time() - seconds, seconds))
 
     @staticmethod
-    def _click_month_picker(driver):
-        """
-        Click month picker to reveal available months on website.
-        """
-        month_picker_element = driver.find_element(by=By.XPATH,
-                                                   value="/html/body/app/div/div[2]/div/div/div/oap-appointment/div/div/oap-appointment-reservation/div/form/div[4]/available-date-picker/div/datepicker/datepicker-inner/div/daypicker/table/thead/tr[1]/th[2]/button")
-        month_picker_element.click()
-        time.sleep(2)
-
-    def _check_desk_for_available_date(self, driver, desk_value, desk_dropdown, desired_months, results,
-                                       click_month_picker=True):
-        """
-        Check a specific desk for an available month and day if any.
-        :param desk_value:
-        :param desk_dropdown:
-        :param desired_months: list of str
-        :param results: list of results found so far (list of str)
-        :param click_month_picker: Selenium element of month picker widget on site
-        :return: True if a month has been clicked to find a day (Bool)
-        """
-        desk_dropdown.select_by_visible_text(desk_value.text)
-        time.sleep(2)
-        logger.info('[{}] Do {}'.format(datetime.datetime.now(), desk_value.text))
-        if click_month_picker:
-            self._click_month_picker(driver=driver)
-        if self._check_desk_for_available_months(driver=driver, desk_value=desk_value, desired_months=desired_months,
-                                                 results=results):
-            return True
-
-    def _check_desk_for_available_months(self, driver, desk_value, desired_months, results):
-        """
-        Check which months are available for the current desk. If any desired ones available, click the first and call
-        func to find a day on that month.
-        :param desk_value: str
-        :param results: list of results found so far (list of str)
-        :return: True if any desired months available (Bool)
-        """
-        potential_month_buttons = driver.find_elements(by=By.CLASS_NAME, value="btn-default")
-        for potential_month_button in potential_month_buttons:
-            month_text = potential_month_button.text.lower()
-            if month_text in desired_months:
-                if not potential_month_button.is_enabled():
-                    continue
-                potential_month_button.click()
-                time.sleep(2)
-                self._check_month_for_available_date(driver=driver, desk_value=desk_value, month=month_text,
-                                                     results=results)
-                return True
+    def _pop_traces(job_type, kwargs):
+        """
+        Take the trace context the controller sent along with jobs out of their parameters.
+        :param job_type: check-desks / check-dates / batch (str)
+        :param kwargs: parameters of the job (dict)
+        :return: job id to trace context, for the jobs that are traced (dict of dict)
+        """
+        jobs = kwargs['batch'] if job_type == 'batch' else [kwargs]
+        return {job['job_id']: job.pop('trace') for job in jobs if job.get('trace')}
 
     @staticmethod
-    def _check_month_for_available_date(driver, desk_value, month, results):
-        """
-        A month has been selected, now check for any available days. If there are any, add the first one to results as
-        we now have a desk, month and day.
-        :param desk_value: str
-        :param month: str
-        :param results: list of results found so far (list of str)
-        """
-        potential_day_buttons = driver.find_elements(by=By.CLASS_NAME, value="btn-sm")
-        days_already_done = []
-        for potential_day_button in potential_day_buttons:
-            day_text = potential_day_button.text
-            if not day_text.isdigit() or day_text in days_already_done:
-                continue
-            days_already_done.append(day_text)
-            if not potential_day_button.is_enabled():
+    def _trace_job(trace, steps, desks, started, ended, attributes):
+        """
+        Record the run of a traced job on this worker as a span of its request, with its steps (browser start, page
+        loads and the scrape of every desk of the job) as child spans.
+        :param trace: trace context of the job, as sent by the controller (dict)
+        :param steps: steps of the run as (name, desk, started, seconds) (list of tuple)
+        :param desks: desks of the job, steps for other desks of a batch are left out (list of str)
+        :param started: time since the epoch the run started (float)
+        :param ended: time since the epoch the run ended (float)
+        :param attributes: attributes of the job's span (dict)
+        :return: time per step and per scraped desk to store if the job is timed (dict with 'steps' and 'desks', None
+                 if it is not)
+        """
+        parent = Telemetry.record_span(exporter=trace_exporter, parent=trace.get('traceparent'), name='worker_job',
+                                       started=started, ended=ended, attributes=attributes)
+        timings = {'steps': {}, 'desks': {}}
+        for step, desk, step_started, seconds in steps:
+            if desk is not None and desk not in desks:
                 continue
-            results.append('{} - {} {}'.format(desk_value.text, day_text, month))
-            logger.info('[{}] Found result: {}'.format(datetime.datetime.now(), desk_value.text))
-            break
-        else:
-            logger.info('[{}] No result: {}'.format(datetime.datetime.now(), desk_value.text))
+            timings['steps'][step] = round(timings['steps'].get(step, 0.0) + seconds, 3)
+            if step == 'scrape_desk':
+                timings['desks'][desk] = round(timings['desks'].get(desk, 0.0) + seconds, 3)
+            if step in TRACED_STEPS and parent:
+                Telemetry.record_span(exporter=trace_exporter, parent=parent, name='worker_{}'.format(step),
+                                      started=step_started, ended=step_started + seconds,
+                                      attributes={'desk': desk} if desk else None)
+        return timings if trace.get('timed') else None
 
+    @staticmethod
+    def _job_ids(job_type, kwargs):
+        """
+        :param job_type: check-desks / check-dates / batch (str)
+        :param kwargs: parameters of the job (dict)
+        :return: ids of the jobs to report outcomes of (list of str)
+        """
+        return [job['job_id'] for job in kwargs['batch']] if job_type == 'batch' else [kwargs['job_id']]
 
-def shutdown_server():
+    def _run_job(self, job_type, target, kwargs, traces=None):
+        """
+        Run a job, time it and report its outcome to the controller. Jobs that raise are reported as failed, as
+        retriable unless the error is in the job itself (e.g. invalid parameters), so the controller can retry them
+        right away instead of waiting for them to time out. The outcome of every job of a batch is reported separately.
+        The run of traced jobs is recorded in their trace, see _trace_job.
+        :param job_type: check-desks / check-dates / batch (str)
+        :param target: function running the job, returning its results (or job id to results for a batch)
+        :param kwargs: parameters of the job (dict)
+        :param traces: job id to trace context, for the jobs that are traced (dict of dict, optional)
+        """
+        traces = traces or {}
+        job_ids = self._job_ids(job_type=job_type, kwargs=kwargs)
+        started, started_at = time.perf_counter(), time.time()
+        self.job_steps.page_load_seconds = None
+        self.job_steps.steps = [] if traces else None
+        try:
+            with job_seconds.time(job_type=job_type):
+                outcomes = target(**kwargs)
+            outcomes = outcomes if job_type == 'batch' else {kwargs['job_id']: outcomes}
+        except Exception as e:
+            outcomes = {job_id: e for job_id in job_ids}
+        seconds = time.perf_counter() - started
+        jobs = {job['job_id']: job for job in kwargs['batch']} if job_type == 'batch' else {kwargs['job_id']: kwargs}
+        for job_id in job_ids:
+            results, status, error = outcomes.get(job_id, ''), JOB_SUCCEEDED, None
+            if isinstance(results, Exception):
+                status = JOB_FAILED if isinstance(results, InvalidJobError) else JOB_RETRIABLE
+                error = '{}: {}'.format(type(results).__name__, results)
+                results = ''
+                logger.error("Job {} failed ({}): {}".format(job_id, status, error))
+            timings = None
+            if job_id in traces:
+                timings = self._trace_job(trace=traces[job_id], steps=self.job_steps.steps,
+                                            desks=jobs[job_id].get('desks') or [], started=started_at,
+                                            ended=started_at + seconds, attributes={
+                                                'job_id': job_id, 'job_type': job_type, 'status': status,
+                                                'batch_size': len(job_ids), 'worker_id': self.worker_id})
+            try:
+                self.return_results(job_id=job_id, results=results, status=status, error=error, seconds=seconds,
+                                    page_load_seconds=self.job_steps.page_load_seconds, timings=timings)
+            except Exception as e:
+                logger.error("Could not return results of job {}: {}".format(job_id, e))
+            finally:
+                with self.jobs_lock:
+                    self.jobs.pop(job_id, None)
+
+
+def drain_worker():
+    """
+    Drain the worker before its process exits. Serving runs it once on SIGTERM (sent by Kubernetes, or by Serving.stop
+    on the shutdown request of the controller and by the controller check), while the worker still serves the
+    controller's heartbeats and calls.
+    """
+    if date_checker is None:
+        return
     logger.info("Shutting down server")
-    func = request.environ.get('werkzeug.server.shutdown')
-    func()
-    quit()
+    handed_off = date_checker.drain(timeout=drain_timeout)
+    logger.info("Drained, {} job(s) handed off to the controller".format(handed_off))
+
+
+drain_timeout = float(os.environ.get('DRAIN_TIMEOUT', 60))
 
 
 @app.route("/start_job", methods=['POST'])
 def start_job():
 
+    if date_checker.draining:
+        return "Draining", 503
     kwargs = json.loads(request.json)
     date_checker.run(**kwargs)
     return "OK"
@@ -261,22 +517,30 @@ def adopt():
 def heartbeat():
 
     date_checker.last_heard_from_controller = datetime.datetime.now()
+    return app.response_class(json.dumps({'status': 'OK', 'running_jobs': date_checker.running_job_ids(),
+                                          'draining': date_checker.draining}), mimetype='application/json')
+
+
+@app.route("/shutdown", methods=['POST'])
+def shutdown():
+
+    threading.Thread(target=Serving.stop, daemon=True).start()
     return "OK"
 
 
-if __name__ == '__main__':
+def start_worker():
 
-    date_checker = DateChecker(url='https://oap.ind.nl/oap/nl/#/doc')
-    timeout = 0
-    while True:
-        try:
-            date_checker.register()
-        except Exception as e:
-            logger.error("Could not register to controller: {}".format(e))
-            timeout += 1
-            if timeout >= 120:
-                quit()
-            time.sleep(1)
-        else:
-            break
-    app.run(host='0.0.0.0', port=5003)
+    global date_checker
+    url = 'https://oap.ind.nl/oap/nl/#/doc'
+    date_checker = DateChecker(url=url, engine=Engines.create_engine(
+        name=os.environ.get('DATECHECKER_ENGINE', 'selenium'), url=url, logger=logger,
+        pool_size=int(os.environ.get('BROWSER_POOL_SIZE', 0)) or None))
+    startup.in_background(name='telemetry', target=start_telemetry)
+    startup.in_background(name='register', target=register_to_controller, required=True)
+
+
+if __name__ == '__main__':
+    # A worker registers itself and its jobs to the controller, so it runs in a single process. Stopping waits for
+    # the drain and hand-off, which must finish before terminationGracePeriodSeconds (aks.yml) runs out.
+    Serving.run(app=app, port=5003, on_start=start_worker, on_stop=drain_worker, processes=1,
+                graceful_timeout=int(drain_timeout) + 15, logger=logger)
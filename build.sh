@@ -2,7 +2,37 @@
 cp Common.py ./Controller/Common.py
 cp Common.py ./Worker/Common.py
 cp Common.py ./APIServer/Common.py
+cp Admission.py ./Controller/Admission.py
+cp Admission.py ./APIServer/Admission.py
+cp Availability.py ./Controller/Availability.py
+cp Availability.py ./APIServer/Availability.py
+cp Planning.py ./Controller/Planning.py
+cp Planning.py ./APIServer/Planning.py
+cp Planning.py ./Worker/Planning.py
+cp Storage.py ./Controller/Storage.py
+cp Mailer.py ./Controller/Mailer.py
+cp Watchers.py ./Controller/Watchers.py
+cp Storage.py ./APIServer/Storage.py
+cp CircuitBreaker.py ./Controller/CircuitBreaker.py
+cp CircuitBreaker.py ./APIServer/CircuitBreaker.py
+cp Engines.py ./Worker/Engines.py
 cp Common.py ./WebFrontend/Common.py
+cp Startup.py ./Controller/Startup.py
+cp Startup.py ./APIServer/Startup.py
+cp Startup.py ./Worker/Startup.py
+cp Startup.py ./WebFrontend/Startup.py
+cp Serving.py ./Controller/Serving.py
+cp Serving.py ./APIServer/Serving.py
+cp Serving.py ./Worker/Serving.py
+cp Serving.py ./WebFrontend/Serving.py
+cp Telemetry.py ./Controller/Telemetry.py
+cp Telemetry.py ./APIServer/Telemetry.py
+cp Telemetry.py ./Worker/Telemetry.py
+cp Telemetry.py ./WebFrontend/Telemetry.py
+cp Metrics.py ./Controller/Metrics.py
+cp Metrics.py ./APIServer/Metrics.py
+cp Metrics.py ./Worker/Metrics.py
+cp Metrics.py ./WebFrontend/Metrics.py
 
 docker build ./Controller -t controller
 docker build ./APIServer -t api_server